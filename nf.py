@@ -119,6 +119,30 @@ def nf(argv=None):
     --detach
     -w, --wait-for-pid WAIT_FOR_PID
 
+    New in 1.5.0:
+    -b BACKEND,BACKEND,...
+    -b all-available
+    --daemon
+    --wsl-helper
+    --provision
+    --offline
+    --rescan-backends
+    --defer-backend
+    --tail N
+    --tail-bytes K
+    --notify-on REGEX
+    --heartbeat INTERVAL
+    --coalesce SECONDS
+    --async-notify
+    --use-shell
+    --debug-level {debug,info,warning,error}
+    --debugfile-format {text,json}
+    --debugfile-max-size BYTES
+    --profile
+    --profile-file PROFILE_FILE
+    --cprofile CPROFILE
+    nf history [--cwd CWD] [--command COMMAND] [--label LABEL] [--since SINCE] [--until UNTIL] [--exit-code EXIT_CODE] [--failed] [--limit LIMIT] [--json]
+
     """
     VERSION = '1.5.0.dev0'
     import argparse
@@ -127,6 +151,13 @@ def nf(argv=None):
     import sys
     import time  # python 2 time.time() instead of datetime.datetime.timestamp()
 
+    monotonic = time.monotonic if hasattr(time, 'monotonic') else time.time
+    profile = {'start': monotonic(), 'last': monotonic(), 'phases': []}
+    def profile_mark(phase):
+        now = monotonic()
+        profile['phases'].append((phase, now - profile['last']))
+        profile['last'] = now
+
     EXAMPLES = '''
 Examples:
  nf make
@@ -161,7 +192,8 @@ Examples:
             except:
                 pass
 
-    def process_exec(cmdline):
+    # check - raise exception if command cannot be run or exits with error, e.g. notification delivery
+    def process_exec(cmdline, check=False):
         p_stdout = ''
         p_stderr = None
         exit_code = None
@@ -170,37 +202,82 @@ Examples:
             p = subprocess.Popen(cmdline, shell=False, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
             p_stdout, p_stderr = p.communicate()
             exit_code = p.returncode
-            log('process{} - exit code:{} stdout={} stderr={}:'.format(cmdline, exit_code, p_stdout, p_stderr))
+            log('process', cmdline, '- exit code:', exit_code, 'stdout:', p_stdout, 'stderr:', p_stderr)
 
         except Exception as e:
-            log('screen - exit code:{} stdout={} stderr={}  exception:'.format(exit_code, p_stdout, p_stderr), e)
+            log('process', cmdline, '- exit code:', exit_code, 'stdout:', p_stdout, 'stderr:', p_stderr, 'exception:', e, level='WARNING')
 
+        if check and exit_code != 0:
+            raise Exception('{} failed, exit code {}'.format(cmdline[0], exit_code))
         return p_stdout
 
+    def regex_type(value):
+        import re
+        try:
+            re.compile(value if isinstance(value, bytes) else value.encode('utf-8'))  # output is scanned as bytes
+        except re.error as e:
+            raise argparse.ArgumentTypeError('invalid regular expression "{}": {}'.format(value, e))
+        return value
+
+    BACKENDS = ['paramiko', 'ssh', 'wsl', 'dbus', 'gdbus', 'notify-send', 'termux-notification', 'win10toast-persist', 'win10toast', 'plyer', 'plyer_toast', 'stdout']
+
+    # one backend, comma separated list of them or "all-available"
+    def backend_type(value):
+        if value == 'all-available':
+            return value
+        for backend in value.split(','):
+            if backend not in BACKENDS:
+                raise argparse.ArgumentTypeError("invalid choice: '{}' (choose from {}, 'all-available')".format(backend, ', '.join(["'{}'".format(name) for name in BACKENDS])))
+        return value
+
     parser = argparse.ArgumentParser(description='Simple command line tool to make notification after target program finished work', epilog=EXAMPLES, formatter_class=argparse.RawDescriptionHelpFormatter, add_help=False)
 
     parser.add_argument('-h', '--help', action="store_true", help='show this help message and exit')
     parser.add_argument('-l', '--label', type=str, help='Add human readable text to custom job identification')
     parser.add_argument('-p', '--print', action="store_true", help='Print notification text in stdout too')
     parser.add_argument('-n', '--no-notify', action="store_true", help='Do not do annoying notifications')
-    parser.add_argument('-s', '--save', action="store_true", help='Save/append command and stat to .nf file')
+    parser.add_argument('-s', '--save', action="store_true", help='Save/append command and stat to .nf file and to history, see "nf history --help"')
     parser.add_argument('-w', '--wait-for-pid', type=int, action='append',help='Wait for PID aka wait for already run process finish work. This option can be used multiple times.')
     parser.add_argument('--detach', action="store_true", help='Run command or wait for pid in detached process')
 
-    parser.add_argument('-b', '--backend', type=str, choices=['paramiko', 'ssh', 'wsl', 'dbus', 'gdbus', 'notify-send', 'termux-notification', 'win10toast-persist', 'win10toast', 'plyer', 'plyer_toast', 'stdout'], help='Notification backend')
+    parser.add_argument('-b', '--backend', type=backend_type, metavar='{{{}}}'.format(','.join(BACKENDS)), help='Notification backend, comma separated list of backends or "all-available" to deliver notification to many backends at once')
     parser.add_argument('-v', '--version', action="store_true", help='Print version')
     parser.add_argument('-d', '--debug', action="store_true", help='More print debugging on stdout')
     parser.add_argument('--debugfile', type=str, help='More print debugging save into file')
+    parser.add_argument('--debug-level', type=str, default='debug', choices=['debug', 'info', 'warning', 'error'], help='Minimal level of debug records')
+    parser.add_argument('--debugfile-format', type=str, default='text', choices=['text', 'json'], help='Format of debugfile records, json is one object per line')
+    parser.add_argument('--debugfile-max-size', type=int, metavar='BYTES', help='Rotate debugfile (to DEBUGFILE.1) when it grows over BYTES')
     parser.add_argument('--custom_notification_text', type=str, help='Custom notification text')
     parser.add_argument('--custom_notification_title', type=str, help='Custom notification title')
     parser.add_argument('--custom_notification_exit_code', type=int, help='Custom notification exit code')
 
+    parser.add_argument('--use-shell', action="store_true", help='Always run command through detected shell, e.g. for aliases or shell functions (simple commands are run directly by default)')
+    parser.add_argument('--rescan-backends', action="store_true", help='Probe all notification backends, do not use backend cached for current environment')
+    parser.add_argument('--defer-backend', action="store_true", help='Start command immediately and probe notification backend while it is running')
+    parser.add_argument('--daemon', action="store_true", help='Run resident nf daemon which keeps notification backend ready, nf sends notifications through it if it is running')
+    parser.add_argument('--provision', action="store_true", help='Download and install dependencies of WSL backend (Windows python, win10toast-persist) now, so notifications do not wait for it')
+    parser.add_argument('--wsl-helper', action="store_true", help='Run resident Windows side helper for WSL backend on localhost, nf under WSL starts it automatically')
+
+    parser.add_argument('--tail', type=int, metavar='N', help='Pass command output (stdout, stderr) through nf and add last N lines of it to notification')
+    parser.add_argument('--tail-bytes', type=int, metavar='K', help='Like --tail but limited to last K bytes of output, can be used with --tail')
+    parser.add_argument('--notify-on', type=regex_type, action='append', metavar='REGEX', help='Notify while command is running when its output matches REGEX for the first time. This option can be used multiple times.')
+    parser.add_argument('--async-notify', action="store_true", help='Return exit code of command at once and deliver notification in detached process (or set NF_ASYNC_NOTIFY=1), not on Windows')
+    parser.add_argument('--coalesce', type=float, metavar='SECONDS', help='Collect notifications of nf runs finishing within SECONDS in ~/.nfdir/spool (one spool per session: SSH_CLIENT, DISPLAY, TMUX, ...) and send one digest notification for them (or set NF_COALESCE=SECONDS), 0 disables it; nf which sends the digest returns after SECONDS, add --async-notify to return at once')
+    # internal: notification prepared by nf --async-notify, delivered by new nf process
+    parser.add_argument('--notification-json', type=str, help=argparse.SUPPRESS)
+    parser.add_argument('--heartbeat', type=float, metavar='INTERVAL', help='Update one notification with elapsed time (and ETA from history) every INTERVAL seconds while command is running, dbus and gdbus backends only')
+
+    parser.add_argument('--profile', action="store_true", help='Print time spent by nf in each phase as JSON on stderr (or set NF_PROFILE=1)')
+    parser.add_argument('--profile-file', type=str, help='Append time spent by nf in each phase as JSON line to file (or set NF_PROFILE=file)')
+    parser.add_argument('--cprofile', type=str, help='Run nf under cProfile and save stats to .pstats file (or set NF_CPROFILE=file)')
+
     parser.add_argument('--sub-nf-args', type=str, help='Arguments from sub-nf, like after-ssh or after-wsl')
 
     parser.add_argument('--env-unset', type=str, help='Modify environment - unset variable')
     parser.add_argument('--env-set-default', type=str, help='Modify environment - set variable if not set; KEY=value')
 
     parser.add_argument('--try-version', type=str, help='Download and run specific nf version: tag, branch, commit hash or "list" to display possible tags/versions. Try "master" for latest development version.')
+    parser.add_argument('--offline', action="store_true", help='Use only nf versions and list of versions cached in ~/.nfdir/versions by --try-version, do not download')
     parser.add_argument('cmd', nargs='?')
     parser.add_argument('args', nargs=argparse.REMAINDER)
 
@@ -244,34 +321,113 @@ Examples:
         return 0
 
     args = parser.parse_args(argv)
+    profile_mark('arguments')
+
+    if args.profile_file is None and os.environ.get('NF_PROFILE'):
+        if os.environ['NF_PROFILE'] == '1':
+            args.profile = True
+        else:
+            args.profile_file = os.environ['NF_PROFILE']
+    if not args.async_notify and os.environ.get('NF_ASYNC_NOTIFY', '').lower() in ['1', 'yes', 'true']:
+        args.async_notify = True
+    if args.coalesce is None and os.environ.get('NF_COALESCE'):
+        try:
+            args.coalesce = float(os.environ['NF_COALESCE'])
+        except ValueError as e:
+            print_stdout('nf: WARNING: NF_COALESCE is not number of seconds, notifications are not coalesced: {}'.format(e), file=sys.stderr)
+    if args.cprofile is None and os.environ.get('NF_CPROFILE'):
+        args.cprofile = os.environ['NF_CPROFILE']
+    if args.cprofile is not None:
+        try:
+            import cProfile
+            profile['cprofile'] = cProfile.Profile()
+            profile['cprofile'].enable()
+        except Exception:
+            profile['cprofile'] = None
+
+    LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR']
+    LOGFILE_BUFFER_SIZE = 64 * 1024
+
+    # nothing is formatted and clock is not read when debug is off
+    log_enabled = args.debug or args.debugfile is not None
+    log_min_level = LOG_LEVELS.index(args.debug_level.upper())
+    logfile = {'handle': None, 'size': 0, 'lock': None}
+
+    def logfile_open():
+        import atexit
+        import threading
+        try:
+            logfile['size'] = os.path.getsize(args.debugfile)
+        except OSError:
+            logfile['size'] = 0
+        if args.debugfile_max_size is not None and logfile['size'] >= args.debugfile_max_size:
+            logfile_rotate()
+        logfile['handle'] = open(args.debugfile, 'ab', LOGFILE_BUFFER_SIZE)
+        if logfile['lock'] is None:
+            logfile['lock'] = threading.Lock()
+            atexit.register(logfile_flush)  # buffered records are not lost on crash
+
+    # debugfile -> debugfile.1, previous debugfile.1 is removed
+    def logfile_rotate():
+        rotated = args.debugfile + '.1'
+        if os.path.exists(rotated):
+            os.remove(rotated)
+        os.rename(args.debugfile, rotated)
+        logfile['size'] = 0
+
+    def logfile_flush():
+        try:
+            if logfile['handle'] is not None and not logfile['handle'].closed:
+                logfile['handle'].flush()
+        except Exception:
+            pass
 
-    logfile = {'handle': None}
-    def log(*arg):
+    def log(*arg, **options):
+        if not log_enabled:
+            return
         try:
+            level = options.get('level', 'DEBUG')
+            if LOG_LEVELS.index(level) < log_min_level:
+                return
             debug_prefix = 'DEBUG:    '
-            current_time = datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S.%f")
+            now = datetime.datetime.now()
+            current_time = now.strftime("%Y/%m/%d %H:%M:%S.%f")
+            # log('x={} y={}', x, y, more): fields of first argument are filled only here, when record is written
+            if arg and isinstance(arg[0], str) and '{' in arg[0]:
+                import string
+                fields = len([field for _, field, _, _ in string.Formatter().parse(arg[0]) if field is not None])
+                arg = (arg[0].format(*arg[1:fields + 1]),) + arg[fields + 1:]
+            message = ' '.join(['{}'.format(a) for a in arg])
             if args.debug is True:
-                argss = []
-                for a in arg:
-                    argss.append('{}'.format(a).replace('\n', '\n{}'.format(debug_prefix)))
                 try:
-                    print('DEBUG {}: {}'.format(current_time, ' '.join(argss)))
+                    print('{} {}: {}'.format(level, current_time, message.replace('\n', '\n{}'.format(debug_prefix))))
                 except:
                     pass
             if args.debugfile is not None:
-                argss = []
-                for a in arg:
-                    argss.append('{}'.format(a).replace('\n', '\n{}'.format(debug_prefix)))
+                if args.debugfile_format == 'json':
+                    import json
+                    record = json.dumps({'time': now.isoformat(), 'level': level, 'pid': os.getpid(), 'message': message}) + '\n'
+                else:
+                    record = '{} {}: {}\n'.format(level, current_time, message.replace('\n', '\n{}'.format(debug_prefix)))
+                record = record.encode('utf-8')
                 if logfile['handle'] is None:
-                    logfile['handle'] = open(args.debugfile, 'a+b', 0)
-                logfile['handle'].write('DEBUG {}: {}\n'.format(current_time, ' '.join(argss)).encode())
+                    logfile_open()
+                with logfile['lock']:
+                    if args.debugfile_max_size is not None and logfile['size'] + len(record) > args.debugfile_max_size and logfile['size'] > 0:
+                        logfile['handle'].close()
+                        logfile_rotate()
+                        logfile['handle'] = open(args.debugfile, 'ab', LOGFILE_BUFFER_SIZE)
+                    logfile['handle'].write(record)
+                    logfile['size'] += len(record)
+                if level == 'ERROR':
+                    logfile_flush()
         except Exception as e:
             # print(e)
             pass
 
-    log('nf version={}'.format(VERSION))
-    log('python {}'.format(sys.version_info))
-    log('platform {}'.format(sys.platform))
+    log('nf version={}', VERSION)
+    log('python {}', sys.version_info)
+    log('platform {}', sys.platform)
     is_wsl = False
     try:
         if sys.platform.startswith('linux'):
@@ -280,7 +436,7 @@ Examples:
                 is_wsl = True if 'Microsoft' in v else False
     except Exception as e:
         log('cannot detect wsl: ', e)
-    log('is_wsl {}'.format(is_wsl))
+    log('is_wsl {}', is_wsl)
 
 
     if args.debug:
@@ -302,7 +458,7 @@ Examples:
 
     if args.debug:
         for env in environ_var_used_by_nf:
-            log('env var: {}={}'.format(env, repr(os.environ.get(env))))
+            log('env var: {}={}', env, repr(os.environ.get(env)))
 
     if args.env_unset and args.env_unset in os.environ:
         del os.environ[args.env_unset]
@@ -313,7 +469,7 @@ Examples:
 
     if args.debug:
         for env in environ_var_used_by_nf:
-            log('final env var: {}={}'.format(env, repr(os.environ.get(env))))
+            log('final env var: {}={}', env, repr(os.environ.get(env)))
 
 # TODO
 # find ls -t ~/.dbus/session-bus/ | head -n 1
@@ -330,10 +486,10 @@ Examples:
             abi = '{}-{}'.format(sys.implementation.name, abi)
     except Exception as e:
         log('abi general error', e)
-    log('abi {}'.format(abi))
+    log('abi {}', abi)
 
-    log('argv {}'.format(sys.argv))
-    log('args {}'.format(args))
+    log('argv', sys.argv)
+    log('args', args)
 
     def windows_to_wsl_path(win_path):
         try:
@@ -361,8 +517,9 @@ Examples:
         except Exception as e:
             log('cannot get user directory', e)
 
-    log('nf dir: {}'.format(nf_dir))
-    log('nf dir win for wsl: {}'.format(nf_dir_win_for_wsl))
+    log('nf dir: {}', nf_dir)
+    log('nf dir win for wsl: {}', nf_dir_win_for_wsl)
+    profile_mark('environment')
 
 # functions (used more than once) ----------------------------------------------
 
@@ -382,25 +539,77 @@ Examples:
                 log('which by distutils failed', e)
         return path
 
+    # everything nf needs from tmux in one process, cached per pane for back-to-back nf calls
+    # (client pid too, so attach from other terminal is seen after TMUX_CACHE_TTL seconds)
+    TMUX_FORMAT = '\t'.join(['#{session_name}', '#{window_index}', '#{window_name}', '#{pane_index}', '#{pane_title}', '#{client_pid}'])
+    TMUX_CACHE_TTL = 10
+    import threading
+    tmux_info = {'lock': threading.Lock()}
+
+    def tmux_context():
+        if 'TMUX' not in os.environ:
+            return None
+        # backend probe threads and console names detection ask at the same time, one tmux process for all of them
+        with tmux_info['lock']:
+            if 'context' not in tmux_info:
+                tmux_info['context'] = tmux_context_read()
+            return tmux_info['context']
+
+    def tmux_context_read():
+        import hashlib
+        pane = os.environ.get('TMUX_PANE')
+        cache_file = os.path.join(nf_dir, 'tmux', hashlib.sha1('{}\n{}'.format(os.environ['TMUX'], pane).encode()).hexdigest() + '.json')
+        try:
+            cached = read_json_file(cache_file)
+            if 0 <= time.time() - cached['time'] < TMUX_CACHE_TTL:
+                log('cached tmux context', cached['context'])
+                return cached['context']
+        except Exception:
+            pass
+
+        context = None
+        output = None
+        try:
+            target = ['-t', pane] if pane else []
+            output = process_exec(['tmux', 'display-message', '-p'] + target + [TMUX_FORMAT, ';', 'show-environment'] + target + ['SSH_CLIENT'])
+            if isinstance(output, bytes):
+                output = output.decode('utf-8', 'replace')
+            lines = output.splitlines()
+            fields = lines[0].split('\t')
+            if len(fields) == 6:
+                context = dict(zip(['session', 'window_index', 'window_name', 'pane_index', 'pane_title', 'client_pid'], fields))
+                context['client_pid'] = int(context['client_pid']) if context['client_pid'].isdigit() else None
+                # show-environment prints "SSH_CLIENT=value" or "-SSH_CLIENT" when removed from session
+                context['ssh_client'] = None
+                for line in lines[1:]:
+                    if line.startswith('SSH_CLIENT='):
+                        context['ssh_client'] = line[len('SSH_CLIENT='):]
+        except Exception as e:
+            log('tmux context failed:', output, e)
+        log('tmux context', context)
+
+        if context is not None:
+            try:
+                write_json_file(cache_file, {'time': time.time(), 'context': context})
+            except Exception as e:
+                log('cannot write tmux context cache', e)
+        return context
+
     def get_ssh():
         import os
         ssh_ip = None
         ssh_port = None
 
-        if 'TMUX' in os.environ:
-            output = None
-            try:
-                output = process_exec(['tmux', 'show-environment', 'SSH_CLIENT'], shell=False).decode().strip()
-                log('cmd: {} output'.format(cmdline_args), output)
-                if output == '-SSH_CLIENT':
-                    log('no ssh in tmux')
-                else:
-                    ssh_connection = output[11:].split(' ')
-                    log('ssh in tmux:', ssh_connection)
+        context = tmux_context()
+        if context is not None:
+            if context['ssh_client'] is None:
+                log('no ssh in tmux')
+            else:
+                ssh_connection = context['ssh_client'].split(' ')
+                log('ssh in tmux:', ssh_connection)
+                if len(ssh_connection) == 3:
                     ssh_ip = ssh_connection[0]
                     ssh_port = ssh_connection[2]
-            except Exception as e:
-                log('{} failed: {}'.format('tmux show-environment SSH_CLIENT', output), e)
 
         if (ssh_ip is None or ssh_port is None) and 'SSH_CLIENT' in os.environ:
             ssh_connection = os.environ['SSH_CLIENT'].split(' ')
@@ -410,48 +619,254 @@ Examples:
         return (ssh_ip, ssh_port)
 
 
-    def call_dbus(service_name, path, method, *arg):
-        app = which('qdbus')
-        if app is not None:
-            log('which qdbus: {}'.format(app))
-
-            xarg = []
-            for a in arg:
-                if a.startswith('int32:'):
-                    a = a[6:]
-                xarg.append(a)
-            tool_cmdline = [app, service_name, path, method]
-            tool_cmdline.extend(xarg)
+    ############################################################################
+    # D-Bus wire protocol client, used when python-dbus is not installed
+    ############################################################################
+    DBUS_ALIGNMENT = {'y': 1, 'b': 4, 'n': 2, 'q': 2, 'i': 4, 'u': 4, 'x': 8, 't': 8, 'd': 8, 's': 4, 'o': 4, 'g': 1, 'a': 4, '(': 8, '{': 8, 'v': 1, 'h': 4}
+    DBUS_WIRE_TIMEOUT = 2
+    DBUS_FIXED = {'y': 'B', 'b': 'I', 'n': 'h', 'q': 'H', 'i': 'i', 'u': 'I', 'x': 'q', 't': 'Q', 'd': 'd', 'h': 'I'}
+
+    # "a{sv}i" -> ["a{sv}", "i"]
+    def dbus_wire_split_signature(signature):
+        types = []
+        index = 0
+        while index < len(signature):
+            end = index
+            while signature[end] == 'a':
+                end += 1
+            if signature[end] in '({':
+                depth = 0
+                while True:
+                    if signature[end] in '({':
+                        depth += 1
+                    elif signature[end] in ')}':
+                        depth -= 1
+                    end += 1
+                    if depth == 0:
+                        break
+            else:
+                end += 1
+            types.append(signature[index:end])
+            index = end
+        return types
+
+    def dbus_wire_pad(data, alignment):
+        data.extend(b'\0' * (-len(data) % alignment))
+
+    def dbus_wire_marshal(data, signature, value):
+        import struct
+        code = signature[0]
+        dbus_wire_pad(data, DBUS_ALIGNMENT[code])
+        if code in DBUS_FIXED:
+            data.extend(struct.pack('<' + DBUS_FIXED[code], value))
+        elif code in 'sog':
+            if not isinstance(value, bytes):
+                value = value.encode('utf-8')
+            data.extend(struct.pack('<B' if code == 'g' else '<I', len(value)))
+            data.extend(value + b'\0')
+        elif code == 'v':
+            value_signature, value = value
+            dbus_wire_marshal(data, 'g', value_signature)
+            dbus_wire_marshal(data, value_signature, value)
+        elif code == 'a':
+            length_offset = len(data)
+            data.extend(b'\0\0\0\0')
+            dbus_wire_pad(data, DBUS_ALIGNMENT[signature[1]])
+            start = len(data)
+            items = value.items() if signature[1] == '{' else value
+            for item in items:
+                dbus_wire_marshal(data, signature[1:], item)
+            data[length_offset:length_offset + 4] = struct.pack('<I', len(data) - start)
+        elif code in '({':
+            for item_signature, item in zip(dbus_wire_split_signature(signature[1:-1]), value):
+                dbus_wire_marshal(data, item_signature, item)
         else:
-            app = which('gdbus')
+            raise ValueError('unsupported D-Bus type: {}'.format(signature))
+
+    # returns (value, new offset)
+    def dbus_wire_unmarshal(data, offset, signature, endian):
+        import struct
+        code = signature[0]
+        offset += -offset % DBUS_ALIGNMENT[code]
+        if code in DBUS_FIXED:
+            fmt = endian + DBUS_FIXED[code]
+            return struct.unpack_from(fmt, data, offset)[0], offset + struct.calcsize(fmt)
+        if code in 'sog':
+            fmt = endian + ('B' if code == 'g' else 'I')
+            length = struct.unpack_from(fmt, data, offset)[0]
+            offset += struct.calcsize(fmt)
+            return bytes(data[offset:offset + length]).decode('utf-8', 'replace'), offset + length + 1
+        if code == 'v':
+            value_signature, offset = dbus_wire_unmarshal(data, offset, 'g', endian)
+            return dbus_wire_unmarshal(data, offset, value_signature, endian)
+        if code == 'a':
+            length, offset = dbus_wire_unmarshal(data, offset, 'u', endian)
+            offset += -offset % DBUS_ALIGNMENT[signature[1]]
+            end = offset + length
+            items = []
+            while offset < end:
+                item, offset = dbus_wire_unmarshal(data, offset, signature[1:], endian)
+                items.append(item)
+            if signature[1] == '{':
+                return dict(items), offset
+            return items, offset
+        if code in '({':
+            items = []
+            for item_signature in dbus_wire_split_signature(signature[1:-1]):
+                item, offset = dbus_wire_unmarshal(data, offset, item_signature, endian)
+                items.append(item)
+            return tuple(items), offset
+        raise ValueError('unsupported D-Bus type: {}'.format(signature))
+
+    def dbus_wire_message(serial, destination, path, interface, member, signature, arguments):
+        import struct
+        body = bytearray()
+        for item_signature, item in zip(dbus_wire_split_signature(signature), arguments):
+            dbus_wire_marshal(body, item_signature, item)
+        # header fields: 1 path, 2 interface, 3 member, 6 destination, 8 signature
+        fields = [(1, ('o', path)), (3, ('s', member))]
+        if interface is not None:
+            fields.append((2, ('s', interface)))
+        if destination is not None:
+            fields.append((6, ('s', destination)))
+        if signature:
+            fields.append((8, ('g', signature)))
+        header = bytearray(b'l\x01\x00\x01')  # little endian, method call, no flags, protocol version 1
+        header.extend(struct.pack('<II', len(body), serial))
+        dbus_wire_marshal(header, 'a(yv)', fields)
+        dbus_wire_pad(header, 8)
+        return bytes(header + body)
+
+    def dbus_wire_recv_exactly(sock, length):
+        data = bytearray()
+        while len(data) < length:
+            chunk = sock.recv(length - len(data))
+            if not chunk:
+                raise IOError('D-Bus connection closed')
+            data.extend(chunk)
+        return data
+
+    # returns (message type, header fields, body values)
+    def dbus_wire_recv_message(sock):
+        import struct
+        data = dbus_wire_recv_exactly(sock, 16)
+        endian = '<' if data[0:1] == b'l' else '>'
+        body_length, _, fields_length = struct.unpack_from(endian + 'III', data, 4)
+        data.extend(dbus_wire_recv_exactly(sock, fields_length + (-fields_length % 8) + body_length))
+        fields, offset = dbus_wire_unmarshal(data, 12, 'a(yv)', endian)
+        fields = dict(fields)
+        offset += -offset % 8
+        body = []
+        if fields.get(8):
+            for item_signature in dbus_wire_split_signature(fields[8]):
+                item, offset = dbus_wire_unmarshal(data, offset, item_signature, endian)
+                body.append(item)
+        return data[1], fields, body
+
+    def dbus_wire_connect():
+        import socket
+        address = os.environ.get('DBUS_SESSION_BUS_ADDRESS')
+        if not address:
+            raise IOError('DBUS_SESSION_BUS_ADDRESS is not set')
+        last_error = None
+        for transport in address.split(';'):
+            if not transport.startswith('unix:'):
+                continue
+            options = dict([option.split('=', 1) for option in transport[5:].split(',') if '=' in option])
+            if 'path' in options:
+                socket_address = options['path']
+            elif 'abstract' in options:
+                socket_address = '\0' + options['abstract']
+            else:
+                continue
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.settimeout(DBUS_WIRE_TIMEOUT)
+                sock.connect(socket_address)
+                import binascii
+                sock.sendall(b'\0AUTH EXTERNAL ' + binascii.hexlify(str(os.getuid()).encode()) + b'\r\n')
+                reply = bytearray()
+                while not reply.endswith(b'\r\n'):
+                    chunk = sock.recv(256)
+                    if not chunk:
+                        raise IOError('D-Bus connection closed during authentication')
+                    reply.extend(chunk)
+                if not reply.startswith(b'OK '):
+                    raise IOError('D-Bus authentication failed: {}'.format(reply))
+                sock.sendall(b'BEGIN\r\n')
+                connection = {'socket': sock, 'serial': 0}
+                dbus_wire_call_on(connection, 'org.freedesktop.DBus', '/org/freedesktop/DBus', 'org.freedesktop.DBus', 'Hello')
+                return connection
+            except Exception as e:
+                log('D-Bus connect to {} failed', transport, e)
+                last_error = e
+                sock.close()
+        raise IOError('cannot connect to D-Bus session bus: {}'.format(last_error))
+
+    def dbus_wire_call_on(connection, destination, path, interface, member, signature='', arguments=()):
+        connection['serial'] += 1
+        serial = connection['serial']
+        connection['socket'].sendall(dbus_wire_message(serial, destination, path, interface, member, signature, arguments))
+        while True:
+            message_type, fields, body = dbus_wire_recv_message(connection['socket'])
+            # 2 method return, 3 error, field 5 is reply serial; signals are skipped
+            if message_type in (2, 3) and fields.get(5) == serial:
+                if message_type == 3:
+                    raise RuntimeError('D-Bus error {}: {}'.format(fields.get(4), body))
+                return body
+
+    # one shared session bus connection for tab title lookup and notifications
+    def dbus_wire_call(destination, path, interface, member, signature='', arguments=()):
+        with backend_internal['dbus_wire_lock']:
+            for attempt in range(2):
+                if backend_internal.get('dbus_wire') is None:
+                    backend_internal['dbus_wire'] = dbus_wire_connect()
+                try:
+                    return dbus_wire_call_on(backend_internal['dbus_wire'], destination, path, interface, member, signature, arguments)
+                except (IOError, OSError) as e:
+                    if attempt == 1:
+                        raise
+                    log('D-Bus connection lost, reconnect', e)
+                    backend_internal['dbus_wire']['socket'].close()
+                    backend_internal['dbus_wire'] = None
+
+    def call_dbus(service_name, path, method, *arg):
+        try:
+            signature = ''.join(['i' if a.startswith('int32:') else 's' for a in arg])
+            arguments = [int(a[6:]) if a.startswith('int32:') else a for a in arg]
+            output = dbus_wire_call(service_name, path, None, method, signature, arguments)
+            log('dbus wire output', output)
+            return str(output[0]) if output else ''
+        except Exception as e:
+            log('dbus wire call failed, use dbus tool', e)
+
+        tool = None
+        for tool in ['qdbus', 'gdbus', 'dbus-send']:
+            app = which(tool)
             if app is not None:
-                log('which gdbus: {}'.format(app))
+                log('which {}: {}', tool, app)
+                break
+        else:
+            log('cannot find dbus backend')
+            raise IOError('cannot find dbus tool')
 
-                xarg = []
-                for a in arg:
-                    if a.startswith('int32:'):
-                        xarg.append(a[6:])
-                    else:
-                        xarg.append(a)
-                tool_cmdline = [app, 'call', '--session', '--dest', service_name, '--object-path', path, '--method', '{}.{}'.format(service_name, method)]
-                tool_cmdline.extend(xarg)
-            else:
-                app = which('dbus-send')
-                if app is not None:
-                    log('which dbus-send: {}'.format(app))
-                    tool_cmdline = [app, '--session', '--print-reply=literal', '--dest={}'.format(service_name), path, '{}.{}'.format(service_name, method)]
-                    tool_cmdline.extend(xarg)
-                else:
-                    log('cannot find dbus backend')
+        xarg = [a[6:] if a.startswith('int32:') and tool != 'dbus-send' else a for a in arg]
+        if tool == 'qdbus':
+            tool_cmdline = [app, service_name, path, method]
+        elif tool == 'gdbus':
+            tool_cmdline = [app, 'call', '--session', '--dest', service_name, '--object-path', path, '--method', '{}.{}'.format(service_name, method)]
+        else:
+            tool_cmdline = [app, '--session', '--print-reply=literal', '--dest={}'.format(service_name), path, '{}.{}'.format(service_name, method)]
+        tool_cmdline.extend(xarg)
 
         log('dbus cmdline', tool_cmdline)
 
         output = process_exec(tool_cmdline).decode().strip()
         log('dbus backend output', output)
 
-        if app == which('gdbus'):
+        if tool == 'gdbus':
             output = output.strip('(),')
-        if app == which('dbus-send'):
+        if tool == 'dbus-send':
             if 'int32' in output:
                 output = output.split(' ')[1]
         log('dbus final output', output)
@@ -459,34 +874,165 @@ Examples:
         return output
 
 
-    def download_file(url, download_dir, output_filename):
+    DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+    # streamed to .part file and renamed when complete, <file>.sha256 is written next to it; returns sha256 or None
+    # file which does not match expected_sha256 is refused
+    def download_file(url, download_dir, output_filename, expected_sha256):
+        import hashlib
         import ssl
         ctx = ssl.create_default_context()
-        ctx.check_hostname = False
-        ctx.verify_mode = ssl.CERT_NONE
 
-        data = ''
+        response = None
         try:
             import urllib.request
-            request = urllib.request.urlopen(url, context=ctx)
-            data = request.read()
+            response = urllib.request.urlopen(url, context=ctx, timeout=30)
         except Exception as e:
             log('urllib for python3 failed', e)
             try:
                 import urllib
-                request = urllib.urlopen(url, context=ctx)
-                data = request.read()
+                response = urllib.urlopen(url, context=ctx)
             except Exception as e:
                 log('urllib for python2 failed', e)
-        if data == '':
+        if response is None:
             print_stdout('ERROR: Cannot download file: {}'.format(url))
-            return 1
+            return None
 
         downloaded_file = os.path.join(download_dir, output_filename)
-        with open(downloaded_file, 'wb') as f:
-            f.write(data)
+        part_file = downloaded_file + '.part'
+        sha = hashlib.sha256()
+        size = 0
+        try:
+            with open(part_file, 'wb') as f:
+                while True:
+                    chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    sha.update(chunk)
+                    size += len(chunk)
+            expected_size = response.info().get('Content-Length')
+            if expected_size is not None and int(expected_size) != size:
+                raise Exception('truncated download {} of {} bytes'.format(size, expected_size))
+            if sha.hexdigest() != expected_sha256:
+                raise Exception('checksum mismatch {}, expected {}'.format(sha.hexdigest(), expected_sha256))
+            if os.path.exists(downloaded_file):
+                os.remove(downloaded_file)
+            os.rename(part_file, downloaded_file)
+            with open(downloaded_file + '.sha256', 'w') as f:
+                f.write(sha.hexdigest())
+        except Exception as e:
+            log('download failed', url, e)
+            print_stdout('ERROR: Cannot download file: {}'.format(url))
+            try:
+                os.remove(part_file)
+            except OSError:
+                pass
+            return None
+        finally:
+            response.close()
+        log('downloaded', url, size, sha.hexdigest())
+        return sha.hexdigest()
+
+    # sha256 of file downloaded before, None if it is missing, incomplete or modified
+    def downloaded_file_sha(downloaded_file):
+        import hashlib
+        try:
+            with open(downloaded_file + '.sha256') as f:
+                expected = f.read().strip()
+            sha = hashlib.sha256()
+            with open(downloaded_file, 'rb') as f:
+                for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    sha.update(chunk)
+        except (IOError, OSError) as e:
+            log('no valid download', downloaded_file, e)
+            return None
+        if sha.hexdigest() != expected:
+            log('checksum mismatch', downloaded_file, sha.hexdigest(), expected)
+            return None
+        return expected
+
+    def read_json_file(path):
+        import json
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def write_json_file(path, data):
+        import json
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Windows: rename does not replace existing file
+            os.remove(path)
+            os.rename(tmp_path, path)
+
+    def read_proc_stat(pid):
+        # comm may contain spaces and ')' so split after the last ')'
+        with open('/proc/{}/stat'.format(pid), 'r') as f:
+            stat = f.read()
+        comm_end = stat.rindex(')')
+        fields = stat[comm_end + 2:].split()
+        return {
+            'comm': stat[stat.index('(') + 1:comm_end],
+            'state': fields[0],
+            'ppid': int(fields[1]),
+            'starttime': int(fields[19]),
+        }
+
+    import threading
+    backend_internal = {'dbus_wire_lock': threading.Lock()}
+
+    def profile_report():
+        if profile.get('cprofile') is not None:
+            try:
+                profile['cprofile'].disable()
+                profile['cprofile'].dump_stats(args.cprofile)
+            except Exception as e:
+                log('cannot save cProfile stats', e)
+        if not args.profile and args.profile_file is None:
+            return
+        import json
+        report = {
+            'version': VERSION,
+            'argv': argv,
+            'pid': os.getpid(),
+            'time': time.time(),
+            'total': monotonic() - profile['start'],
+            'phases': [{'phase': phase, 'seconds': seconds} for phase, seconds in profile['phases']],
+        }
+        try:
+            if args.profile_file is not None:
+                with open(args.profile_file, 'a') as f:
+                    f.write(json.dumps(report) + '\n')
+            if args.profile:
+                print(json.dumps(report, indent=2), file=sys.stderr)
+        except Exception as e:
+            log('cannot save profile report', e)
 
     def nf_cleanup():
+        profile_report()
+        if backend_internal.get('ssh_process') is not None:
+            try:
+                backend_internal['ssh_process'].kill()
+            except Exception as e:
+                log('cannot kill unused ssh process', e)
+        if backend_internal.get('ssh_client') is not None:
+            try:
+                backend_internal['ssh_client'].close()
+            except Exception as e:
+                log('cannot close ssh client', e)
+        if backend_internal.get('dbus_wire') is not None:
+            try:
+                backend_internal['dbus_wire']['socket'].close()
+            except Exception as e:
+                log('cannot close D-Bus connection', e)
         if logfile['handle'] is not None:
             try:
                 logfile['handle'].write('\n'.encode())
@@ -499,63 +1045,323 @@ Examples:
     if args.debug:
         tools_used_by_nf = ['python', 'python.exe', 'ssh', 'tmux', 'screen', 'dbus-send', 'cmd.exe', 'gdbus', 'notify-send', 'termux-notification']
         for tool in tools_used_by_nf:
-            log('tool {}: {}'.format(tool, which(tool)))
+            log('tool {}: {}', tool, which(tool))
 
     log('tool this python:', sys.executable)
 
-    if args.try_version:
-        if args.try_version == 'list':
-            url = 'https://api.github.com/repos/NIC-MichalLabedzki/nf/tags'
-        else:
-            url = 'https://github.com/NIC-MichalLabedzki/nf/raw/{}/nf.py'.format(args.try_version)
+    ############################################################################
+    # --try-version
+    ############################################################################
+    # fetched nf versions are stored by content in ~/.nfdir/versions/objects, refs.json maps tag/branch/commit to them
+    TRY_VERSION_DIR = os.path.join(nf_dir, 'versions')
+    TRY_VERSION_REFS_FILE = os.path.join(TRY_VERSION_DIR, 'refs.json')
+    TRY_VERSION_TAGS_FILE = os.path.join(TRY_VERSION_DIR, 'tags.json')
+    TRY_VERSION_TAGS_TTL = 3600
+    TRY_VERSION_TIMEOUT = 30
+
+    # returns (data, etag), data is None if not modified since etag
+    def http_get(url, etag=None):
+        try:
+            import urllib.request as urllib_request
+            import urllib.error as urllib_error
+        except ImportError:
+            import urllib2 as urllib_request
+            urllib_error = urllib_request
+        headers = {'User-Agent': 'nf/{}'.format(VERSION)}
+        if etag:
+            headers['If-None-Match'] = etag
+        try:
+            response = urllib_request.urlopen(urllib_request.Request(url, headers=headers), timeout=TRY_VERSION_TIMEOUT)
+        except urllib_error.HTTPError as e:
+            if e.code == 304:
+                log('not modified', url)
+                return None, etag
+            raise
+        try:
+            return response.read(), response.info().get('ETag')
+        finally:
+            response.close()
 
-        import ssl
-        ctx = ssl.create_default_context()
-        ctx.check_hostname = False
-        ctx.verify_mode = ssl.CERT_NONE
+    def try_version_list():
+        try:
+            cache = read_json_file(TRY_VERSION_TAGS_FILE)
+        except Exception as e:
+            log('no cached nf tags', e)
+            cache = None
+        if cache is not None and (args.offline or time.time() - cache['time'] < TRY_VERSION_TAGS_TTL):
+            log('cached nf tags')
+            return cache['tags']
+        if args.offline:
+            print_stdout('nf: ERROR: --offline and no cached list of nf versions', file=sys.stderr)
+            return None
+        try:
+            import json
+            data, etag = http_get('https://api.github.com/repos/NIC-MichalLabedzki/nf/tags', cache['etag'] if cache else None)
+            tags = cache['tags'] if data is None else [tag['name'] for tag in json.loads(data.decode())]
+            write_json_file(TRY_VERSION_TAGS_FILE, {'time': time.time(), 'etag': etag, 'tags': tags})
+            return tags
+        except Exception as e:
+            log('cannot download nf tags', e)
+            if cache is not None:
+                print_stdout('nf: WARNING: Cannot download list of nf versions, cached list is used', file=sys.stderr)
+                return cache['tags']
+        print_stdout('ERROR: Cannot download specified nf version for: {}'.format(args.try_version))
+        return None
+
+    def try_version_fetch(ref):
+        import hashlib
+        import re
+        try:
+            refs = read_json_file(TRY_VERSION_REFS_FILE)
+        except Exception as e:
+            log('no cached nf versions', e)
+            refs = {}
+        entry = refs.get(ref)
+        if entry is not None and not os.path.exists(os.path.join(TRY_VERSION_DIR, 'objects', 'nf_{}.py'.format(entry['sha256']))):
+            entry = None
+        # full commit hash never changes
+        if entry is not None and (args.offline or re.match('^[0-9a-f]{40}$', ref)):
+            log('cached nf version', ref, entry)
+            return entry['sha256']
+        if args.offline:
+            print_stdout('nf: ERROR: --offline and nf version {} is not cached'.format(ref), file=sys.stderr)
+            return None
 
-        data = ''
         try:
-            import urllib.request
-            request = urllib.request.urlopen(url, context=ctx)
-            data = request.read()
+            data, etag = http_get('https://github.com/NIC-MichalLabedzki/nf/raw/{}/nf.py'.format(ref), entry['etag'] if entry else None)
         except Exception as e:
-            log('urllib for python3 failed', e)
-            try:
-                import urllib
-                request = urllib.urlopen(url, context=ctx)
-                data = request.read()
-            except Exception as e:
-                log('urllib for python2 failed', e)
-        if data == '':
-            print_stdout('ERROR: Cannot download specified nf version for: {}'.format(args.try_version))
-            nf_cleanup()
-            return 1
+            log('cannot download nf version', ref, e)
+            if entry is not None:
+                print_stdout('nf: WARNING: Cannot check nf version {}, cached one is used'.format(ref), file=sys.stderr)
+                return entry['sha256']
+            print_stdout('ERROR: Cannot download specified nf version for: {}'.format(ref))
+            return None
+
+        if data is not None:
+            sha = hashlib.sha256(data).hexdigest()
+            path = os.path.join(TRY_VERSION_DIR, 'objects', 'nf_{}.py'.format(sha))
+            if not os.path.exists(path):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    pass
+                tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.rename(tmp_path, path)
+            entry = {'sha256': sha, 'etag': etag}
+        entry['time'] = time.time()
+        refs[ref] = entry
+        write_json_file(TRY_VERSION_REFS_FILE, refs)
+        return entry['sha256']
+
+    # imported, so bytecode is cached in __pycache__ and output of command is not buffered
+    def try_version_run(sha, new_argv):
+        objects_dir = os.path.join(TRY_VERSION_DIR, 'objects')
+        sys.path.insert(0, objects_dir)
+        try:
+            module = __import__('nf_{}'.format(sha))
+        finally:
+            sys.path.remove(objects_dir)
+        argv_backup = sys.argv
+        sys.argv = [module.__file__] + new_argv  # older versions read sys.argv, e.g. for --detach
+        try:
+            return module.nf(new_argv)
+        finally:
+            sys.argv = argv_backup
 
+    if args.try_version:
+        exit_code = 0
         if args.try_version == 'list':
-            import json
-            tags = json.loads(data.decode())
-            print_stdout(' '.join([tag['name'] for tag in tags]))
+            tags = try_version_list()
+            if tags is None:
+                exit_code = 1
+            else:
+                print_stdout(' '.join(tags))
         else:
-            import subprocess
             try_version_index = 0
-            for index, arg in enumerate(sys.argv[0:]):
+            for index, arg in enumerate(argv):
                 if arg.startswith('--try-version'):
                     try_version_index = index
                     if not arg.startswith('--try-version='):
                         try_version_index += 1
-            new_argv = sys.argv[try_version_index + 1:]
-            new_argv.insert(0, '-')
-            new_argv.insert(0, sys.executable)
-            log('run nf[{}] {}'.format(args.try_version, ' '.join(new_argv)))
-            python_process = subprocess.Popen(new_argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            output, stderr_output = python_process.communicate(data)
-            print_stdout(output.decode().rstrip('\n'))
-            print(stderr_output.decode(), file=sys.stderr)
+            new_argv = argv[try_version_index + 1:]
+            sha = try_version_fetch(args.try_version)
+            if sha is None:
+                exit_code = 1
+            else:
+                log('run nf[{}] {} {}', args.try_version, sha, ' '.join(new_argv))
+                exit_code = try_version_run(sha, new_argv)
 
         nf_cleanup()
+        return exit_code
+
+    ############################################################################
+    # history
+    ############################################################################
+    HISTORY_FILE = os.path.join(nf_dir, 'history.sqlite')
+    HISTORY_RETENTION_DAYS = 365
+    HISTORY_MAX_JOBS = 100000
+    HISTORY_COMPACT_EVERY = 100
+    # index is schema version - 1, see PRAGMA user_version
+    HISTORY_SCHEMA = [
+        [
+            'CREATE TABLE jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, cmdline TEXT, cwd TEXT, label TEXT, exit_code INTEGER, start REAL, end REAL, elapsed REAL, host TEXT, backend TEXT)',
+            'CREATE INDEX jobs_cwd ON jobs (cwd, start)',
+            'CREATE INDEX jobs_cmdline ON jobs (cmdline, start)',
+            'CREATE INDEX jobs_label ON jobs (label, start)',
+            'CREATE INDEX jobs_exit_code ON jobs (exit_code, start)',
+            'CREATE INDEX jobs_start ON jobs (start)',
+        ],
+        [
+            'ALTER TABLE jobs ADD COLUMN utime REAL',
+            'ALTER TABLE jobs ADD COLUMN stime REAL',
+            'ALTER TABLE jobs ADD COLUMN maxrss INTEGER',
+            'ALTER TABLE jobs ADD COLUMN inblock INTEGER',
+            'ALTER TABLE jobs ADD COLUMN oublock INTEGER',
+            'ALTER TABLE jobs ADD COLUMN nvcsw INTEGER',
+            'ALTER TABLE jobs ADD COLUMN nivcsw INTEGER',
+        ],
+    ]
+
+    def history_open():
+        import sqlite3
+        try:
+            os.makedirs(nf_dir)
+        except OSError:
+            pass
+        connection = sqlite3.connect(HISTORY_FILE, timeout=10)
+        version = connection.execute('PRAGMA user_version').fetchone()[0]
+        if version < len(HISTORY_SCHEMA):
+            with connection:
+                connection.execute('BEGIN IMMEDIATE')
+                # re-check under lock, other nf could migrate in the meantime
+                version = connection.execute('PRAGMA user_version').fetchone()[0]
+                for statements in HISTORY_SCHEMA[version:]:
+                    for statement in statements:
+                        connection.execute(statement)
+                connection.execute('PRAGMA user_version = {}'.format(len(HISTORY_SCHEMA)))
+        return connection
+
+    def history_save(job):
+        try:
+            connection = history_open()
+            try:
+                columns = sorted(job)
+                with connection:
+                    cursor = connection.execute('INSERT INTO jobs ({}) VALUES ({})'.format(', '.join(columns), ', '.join(['?'] * len(columns))), [job[column] for column in columns])
+                    job_id = cursor.lastrowid
+                    if job_id % HISTORY_COMPACT_EVERY == 0:
+                        connection.execute('DELETE FROM jobs WHERE start < ?', (time.time() - HISTORY_RETENTION_DAYS * 24 * 3600,))
+                        connection.execute('DELETE FROM jobs WHERE id <= ?', (job_id - HISTORY_MAX_JOBS,))
+                        log('history compacted')
+                log('history saved job id={}', job_id)
+            finally:
+                connection.close()
+        except Exception as e:
+            print_stdout('Cannot save job into history: {}'.format(HISTORY_FILE))
+            log('Cannot save job into history', e, level='ERROR')
+
+    # median elapsed time of last successful runs of the same command in the same directory
+    def history_expected_elapsed(cmdline, cwd, runs=10):
+        if not os.path.exists(HISTORY_FILE):
+            return None
+        try:
+            connection = history_open()
+            try:
+                rows = connection.execute('SELECT elapsed FROM jobs WHERE cmdline = ? AND cwd = ? AND exit_code = 0 AND elapsed IS NOT NULL ORDER BY start DESC LIMIT ?', (cmdline, cwd, runs)).fetchall()
+            finally:
+                connection.close()
+        except Exception as e:
+            log('Cannot read expected elapsed time from history', e)
+            return None
+        if not rows:
+            return None
+        elapsed = sorted([row[0] for row in rows])
+        return elapsed[len(elapsed) // 2]
+
+    def history_time(value):
+        for time_format in ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d']:
+            try:
+                return time.mktime(time.strptime(value, time_format))
+            except ValueError:
+                pass
+        raise argparse.ArgumentTypeError('invalid time: {}, use YYYY-MM-DD[ HH:MM[:SS]]'.format(value))
+
+    def history(history_argv):
+        history_parser = argparse.ArgumentParser(prog='nf history', description='Show jobs saved by "nf --save"')
+        history_parser.add_argument('--cwd', type=str, help='Jobs run in directory, "." for current one')
+        history_parser.add_argument('--command', type=str, help='Jobs which command line starts with text')
+        history_parser.add_argument('--label', type=str, help='Jobs with label')
+        history_parser.add_argument('--since', type=history_time, help='Jobs started since: YYYY-MM-DD[ HH:MM[:SS]]')
+        history_parser.add_argument('--until', type=history_time, help='Jobs started before: YYYY-MM-DD[ HH:MM[:SS]]')
+        history_parser.add_argument('--exit-code', type=int, help='Jobs finished with exit code')
+        history_parser.add_argument('--failed', action="store_true", help='Jobs finished with non zero exit code')
+        history_parser.add_argument('--limit', type=int, default=20, help='Show only latest LIMIT jobs, default 20')
+        history_parser.add_argument('--json', action="store_true", help='Print jobs as JSON lines')
+        history_args = history_parser.parse_args(history_argv)
+
+        where = []
+        params = []
+        if history_args.cwd is not None:
+            where.append('cwd = ?')
+            params.append(os.path.abspath(history_args.cwd))
+        if history_args.command is not None:
+            # range instead of LIKE, so index can be used
+            where.append('cmdline >= ? AND cmdline < ?')
+            params.extend([history_args.command, history_args.command + u'\U0010ffff'])
+        if history_args.label is not None:
+            where.append('label = ?')
+            params.append(history_args.label)
+        if history_args.since is not None:
+            where.append('start >= ?')
+            params.append(history_args.since)
+        if history_args.until is not None:
+            where.append('start < ?')
+            params.append(history_args.until)
+        if history_args.exit_code is not None:
+            where.append('exit_code = ?')
+            params.append(history_args.exit_code)
+        if history_args.failed:
+            where.append('exit_code != 0')
+
+        query = 'SELECT * FROM jobs'
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY start DESC LIMIT ?'
+        params.append(history_args.limit)
+        log('history query', query, params)
+
+        try:
+            connection = history_open()
+        except Exception as e:
+            print_stdout('nf: ERROR: Cannot open history: {}'.format(HISTORY_FILE), file=sys.stderr)
+            log('Cannot open history', e)
+            return 1
+        try:
+            cursor = connection.execute(query, params)
+            columns = [column[0] for column in cursor.description]
+            jobs = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        finally:
+            connection.close()
+
+        import json
+        for job in reversed(jobs):
+            if history_args.json:
+                print_stdout(json.dumps(job))
+            else:
+                start = datetime.datetime.fromtimestamp(job['start']).strftime("%Y-%m-%d %H:%M.%S")
+                elapsed = (datetime.datetime(1970, 1, 1, 0, 0, 0) + datetime.timedelta(seconds=job['elapsed'])).strftime("%H:%M.%S")
+                label = ' ({})'.format(job['label']) if job['label'] is not None else ''
+                usage = ' cpu {:.2f}s rss {:.1f}MiB'.format(job['utime'] + job['stime'], job['maxrss'] / 1024.0) if job['utime'] is not None else ''
+                print_stdout('{} {} [{:>3}] "{}$ {}"{}{}'.format(start, elapsed, job['exit_code'], job['cwd'], job['cmdline'], label, usage))
         return 0
 
+    if args.cmd == 'history':
+        exit_code = history(args.args)
+        nf_cleanup()
+        return exit_code
+
     try:
         import signal
 
@@ -567,298 +1373,1297 @@ Examples:
     except Exception as e:
         log('signal exception', e)
 
-    if args.backend is not None:
-        backend = args.backend
-    else:
-        backend = 'stdout'
-
-    if not args.no_notify:
-        if (backend in ['stdout', 'paramiko'] and args.backend == None) or args.backend == 'paramiko':
-            try:
+    def probe_paramiko(interactive=True):
+        if remote_source() is None:
+            return False
+        try:
+            pending = backend_internal.pop('paramiko_pending', None)
+            if pending is None:
                 ssh_ip, ssh_port = get_ssh()
 
-                if ssh_ip is not None and ssh_port is not None:
-                    import paramiko
-                    ssh_client = paramiko.SSHClient()
-                    ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                    try:
-                        ssh_client.load_system_host_keys()
-                    except Exception as e:
-                        log('backend={}'.format('paramiko'), e)
-                    try:
-                        ssh_client.connect(hostname=ssh_ip, port=ssh_port, timeout=2)
-                    except Exception as e:
-                        exc_info = sys.exc_info()
-                        log('traceback {line} backend={backend}'.format(line=exc_info[-1].tb_lineno, backend='paramiko'), e)
-                        import traceback
-                        traceback.print_exception(*exc_info)
-                        log('end ----')
-                        try:
-                            import getpass
-                            password = getpass.getpass()
-                            ssh_client.connect(hostname=ssh_ip, port=ssh_port, password=password, timeout=2)
-                            del password
-                        except Exception as e:
-                            log('backend={}'.format('paramiko'), e)
-                            backend = 'stdout'
-                else:
-                    if args.backend == 'paramiko':
+                if ssh_ip is None or ssh_port is None:
+                    if args.backend is not None and 'paramiko' in args.backend.split(','):
                         print_stdout('nf: WARNING: No $SSH_CLIENT, backend "paramiko" will not work')
-                    backend = 'stdout'
-            except Exception as e:
-                log('backend={}'.format('paramiko'), e)
-                backend = 'stdout'
+                    return False
+
+                import paramiko
+                ssh_client = paramiko.SSHClient()
+                ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                try:
+                    ssh_client.load_system_host_keys()
+                except Exception as e:
+                    log('backend={}', 'paramiko', e)
+                try:
+                    ssh_client.connect(hostname=ssh_ip, port=ssh_port, timeout=2)
+                    backend_internal['ssh_client'] = ssh_client
+                    return True
+                except Exception as e:
+                    exc_info = sys.exc_info()
+                    log('traceback {} backend={}', exc_info[-1].tb_lineno, 'paramiko', e)
+                    import traceback
+                    traceback.print_exception(*exc_info)
+                    log('end ----')
+                    if not interactive:
+                        backend_internal['paramiko_pending'] = (ssh_client, ssh_ip, ssh_port)
+                        return None
+            else:
+                ssh_client, ssh_ip, ssh_port = pending
 
-        if (backend in ['stdout', 'ssh'] and args.backend == None) or args.backend == 'ssh':
             try:
-                ssh_ip, ssh_port = get_ssh()
-                if ssh_ip is not None and ssh_port is not None:
-                    import subprocess
+                import getpass
+                password = getpass.getpass()
+                ssh_client.connect(hostname=ssh_ip, port=ssh_port, password=password, timeout=2)
+                del password
+                backend_internal['ssh_client'] = ssh_client
+                backend_internal['paramiko_password'] = True
+                return True
+            except Exception as e:
+                log('backend={}', 'paramiko', e)
+        except Exception as e:
+            log('backend={}', 'paramiko', e)
+        return False
+
+    # one ControlMaster connection per target in ~/.nfdir/ssh, notifications are multiplexed over it
+    SSH_CONTROL_PERSIST = 600
+
+    def ssh_control_path(ssh_ip, ssh_port):
+        import hashlib
+        # short name, unix socket path length is limited
+        return os.path.join(nf_dir, 'ssh', hashlib.sha1('{}:{}'.format(ssh_ip, ssh_port).encode()).hexdigest()[:16])
+
+    def ssh_call(cmdline, quiet=True):
+        import subprocess
+        log('ssh call', cmdline)
+        with open(os.devnull, 'r+b') as devnull:
+            options = {'stdin': devnull}
+            if quiet:
+                options.update({'stdout': devnull, 'stderr': devnull})
+            return subprocess.call(cmdline, **options)
+
+    def ssh_master_alive(ssh_ip, ssh_port, control_path):
+        if not os.path.exists(control_path):
+            return False
+        if ssh_call(['ssh', '-O', 'check', '-o', 'ControlPath={}'.format(control_path), '-p', ssh_port, ssh_ip]) == 0:
+            return True
+        # stale socket (master died), new master would run without multiplexing and stay in background
+        try:
+            os.unlink(control_path)
+        except OSError as e:
+            log('ssh stale control path', e)
+        return False
+
+    # -f: ssh goes to background after authentication, so exit code tells if it worked
+    def ssh_master_start(ssh_ip, ssh_port, control_path, password=False):
+        try:
+            os.makedirs(os.path.dirname(control_path), 0o700)
+        except OSError:
+            pass
+        cmdline = ['ssh', ssh_ip, '-p', ssh_port, '-f', '-N', '-o', 'ControlMaster=yes', '-o', 'ControlPath={}'.format(control_path), '-o', 'ControlPersist={}'.format(SSH_CONTROL_PERSIST), '-o', 'StrictHostKeyChecking=no', '-o', 'ConnectTimeout=2']
+        if password:
+            cmdline += ['-o', 'PreferredAuthentications=password', '-o', 'PubkeyAuthentication=no']
+        else:
+            cmdline += ['-o', 'BatchMode=yes', '-o', 'PreferredAuthentications=publickey', '-o', 'PubkeyAuthentication=yes']
+        return ssh_call(cmdline, quiet=not password) == 0
 
+    def probe_ssh(interactive=True):
+        if remote_source() is None:
+            return False
+        try:
+            ssh_ip, ssh_port = get_ssh()
+            if ssh_ip is not None and ssh_port is not None:
+                import subprocess
+
+                if sys.platform != 'win32':
+                    control_path = ssh_control_path(ssh_ip, ssh_port)
+                    master = ssh_master_alive(ssh_ip, ssh_port, control_path)
+                    log('ssh master alive', master)
+                    if not master and not backend_internal.pop('ssh_pending', False):
+                        master = ssh_master_start(ssh_ip, ssh_port, control_path)
+                    if not master:
+                        if not interactive:
+                            backend_internal['ssh_pending'] = True
+                            return None
+                        master = ssh_master_start(ssh_ip, ssh_port, control_path, password=True)
+                    if not master:
+                        return False
+                    backend_internal['ssh_process'] = subprocess.Popen(['ssh', ssh_ip, '-p', ssh_port, '-o', 'ControlMaster=no', '-o', 'ControlPath={}'.format(control_path), '-o', 'BatchMode=yes'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                    return True
+
+                # Windows OpenSSH has no ControlMaster
+                ssh_process = None
+                if not backend_internal.pop('ssh_pending', False):
                     try:
                         ssh_process = subprocess.Popen(["ssh", ssh_ip , '-p', ssh_port, '-o', 'StrictHostKeyChecking=no', '-o', 'ConnectTimeout=2', '-o', 'PreferredAuthentications=publickey', '-o', 'PubkeyAuthentication=yes'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
                         time.sleep(1)
                         if ssh_process.poll() != None:
                             raise Exception('Public key not working')
                     except Exception as e:
-                        log('backend={}'.format('ssh'), e)
-                        ssh_process = subprocess.Popen(["ssh", ssh_ip , '-p', ssh_port, '-o', 'ConnectTimeout=2', '-o', 'PreferredAuthentications=password', '-o', 'PubkeyAuthentication=no'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                        ssh_process.stdout.readline()  # expect password prompt
-                    if ssh_process.poll():
-                        backend = 'stdout'
-                    else:
-                        backend = 'ssh'
-                else:
-                    if args.backend == 'ssh':
-                        print_stdout('nf: WARNING: No $SSH_CLIENT, backend SSH will not work')
-                    backend = 'stdout'
-            except Exception as e:
-                log('backend={}'.format('ssh'), e)
-                backend = 'stdout'
+                        log('backend={}', 'ssh', e)
+                        ssh_process = None
+                        if not interactive:
+                            backend_internal['ssh_pending'] = True
+                            return None
+                if ssh_process is None:
+                    ssh_process = subprocess.Popen(["ssh", ssh_ip , '-p', ssh_port, '-o', 'ConnectTimeout=2', '-o', 'PreferredAuthentications=password', '-o', 'PubkeyAuthentication=no'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                    ssh_process.stdout.readline()  # expect password prompt
+                if ssh_process.poll():
+                    return False
+                backend_internal['ssh_process'] = ssh_process
+                return True
+            else:
+                if args.backend is not None and 'ssh' in args.backend.split(','):
+                    print_stdout('nf: WARNING: No $SSH_CLIENT, backend SSH will not work')
+        except Exception as e:
+            log('backend={}', 'ssh', e)
+        return False
+
+    WSL_PYTHON_VERSION = '3.8.2'
+    WSL_PYTHON_URL = 'https://www.python.org/ftp/python/{0}/python-{0}-embed-amd64.zip'.format(WSL_PYTHON_VERSION)
+    # from https://www.python.org/downloads/release/python-382/, download is refused until it is set
+    WSL_PYTHON_SHA256 = None
+    # bump when provisioned dependencies change, manifest name changes with it
+    WSL_PROVISION_VERSION = 1
+
+    def wsl_paths():
+        pip_target_dir = os.path.join(nf_dir, 'dependencies', '{}.{}.{}'.format(*sys.version_info[:3]), 'platform_unknown', 'pip')
+        win_module_dir = os.path.join(nf_dir_win_for_wsl, 'dependencies', WSL_PYTHON_VERSION, 'win_amd64', 'win10toast-persist')
+        return {
+            'manifest': os.path.join(nf_dir, 'wsl', 'manifest-{}-{}.json'.format(WSL_PROVISION_VERSION, WSL_PYTHON_VERSION)),
+            'pip_target_dir': pip_target_dir,
+            'pip_done': os.path.join(pip_target_dir, 'nf_done'),
+            'win_module_dir': win_module_dir,
+            'win_module_done': os.path.join(win_module_dir, 'nf_done'),
+            'download_dir': os.path.join(nf_dir, 'downloaded'),
+            'python_zip_dir': os.path.join(nf_dir, 'wsl', 'python', 'zip'),
+            'python_dir': os.path.join(nf_dir_win_for_wsl, 'wsl', 'python', WSL_PYTHON_VERSION),
+        }
+
+    def run_pip(cmdline_args, what, environ=None):
+        cmd_exit_code = 0
+        try:
+            import subprocess
+            p = subprocess.Popen(cmdline_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=environ)
+            output, stderr_output = p.communicate()
+            cmd_exit_code = p.returncode
+            log('install {} stdout\n', what, output.decode())
+            log('install {} stderr\n', what, stderr_output.decode())
+            log('install {} exit code', what, cmd_exit_code)
+        except Exception as e:
+            log('install {} failed for: <{}> exit code {}', what, cmdline_args, cmd_exit_code, e)
+            cmd_exit_code = cmd_exit_code or 1
+        return cmd_exit_code
+
+    def wsl_environ(paths, pip_done):
+        environ = os.environ.copy()
+        if pip_done:
+            if 'PYTHONPATH' not in environ:
+                environ['PYTHONPATH'] = os.path.abspath(paths['pip_target_dir'])
+            else:
+                environ['PYTHONPATH'] = os.path.abspath(paths['pip_target_dir']) + ':' + environ['PYTHONPATH']
+            import site;
+            site.addsitedir(os.path.abspath(paths['pip_target_dir']))
+        return environ
 
-        backend_internal = {}
+    def ensurepip_wheel():
+        import glob
+        try:
+            import ensurepip
+            wheels = glob.glob(os.path.join(os.path.dirname(ensurepip.__file__), '_bundled', 'pip-*.whl'))
+        except ImportError as e:  # e.g. removed by distribution
+            log('no ensurepip', e)
+            return None
+        return sorted(wheels)[-1] if wheels else None
 
-        if is_wsl or (args.backend == 'wsl' and is_wsl is not True):
-            python_exe = which('python.exe')
-            log('type python.exe before', python_exe)
+    # embedded Windows python is downloaded while pip steps run; manifest is written only if everything is ready
+    def wsl_provision(paths):
+        import threading
+        for directory in [paths['download_dir'], paths['python_zip_dir']]:
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
 
-            environ = os.environ.copy()
+        python_zip = os.path.join(paths['python_zip_dir'], 'python.zip')
+        download = {'sha': downloaded_file_sha(python_zip), 'fresh': False}
+        if download['sha'] != WSL_PYTHON_SHA256:
+            download['sha'] = None
+        def download_python():
+            download['sha'] = download_file(WSL_PYTHON_URL, paths['python_zip_dir'], 'python.zip', WSL_PYTHON_SHA256)
+            download['fresh'] = True
+        download_thread = None
+        if download['sha'] is None:
+            download_thread = threading.Thread(target=download_python)
+            download_thread.daemon = True
+            download_thread.start()
+
+        if not os.path.exists(paths['pip_done']):
+            if run_pip([sys.executable, '-m', 'pip', 'install', 'pip', '--target', paths['pip_target_dir']], 'pip') != 0:
+                # pip wheel bundled with python instead of unverified get-pip.py, wheel runs pip installing itself
+                pip_wheel = ensurepip_wheel()
+                if pip_wheel is not None:
+                    if run_pip([sys.executable, os.path.join(pip_wheel, 'pip'), 'install', '--no-index', pip_wheel, '--target', paths['pip_target_dir']], 'pip') == 0:
+                        os.mkdir(paths['pip_done'])
+            else:
+                os.mkdir(paths['pip_done'])
+            if not os.path.exists(paths['pip_done']):
+                print_stdout('ERROR: Cannot make notification under Windows - cannot download newer "pip"')
+        pip_done = os.path.exists(paths['pip_done'])
+
+        if not os.path.exists(paths['win_module_done']):
+            cmdline_args = [sys.executable, '-m', 'pip', 'install', 'win10toast-persist', '--platform', 'win_amd64', '--python-version', WSL_PYTHON_VERSION, '--only-binary=:all:', '--target', paths['win_module_dir']]
+            if run_pip(cmdline_args, 'win10toast-persist', wsl_environ(paths, pip_done)) == 0:
+                os.mkdir(paths['win_module_done'])
+            else:
+                print_stdout('ERROR: Cannot make notification under Windows - cannot download backend module - win10toast-persist')
 
-            nf_dependencies_dir = os.path.join(nf_dir, 'dependencies')
-            nf_current_deps_dir = os.path.join(nf_dependencies_dir, '{}.{}.{}'.format(sys.version_info.major, sys.version_info.minor, sys.version_info.micro), 'platform_unknown')
-            pip_target_dir = os.path.join(nf_current_deps_dir, 'pip')
-            nf_pip_done = os.path.join(pip_target_dir, 'nf_done')
-            if not os.path.exists(nf_pip_done):
-                cmd_exit_code = 0
-                try:
-                    cmdline_args = [sys.executable, '-m', 'pip', 'install', 'pip', '--target', pip_target_dir]
-                    import subprocess
-                    p = subprocess.Popen(cmdline_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                    output, stderr_output = p.communicate()
-                    cmd_exit_code = p.returncode
-                    log('install pip stdout\n', output.decode())
-                    log('install pip stderr\n', stderr_output.decode())
-                    log('install pip exit code', cmd_exit_code)
-                    if cmd_exit_code == 0:
-                        os.mkdir(nf_pip_done)
-                except Exception as e:
-                    log('download pip failed for: <{}> exit code {}'.format(cmdline_args, cmd_exit_code), e)
-                    print_stdout('ERROR: Cannot make notification under Windows - cannot download newer "pip"')
+        if download_thread is not None:
+            download_thread.join()
+        if download['sha'] is None:
+            return False
 
-            if not os.path.exists(nf_pip_done):
-                download_dir = os.path.join(nf_dir, 'downloaded')
-                import os
-                try:
-                    os.makedirs(download_dir)
-                except:
-                    pass
-                    # TODO
+        python_exe = os.path.join(paths['python_dir'], 'python.exe')
+        if download['fresh'] or not os.path.exists(python_exe):
+            # extract aside and rename, so interrupted unzip is never used
+            import shutil
+            import zipfile
+            tmp_dir = '{}.{}.tmp'.format(paths['python_dir'], os.getpid())
+            try:
+                with zipfile.ZipFile(python_zip, 'r') as file_zip:
+                    file_zip.extractall(tmp_dir)
+                if os.path.exists(paths['python_dir']):
+                    shutil.rmtree(paths['python_dir'])
+                os.rename(tmp_dir, paths['python_dir'])
+            except Exception as e:
+                log('cannot unzip custom python', e)
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                return False
+
+        if not pip_done or not os.path.exists(paths['win_module_done']):
+            return False
+        write_json_file(paths['manifest'], {
+            'version': WSL_PROVISION_VERSION,
+            'time': time.time(),
+            'python': {'version': WSL_PYTHON_VERSION, 'url': WSL_PYTHON_URL, 'sha256': download['sha'], 'dir': paths['python_dir']},
+            'pip': paths['pip_target_dir'],
+            'win10toast-persist': paths['win_module_dir'],
+        })
+        log('wsl dependencies provisioned', paths['manifest'])
+        return True
+
+    def probe_wsl():
+        if remote_source() is None:
+            return False
+        paths = wsl_paths()
+        # steady state: one stat
+        provisioned = os.path.exists(paths['manifest'])
+        if not provisioned:
+            provisioned = wsl_provision(paths)
+            log('wsl provisioning done', provisioned)
+        environ = wsl_environ(paths, provisioned or os.path.exists(paths['pip_done']))
+
+        new_python_dir = paths['python_dir']
+        os.environ["PATH"] = os.path.abspath(new_python_dir) + os.pathsep + os.environ["PATH"]
+        sys.path.insert(0, os.path.abspath(new_python_dir))
+
+        python_exe = os.path.join(new_python_dir, 'python.exe')
+        if sys.platform != 'win32' and is_wsl is not True: # NOTE: just for testing without Win
+            python_exe = 'python'
+        log('type python.exe after set ensure', python_exe)
+
+        backend_internal['python_exe'] = python_exe
+        backend_internal['environ'] = environ
+        return True
+
+    def probe_win10toast_persist():
+        try:
+# TODO: platform detect
+            module_win_path = os.path.join(nf_dir, 'dependencies', '{}.{}.{}'.format(sys.version_info.major, sys.version_info.minor, sys.version_info.micro), 'win_amd64', 'win10toast-persist')
+            if os.path.exists(module_win_path):
+                import site;
+                site.addsitedir(os.path.abspath(module_win_path))
 
-                downloaded_file = os.path.join(download_dir, 'get-pip.py')
-                if not os.path.exists(downloaded_file):
-                    download_file('https://bootstrap.pypa.io/get-pip.py', download_dir, 'get-pip.py')
+            module_win_path = os.path.join(nf_dir, 'dependencies', '3.8.2', 'win_amd64', 'win10toast-persist')
+            if os.path.exists(module_win_path):
+                import site;
+                site.addsitedir(os.path.abspath(module_win_path))
 
-                cmd_exit_code = 0
-                try:
-                    cmdline_args = [sys.executable, downloaded_file, 'pip', '--target', pip_target_dir]
-                    import subprocess
-                    p = subprocess.Popen(cmdline_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                    output, stderr_output = p.communicate()
-                    cmd_exit_code = p.returncode
-                    log('install pip stdout\n', output.decode())
-                    log('install pip stderr\n', stderr_output.decode())
-                    log('install pip exit code', cmd_exit_code)
-                    if cmd_exit_code == 0:
-                        os.mkdir(nf_pip_done)
-                except Exception as e:
-                    log('download pip failed for: <{}> exit code {}'.format(cmdline_args, cmd_exit_code), e)
-                    print_stdout('ERROR: Cannot make notification under Windows - cannot download newer "pip"')
-# TODO
+            import win10toast
+            return True
+        except Exception as e:
+            log('backend={}', 'win10toast-persist', e)
+        return False
 
-            if os.path.exists(nf_pip_done):
-                if 'PYTHONPATH' not in environ:
-                    environ['PYTHONPATH'] = os.path.abspath(pip_target_dir)
-                else:
-                    environ['PYTHONPATH'] = os.path.abspath(pip_target_dir) + ':' + environ['PYTHONPATH']
-                import site;
-                site.addsitedir(os.path.abspath(pip_target_dir))
+    def probe_win10toast():
+        try:
+            import win10toast
+            return True
+        except Exception as e:
+            log('backend={}', 'win10toast', e)
+        return False
 
-            nf_remote_deps_dir = os.path.join(nf_dir_win_for_wsl, 'dependencies', '3.8.2', 'win_amd64')
-            win_module_target_dir = os.path.join(nf_remote_deps_dir, 'win10toast-persist')
-            nf_win_module_done = os.path.join(win_module_target_dir, 'nf_done')
-            if not os.path.exists(win_module_target_dir):
-                cmd_exit_code = 0
-                try:
-                    cmdline_args = [sys.executable, '-m', 'pip', 'install', 'win10toast-persist', '--platform', 'win_amd64', '--python-version', '3.8.2', '--only-binary=:all:', '--target', win_module_target_dir]
-                    import subprocess
-                    p = subprocess.Popen(cmdline_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=environ)
-                    output, stderr_output = p.communicate()
-                    cmd_exit_code = p.returncode
-                    log('install win10toast-persist stdout\n', output.decode())
-                    log('install win10toast-persist stderr\n', stderr_output.decode())
-                    log('install win10toast-persist exit code', cmd_exit_code)
-                    if cmd_exit_code == 0:
-                        os.mkdir(nf_win_module_done)
-                except Exception as e:
-                    log('download win10toast-persist failed for: <{}> exit code {}'.format(cmdline_args, cmd_exit_code), e)
-                    print_stdout('ERROR: Cannot make notification under Windows - cannot download backend module - win10toast-persist')
+    def probe_dbus():
+        try:
+            import dbus
+
+            dbus_session = dbus.SessionBus()
+            if dbus_session is not None:
+                backend_internal['dbus_session'] = dbus_session
+                dbus_notification = dbus_session.get_object('org.freedesktop.Notifications', '/org/freedesktop/Notifications')
+                if dbus_notification is not None:
+                    backend_internal['dbus_notification'] = dbus_notification
+                    return True
+        except Exception as e:
+            log('backend={}', 'dbus', e)
 
-            download_dir = os.path.join(nf_dir, 'wsl', 'python', 'zip')
-            import os
-            try:
-                os.makedirs(download_dir)
-            except:
-                pass
-                # TODO
+        # no python-dbus, talk to session bus directly
+        try:
+            has_owner = dbus_wire_call('org.freedesktop.DBus', '/org/freedesktop/DBus', 'org.freedesktop.DBus', 'NameHasOwner', 's', ['org.freedesktop.Notifications'])[0]
+            if not has_owner:
+                dbus_wire_call('org.freedesktop.DBus', '/org/freedesktop/DBus', 'org.freedesktop.DBus', 'StartServiceByName', 'su', ['org.freedesktop.Notifications', 0])
+            return True
+        except Exception as e:
+            log('backend={} wire', 'dbus', e)
+        return False
 
-            new_python_dir = os.path.join(nf_dir_win_for_wsl, 'wsl', 'python', '3.8.2')
-            downloaded_file = os.path.join(download_dir, 'python.zip')
-            if not os.path.exists(downloaded_file):
-                download_file('https://www.python.org/ftp/python/3.8.2/python-3.8.2-embed-amd64.zip', download_dir, 'python.zip')
-                #download_file('https://www.python.org/ftp/python/3.8.2/python-3.8.2-embed-win32.zip', download_dir)
+    def probe_app(backend_name, app_name):
+        try:
+            app = which(app_name)
+            log('backend={}', backend_name, app)
+            if app is not None:
+                backend_internal['{}_app'.format(backend_name)] = app
+                return True
+        except Exception as e:
+            log('backend={}', backend_name, e)
+        return False
 
-                try:
-                    os.makedirs(new_python_dir)
-                except Exception as e:
-                    log('cannot create dirs', new_python_dir)
+    def probe_plyer():
+        try:
+            import plyer
+            backend_internal['plyer'] = plyer
+            return True
+        except Exception as e:
+            log('backend={}', 'plyer', e)
+        return False
+
+    backend_probes = {
+        'paramiko': probe_paramiko,
+        'ssh': probe_ssh,
+        'wsl': probe_wsl,
+        'win10toast-persist': probe_win10toast_persist,
+        'win10toast': probe_win10toast,
+        'dbus': probe_dbus,
+        'gdbus': lambda: probe_app('gdbus', 'gdbus'),
+        'notify-send': lambda: probe_app('notify-send', 'notify-send'),
+        'termux-notification': lambda: probe_app('termux-notification', 'termux-notification'),
+        'plyer': probe_plyer,
+        'plyer_toast': probe_plyer,
+        'stdout': lambda: True,
+    }
+
+    # order matters: first working backend wins
+    BACKENDS_PRIORITY = ['paramiko', 'ssh', 'wsl', 'win10toast-persist', 'win10toast', 'dbus', 'gdbus', 'notify-send', 'termux-notification', 'plyer']
+
+    def backend_candidates():
+        if args.backend is not None:
+            return [args.backend]
+        return backend_candidates_all()
+
+    def backend_candidates_all():
+        candidates = []
+        for candidate in BACKENDS_PRIORITY:
+            if candidate == 'wsl' and not is_wsl:
+                continue
+            if candidate in ['win10toast-persist', 'win10toast'] and sys.platform != 'win32':
+                continue
+            candidates.append(candidate)
+        return candidates
+
+    # probes which can ask user e.g. for password, they can be run in non-interactive mode
+    INTERACTIVE_PROBES = ['paramiko', 'ssh']
+    # seconds; None - no timeout, WSL provisioning must not be interrupted
+    PROBE_TIMEOUTS = {'paramiko': 5, 'ssh': 5, 'wsl': None}
+    PROBE_DEFAULT_TIMEOUT = 3
+    PROBE_DEADLINE = 10
+
+    def run_probe(candidate, interactive=True):
+        if candidate in INTERACTIVE_PROBES:
+            return backend_probes[candidate](interactive=interactive)
+        return backend_probes[candidate]()
+
+    # wait_all - results of all candidates, not only up to the first working one
+    def probe_backends_concurrently(candidates, wait_all=False):
+        import threading
+
+        probe_start = time.time()
+        results = {}
+
+        def probe(candidate):
+            result = run_probe(candidate, interactive=False)
+            results[candidate] = result
+            log('backend={} probe result={} time={:.3f}s', candidate, result, time.time() - probe_start)
+
+        threads = []
+        for candidate in candidates:
+            thread = threading.Thread(target=probe, args=(candidate,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        # wait in priority order, first success wins so there is no need to wait for the rest
+        waited = []
+        for candidate, thread in zip(candidates, threads):
+            timeout = PROBE_TIMEOUTS.get(candidate, PROBE_DEFAULT_TIMEOUT)
+            if timeout is None:
+                thread.join()
+            else:
+                thread.join(max(0, min(timeout, PROBE_DEADLINE) - (time.time() - probe_start)))
+            if candidate in results:
+                waited.append((candidate, results[candidate]))
+            else:
+                log('backend={} probe timeout after {:.3f}s', candidate, time.time() - probe_start)
+                waited.append((candidate, False))
+            if waited[-1][1] and not wait_all:
+                break
+        log('backends probe time={:.3f}s', time.time() - probe_start)
+        return waited
+
+    BACKEND_CACHE_FILE = os.path.join(nf_dir, 'backend_cache.json')
+    BACKEND_CACHE_SIZE = 16
+    # app paths found by which(), they are enough to deliver notification without probe
+    BACKEND_CACHE_PATHS = ['gdbus_app', 'notify-send_app', 'termux-notification_app']
+
+    def backend_fingerprint():
+        import hashlib
+        fingerprint = ['{}={}'.format(env, os.environ.get(env)) for env in ['SSH_CLIENT', 'TMUX', 'DISPLAY', 'DBUS_SESSION_BUS_ADDRESS', 'PATH']]
+        fingerprint.append(sys.platform)
+        return hashlib.sha1('\n'.join(fingerprint).encode()).hexdigest()
+
+    def load_backend_cache():
+        try:
+            return read_json_file(BACKEND_CACHE_FILE)
+        except Exception as e:
+            log('cannot read backend cache', e)
+        return {}
 
-            if not os.path.exists(os.path.join(new_python_dir, 'python.exe')):
-                try:
-                    import zipfile
-                    with zipfile.ZipFile(downloaded_file, 'r') as file_zip:
-                        file_zip.extractall(new_python_dir)
-                except Exception as e:
-                    log('cannot unzip custom python', e)
+    def save_backend_cache(backend):
+        try:
+            cache = load_backend_cache()
+            entry = {'backend': backend, 'time': time.time()}
+            entry.update([(key, backend_internal[key]) for key in BACKEND_CACHE_PATHS if key in backend_internal])
+            cache[backend_fingerprint()] = entry
+            for fingerprint in sorted(cache, key=lambda key: cache[key].get('time', 0))[:-BACKEND_CACHE_SIZE]:
+                del cache[fingerprint]
+            write_json_file(BACKEND_CACHE_FILE, cache)
+            log('backend cache saved', entry)
+        except Exception as e:
+            log('cannot save backend cache', e)
 
-            os.environ["PATH"] = os.path.abspath(new_python_dir) + os.pathsep + os.environ["PATH"]
-            sys.path.insert(0, os.path.abspath(new_python_dir))
+    def drop_backend_cache():
+        try:
+            cache = load_backend_cache()
+            if cache.pop(backend_fingerprint(), None) is not None:
+                write_json_file(BACKEND_CACHE_FILE, cache)
+                log('backend cache dropped')
+        except Exception as e:
+            log('cannot drop backend cache', e)
 
-            python_exe = which('python.exe')
-            log('type python.exe after set', python_exe)
-            python_exe = os.path.join(new_python_dir, 'python.exe')
-            #os.chmod(python_exe, 0o777)
-            log('type python.exe after set ensure', python_exe)
-            python_x = which('python')
-            log('type python after set', python_x)
+    def cached_backend(interactive=True):
+        entry = load_backend_cache().get(backend_fingerprint())
+        if entry is None:
+            return None
+        log('backend cache entry', entry)
+        backend = entry['backend']
+        paths = [key for key in BACKEND_CACHE_PATHS if key in entry]
+        if paths:
+            if all([os.path.exists(entry[key]) for key in paths]):
+                for key in paths:
+                    backend_internal[key] = entry[key]
+                return (backend, True)
+        else:
+            result = run_probe(backend, interactive)
+            if result is not False:
+                return (backend, result)
+        log('cached backend={} does not work anymore', backend)
+        drop_backend_cache()
+        return None
+
+    # returns ([(backend, probe result), ...] in priority order, is full probe), probe result None means it needs user interaction
+    def probe_backends(interactive=True, use_cache=True):
+        if use_cache and args.backend is None and not args.rescan_backends:
+            cached = cached_backend(interactive)
+            if cached is not None:
+                log('backend={} from cache', cached[0])
+                return ([cached], False)
+
+        candidates = backend_candidates()
+        if len(candidates) > 1:
+            return (probe_backends_concurrently(candidates), True)
+        return ([(candidate, run_probe(candidate, interactive)) for candidate in candidates], True)
+
+    def choose_backend(probed):
+        results, is_full_probe = probed
+        backend = None
+        for candidate, result in results:
+            if result is None:
+                log('backend={} needs user interaction', candidate)
+                result = run_probe(candidate, interactive=True)
+            if result:
+                log('backend={} probe success', candidate)
+                backend = candidate
+                break
+            log('backend={} probe failed', candidate)
+
+        if backend is None and not is_full_probe:
+            drop_backend_cache()
+            return choose_backend(probe_backends(use_cache=False))
+        if backend is None:
+            backend = 'stdout'
 
-            if sys.platform != 'win32' and is_wsl is not True: # NOTE: just for testing without Win
-                python_exe = 'python'
+        # stdout is not cached, so backend which appears later (e.g. after login to desktop) is found
+        if is_full_probe and args.backend is None and backend != 'stdout':
+            save_backend_cache(backend)
+        if backend == 'stdout' and args.backend != 'stdout':
+            print_stdout("nf: WARNING: Could not get backend, notification will not work", file=sys.stderr)
+        return backend
 
-            backend = 'wsl'
+    def fanout_requested():
+        return args.backend is not None and (',' in args.backend or args.backend == 'all-available')
 
-        if (sys.platform == 'win32' and backend in ['stdout', 'win10toast-persist'] and args.backend == None) or args.backend == 'win10toast-persist':
-            try:
-# TODO: platform detect
-                module_win_path = os.path.join(nf_dir, 'dependencies', '{}.{}.{}'.format(sys.version_info.major, sys.version_info.minor, sys.version_info.micro), 'win_amd64', 'win10toast-persist')
-                if os.path.exists(module_win_path):
-                    import site;
-                    site.addsitedir(os.path.abspath(module_win_path))
+    def select_backend():
+        if fanout_requested():
+            return select_fanout_backends()
+        return choose_backend(probe_backends())
 
-                module_win_path = os.path.join(nf_dir, 'dependencies', '3.8.2', 'win_amd64', 'win10toast-persist')
-                if os.path.exists(module_win_path):
-                    import site;
-                    site.addsitedir(os.path.abspath(module_win_path))
+    ############################################################################
+    # -b a,b,c / -b all-available: the same notification to many backends at once
+    ############################################################################
+    # seconds for one delivery, slow backend does not hold up others or nf exit
+    DELIVERY_TIMEOUTS = {'paramiko': 10, 'ssh': 10, 'wsl': 20}
+    DELIVERY_DEFAULT_TIMEOUT = 5
 
-                import win10toast
-                backend = 'win10toast-persist'
-            except Exception as e:
-                log('backend={}'.format('win10toast-persist'), e)
-                backend = 'stdout'
+    def select_fanout_backends():
+        if args.backend == 'all-available':
+            candidates = backend_candidates_all()
+        else:
+            candidates = args.backend.split(',')
+        results = probe_backends_concurrently(candidates, wait_all=True)
+        backends = []
+        for candidate, result in results:
+            if result is None:
+                log('backend={} needs user interaction', candidate)
+                result = run_probe(candidate, interactive=True)
+            log('backend={} probe {}', candidate, 'success' if result else 'failed')
+            if result:
+                backends.append(candidate)
+        if not backends:
+            print_stdout("nf: WARNING: Could not get backend, notification will not work", file=sys.stderr)
+            return 'stdout'
+        return ','.join(backends)
+
+    # returns comma separated backends which delivered notification, 'stdout' if none of them
+    def deliver_fanout(backends, notification):
+        import threading
+
+        delivery_start = time.time()
+        results = {}
+
+        def deliver(backend):
+            results[backend] = deliver_notification(backend, notification)
+            log('backend={} delivery={} time={:.3f}s', backend, results[backend] == backend, time.time() - delivery_start)
+
+        threads = []
+        for backend in backends:
+            thread = threading.Thread(target=deliver, args=(backend,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        delivered = []
+        for backend, thread in zip(backends, threads):
+            thread.join(max(0, DELIVERY_TIMEOUTS.get(backend, DELIVERY_DEFAULT_TIMEOUT) - (time.time() - delivery_start)))
+            if backend not in results:
+                log('backend={} delivery timeout after {:.3f}s', backend, time.time() - delivery_start, level='WARNING')
+            elif results[backend] == backend:
+                delivered.append(backend)
+        log('fanout delivery time={:.3f}s', time.time() - delivery_start)
+        return ','.join(delivered) if delivered else 'stdout'
 
-        if (sys.platform == 'win32' and backend in ['stdout', 'win10toast'] and args.backend == None) or args.backend == 'win10toast':
+    ############################################################################
+    # remote nf: content addressed copy in ~/.nfdir/cache, source is sent only if remote does not have it
+    ############################################################################
+    REMOTE_BOOTSTRAP = '\n'.join([
+        'import base64, json, os, sys, zlib',
+        'sha = sys.argv[1]',
+        'argv = json.loads(base64.b64decode(sys.argv[2]).decode("utf-8"))',
+        'cache_dir = os.path.join(os.path.expanduser("~"), ".nfdir", "cache")',
+        'path = os.path.join(cache_dir, "nf_" + sha + ".py")',
+        'if os.path.exists(path):',
+        '    sys.stdout.write("NF-BOOTSTRAP HIT\\n")',
+        '    sys.stdout.flush()',
+        'else:',
+        '    sys.stdout.write("NF-BOOTSTRAP MISS\\n")',
+        '    sys.stdout.flush()',
+        '    stdin = getattr(sys.stdin, "buffer", sys.stdin)',
+        '    size = int(stdin.readline())',
+        '    data = b""',
+        '    while len(data) < size:',
+        '        chunk = stdin.read(size - len(data))',
+        '        if not chunk:',
+        '            sys.exit("nf bootstrap: upload truncated")',
+        '        data += chunk',
+        '    data = zlib.decompress(data)',
+        '    import hashlib',
+        '    if hashlib.sha256(data).hexdigest() != sha:',
+        '        sys.exit("nf bootstrap: checksum mismatch")',
+        '    try:',
+        '        os.makedirs(cache_dir)',
+        '    except OSError:',
+        '        pass',
+        '    tmp_path = "{}.{}.tmp".format(path, os.getpid())',
+        '    with open(tmp_path, "wb") as f:',
+        '        f.write(data)',
+        '    os.rename(tmp_path, path)',
+        'sys.path.insert(0, cache_dir)',
+        'exit_code = __import__("nf_" + sha).nf(argv)',  # import, so compiled .pyc is cached too
+        'if exit_code == "detached":',
+        '    os._exit(0)',
+        'sys.exit(exit_code)',
+    ])
+
+    # None if nf cannot read its own source, then remote backends (ssh, paramiko, wsl) are not used
+    def remote_source():
+        if 'remote_source' not in backend_internal:
+            import hashlib
             try:
-                import win10toast
-                backend = 'win10toast'
+                with open(__file__, 'rb') as f:
+                    source = f.read()
             except Exception as e:
-                log('backend={}'.format('win10toast'), e)
-                backend = 'stdout'
-
-        if (backend in ['stdout', 'dbus'] and args.backend == None) or args.backend == 'dbus':
+                if nf_stored_code is None:
+                    log('cannot read own source and there is no stored code, remote nf is not available', e, level='WARNING')
+                    backend_internal['remote_source'] = None
+                    return None
+                log('cannot read own source, use stored code', e)
+                source = ('##\n' + nf_stored_code).encode('utf-8')
+            backend_internal['remote_source'] = {'source': source, 'sha': hashlib.sha256(source).hexdigest()}
+        return backend_internal['remote_source']
+
+    # python -c with base64 only, so it survives any remote shell quoting
+    def remote_bootstrap_argv(python, notification, extra_argv=[]):
+        import base64
+        import json
+        argv = []
+        if notification is not None:
+            argv = [
+                '--custom_notification_title={}'.format(notification['title']),
+                '--custom_notification_text={}'.format(notification['body']),
+                '--custom_notification_exit_code={}'.format(notification['exit_code']),
+                '--coalesce=0',  # already coalesced here, e.g. shared home with NF_COALESCE
+            ]
+        argv += extra_argv
+        code = base64.b64encode(REMOTE_BOOTSTRAP.encode()).decode()
+        return [python, '-c', 'import base64;exec(base64.b64decode("{}"))'.format(code), remote_source()['sha'], base64.b64encode(json.dumps(argv).encode('utf-8')).decode()]
+
+    # arguments have no single quotes (base64, hex), so quoting is simple for any remote shell
+    def remote_command_line(argv):
+        return ' '.join(["'{}'".format(arg) for arg in argv])
+
+    def remote_ssh_argv():
+        import shlex
+        argv = ['--env-unset=SSH_CLIENT', '--env-set-default=DISPLAY=:0']
+        if args.sub_nf_args:
+            argv.extend(shlex.split(args.sub_nf_args))
+        return argv
+
+    def remote_wsl_argv():
+        import shlex
+        return shlex.split(args.sub_nf_args) if args.sub_nf_args else []
+
+    def remote_upload():
+        import zlib
+        payload = zlib.compress(remote_source()['source'], 9)
+        return '{}\n'.format(len(payload)).encode() + payload
+
+    # lines before marker are e.g. from remote shell rc files
+    def remote_bootstrap_status(readline):
+        while True:
+            line = readline()
+            if not line:
+                return None
+            if not isinstance(line, bytes):
+                line = line.encode('utf-8')  # paramiko files are opened in text mode
+            if line.startswith(b'NF-BOOTSTRAP '):
+                return line.strip().split(b' ')[1].decode()
+
+    def readline_with_timeout(stream, timeout):
+        import threading
+        result = {'line': b''}
+        def read():
             try:
-                import dbus
-
-                dbus_session = dbus.SessionBus()
-                if dbus_session is not None:
-                    backend_internal['dbus_session'] = dbus_session
-                    dbus_notification = dbus_session.get_object('org.freedesktop.Notifications', '/org/freedesktop/Notifications')
-                    if dbus_notification is not None:
-                        backend_internal['dbus_notification'] = dbus_notification
-                        backend = 'dbus'
-                    else:
-                        backend = 'stdout'
-                else:
-                    backend = 'stdout'
+                result['line'] = stream.readline()
             except Exception as e:
-                log('backend={}'.format('dbus'), e)
-                backend = 'stdout'
+                log('readline failed', e)
+        thread = threading.Thread(target=read)
+        thread.daemon = True
+        thread.start()
+        thread.join(timeout)
+        return result['line']
+
+    # notification id returned by server, reused as replaces_id to update notification in place
+    def notification_replaces_id(notification):
+        return backend_internal.get('notification_ids', {}).get(notification.get('replaces'), 0)
+
+    def notification_id_store(notification, notification_id):
+        if notification.get('replaces') is None or notification_id is None:
+            return
+        notification_ids = backend_internal.setdefault('notification_ids', {})
+        if len(notification_ids) > 64:
+            notification_ids.clear()  # daemon serves many jobs
+        notification_ids[notification['replaces']] = int(notification_id)
+
+    def print_notification(notification, bell=True):
+        columns = 10
+        try:
+            import shutil
+            sizes = shutil.get_terminal_size()
+            columns = sizes.columns
+        except Exception as e:
+            log('Cannot get terminal size', e)
+
+        print_stdout('-' * columns)
+        print_stdout(notification['title'])
+        print_stdout(notification['body'])
+        print_stdout('-' * columns)
+        if bell:
+            print_stdout('\a')
+
+    def deliver_notification(backend, notification):
+        if ',' in backend:
+            return deliver_fanout(backend.split(','), notification)
+        notify__app_name = notification['app_name']
+        notify__app_icon = notification['app_icon']
+        notify__title = notification['title']
+        notify__body = notification['body']
+        notify__timeout = notification['timeout']
 
-        if (backend in ['stdout', 'gdbus'] and args.backend == None) or args.backend == 'gdbus':
+        try:
+            if backend == 'wsl':
+
+                nf_exit_code = 0
+                cmdline_args = None
+                try:
+                    # Windows python reads the same ~/.nfdir/cache, so nf is stored there before run
+                    cache_path = os.path.join(nf_dir_win_for_wsl, 'cache', 'nf_{}.py'.format(remote_source()['sha']))
+                    if not os.path.exists(cache_path):
+                        try:
+                            os.makedirs(os.path.dirname(cache_path))
+                        except OSError:
+                            pass
+                        tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+                        with open(tmp_path, 'wb') as f:
+                            f.write(remote_source()['source'])
+                        os.rename(tmp_path, cache_path)
+
+                    if wsl_helper_notify(notification):
+                        log('notification delivered by wsl helper')
+                        return backend
+
+                    cmdline_args = remote_bootstrap_argv(backend_internal['python_exe'], notification, remote_wsl_argv())
+
+                    log('run external python:', cmdline_args)
+                    import subprocess
+                    p = subprocess.Popen(cmdline_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=backend_internal['environ'])
+                    output, stderr_output  = p.communicate()
+                    if output.startswith(b'NF-BOOTSTRAP MISS'):
+                        log('Windows python does not see cached nf, send it')
+                        p = subprocess.Popen(cmdline_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=backend_internal['environ'])
+                        output, stderr_output  = p.communicate(remote_upload())
+                    output = output.split(b'\n', 1)[1] if output.startswith(b'NF-BOOTSTRAP ') else output
+                    o = output.decode()
+                    log('stdout external python', output)
+                    log('stderr external python', stderr_output)
+                    if o != '':
+                        print_stdout(o)
+                    # output is redirected on stdout
+                    if nf_exit_code != 0:
+                        log('run external python exit with error: <{}> exit code {}', cmdline_args, nf_exit_code)
+                except Exception as e:
+                    log('run external python failed for: <{}> exit code {}', cmdline_args, nf_exit_code, e)
+                    print_stdout('ERROR: Cannot run external python, last3 win step')
+                    return 'stdout'
+
+                log('wsl external python exit code ', nf_exit_code)
+            elif backend == 'dbus' and 'dbus_notification' not in backend_internal:
+                notification_id = dbus_wire_call('org.freedesktop.Notifications', '/org/freedesktop/Notifications', 'org.freedesktop.Notifications', 'Notify', 'susssasa{sv}i',
+                                                 [notify__app_name, notification_replaces_id(notification), notify__app_icon, notify__title, notify__body, [], {}, notify__timeout])[0]
+                notification_id_store(notification, notification_id)
+            elif backend == 'dbus':
+                import dbus
+                notify__replaces_id = dbus.UInt32(notification_replaces_id(notification))
+                notify__actions = dbus.Array(signature='s')
+                notify__hints = dbus.Dictionary(signature='sv')
+
+                try:
+                    notification_id = backend_internal['dbus_notification'].Notify(notify__app_name, notify__replaces_id, notify__app_icon, notify__title, notify__body, notify__actions, notify__hints, notify__timeout)
+                except Exception as e:
+                    log('dbus notify #1 fails', e)
+                    notify_interface = dbus.Interface(backend_internal['dbus_notification'], dbus_interface='org.freedesktop.Notifications')
+                    notification_id = notify_interface.Notify(notify__app_name, notify__replaces_id, notify__app_icon, notify__title, notify__body, notify__actions, notify__hints, notify__timeout)
+                notification_id_store(notification, notification_id)
+            elif backend == 'gdbus':
+                output = process_exec([backend_internal['gdbus_app'], 'call', '--session', '--dest', 'org.freedesktop.Notifications', '--object-path', '/org/freedesktop/Notifications', '--method', 'org.freedesktop.Notifications.Notify',
+                                  notify__app_name,
+                                  str(notification_replaces_id(notification)),
+                                  notify__app_icon,
+                                  notify__title,
+                                  notify__body,
+                                  "[]",
+                                  "{}",
+                                  str(notify__timeout)], check=True)
+                # output is like "(uint32 42,)"
+                import re
+                if isinstance(output, bytes):
+                    output = output.decode('utf-8', 'replace')
+                match = re.search(r'uint32 (\d+)', output or '')
+                notification_id_store(notification, match.group(1) if match else None)
+            elif backend == 'notify-send':
+                process_exec([backend_internal['notify-send_app'], notify__title, notify__body, '--expire-time', str(notify__timeout), '--icon', notify__app_icon, '--app-name', notify__app_name], check=True)
+            elif backend == 'termux-notification':
+                process_exec([backend_internal['termux-notification_app'], '--title', notify__title, '--content', notify__body, '--sound', '--vibrate', '500,100,200', '--action', '"am start com.termux/.app.TermuxActivity"'], check=True)
+            elif backend == 'win10toast-persist':
+                import win10toast
+                toaster = win10toast.ToastNotifier()
+                toaster.show_toast(notify__title, notify__body, duration=None)
+            elif backend == 'win10toast':
+                import win10toast
+                toaster = win10toast.ToastNotifier()
+                toaster.show_toast(notify__title, notify__body)
+            elif backend == 'plyer':
+                backend_internal['plyer'].notification.notify(title=notify__title, message=notify__body, app_name=notify__app_name, app_icon=notify__app_icon,timeout=notify__timeout)
+            elif backend == 'plyer_toast':
+                backend_internal['plyer'].notification.notify(title=notify__title, message=notify__body, app_name=notify__app_name, app_icon=notify__app_icon,timeout=notify__timeout, toast=True)
+            elif backend == 'ssh':
+                # ssh process is single use, next notification (e.g. from daemon) needs new one
+                if backend_internal.get('ssh_process') is None:
+                    probe_ssh()
+                ssh_process = backend_internal.get('ssh_process')
+                backend_internal['ssh_process'] = None
+                if ssh_process:
+# TODO: unbash ssh cmd: remove unset SSH_CLIENT)
+# TODO: detect DISPLAY=:0
+# ps -fC X
+# UID        PID  PPID  C STIME TTY          TIME CMD
+# xxxx yyy   zzz  eee fff ttyaaa         aa:aa:aa X :0
+# so CMD is X :0 <-= ":0"
+# TODO: detect DBUS_SESSION_BUS_ADDRESS if possible
+                    # remote login shell reads command from stdin
+                    try:
+                        ssh_process.stdin.write(remote_command_line(remote_bootstrap_argv('python', notification, remote_ssh_argv())).encode() + b'\n')
+                        ssh_process.stdin.flush()
+                        status = remote_bootstrap_status(lambda: readline_with_timeout(ssh_process.stdout, 5))
+                        log('remote nf cache', status)
+                        if status == 'MISS':
+                            ssh_process.stdin.write(remote_upload())
+                    except (IOError, OSError) as e:
+                        log('ssh closed connection', e)  # like communicate(), broken pipe is not an error here
+                    if sys.version_info >= (3, 3):
+                        output, stderr_output = ssh_process.communicate(timeout=5)
+                    else:
+                        output, stderr_output = ssh_process.communicate()
+                    log('stdout', output.decode())
+                    log('stderr', stderr_output.decode())
+            elif backend == 'paramiko':
+                ssh_client = backend_internal.get('ssh_client')
+                if ssh_client:
+                    stdin, output, stderr_output = ssh_client.exec_command(remote_command_line(remote_bootstrap_argv('python', notification, remote_ssh_argv())), timeout=5)
+                    status = remote_bootstrap_status(output.readline)
+                    log('remote nf cache', status)
+                    if status == 'MISS':
+                        stdin.write(remote_upload())
+                        stdin.flush()
+                    stdin.channel.shutdown_write()
+                    for name, stream in [('stdout', output), ('stderr', stderr_output)]:
+                        data = stream.read()
+                        log(name, data.decode() if isinstance(data, bytes) else data)
+        except Exception as e:
+            log('engine error, backend={}:', backend, e, level='ERROR')
+            exc_info = sys.exc_info()
+            log('traceback line: {} ; ', exc_info[-1].tb_lineno, e)
+            import traceback
+            traceback.print_exception(*exc_info)
+
+            if args.backend is None:
+                drop_backend_cache()
+            return 'stdout'
+        return backend
+
+    ############################################################################
+    # --daemon
+    ############################################################################
+    # session where notification shows up (ssh, X display, tmux, WSL distro), nf from other session does not share daemon or spool
+    def session_fingerprint():
+        import hashlib
+        fingerprint = ['{}={}'.format(env, os.environ.get(env)) for env in ['SSH_CLIENT', 'DISPLAY', 'TMUX', 'WSL_DISTRO_NAME', 'DBUS_SESSION_BUS_ADDRESS']]
+        return hashlib.sha1('\n'.join(fingerprint).encode()).hexdigest()[:12]
+
+    def daemon_socket_path():
+        import socket
+        return os.path.join(nf_dir, 'daemon', '{}-{}.sock'.format(socket.gethostname(), session_fingerprint()))
+
+    # address: None - local daemon unix socket, (host, port) - TCP, e.g. WSL helper
+    def daemon_send(request, timeout=10, address=None):
+        import json
+        import socket
+        client = socket.socket(socket.AF_UNIX if address is None else socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            client.settimeout(timeout)
+            client.connect(daemon_socket_path() if address is None else address)
+            client.sendall(json.dumps(request).encode() + b'\n')
+            data = b''
+            while not data.endswith(b'\n'):
+                chunk = client.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+        finally:
+            client.close()
+        return json.loads(data.decode())
+
+    # token - requests without it are ignored; idle_timeout - seconds without request to stop serving
+    # early_ack - notify request is acknowledged before delivery, otherwise reply tells backend which delivered it
+    def daemon_serve(server, daemon_backend, token=None, idle_timeout=None, early_ack=False):
+        import json
+        import socket
+
+        server.settimeout(idle_timeout)
+        while True:
+            try:
+                connection, _ = server.accept()
+            except socket.timeout:
+                log('daemon idle for {}s, stop', idle_timeout)
+                return
             try:
-                gdbus_app = which('gdbus')
-                log('backend={}'.format('gdbus'), gdbus_app)
-                if gdbus_app is not None:
-                    backend = 'gdbus'
+                connection.settimeout(10)
+                data = b''
+                while not data.endswith(b'\n'):
+                    chunk = connection.recv(65536)
+                    if not chunk:
+                        break
+                    data += chunk
+                request = json.loads(data.decode())
+                if token is not None and request.get('token') != token:
+                    log('daemon request with wrong token')
+                    continue
+                log('daemon request', request)
+
+                if request.get('request') == 'notify':
+                    if early_ack:
+                        # client which timed out would deliver notification once again
+                        connection.sendall(json.dumps({'status': 'accepted', 'backend': daemon_backend}).encode() + b'\n')
+                        connection.close()
+                    used_backend = deliver_notification(daemon_backend, request['notification'])
+                    if used_backend == 'stdout' and daemon_backend != 'stdout':
+                        log('daemon backend={} failed, select again', daemon_backend)
+                        daemon_backend = select_backend()
+                        used_backend = deliver_notification(daemon_backend, request['notification'])
+                    log('daemon delivered job {} with backend={}', request.get('job'), used_backend)
+                    if not early_ack:
+                        connection.sendall(json.dumps({'status': 'ok', 'backend': used_backend}).encode() + b'\n')
                 else:
-                    backend = 'stdout'
+                    connection.sendall(json.dumps({'status': 'ok', 'backend': daemon_backend}).encode() + b'\n')
             except Exception as e:
-                log('backend={}'.format('gdbus'), e)
-                backend = 'stdout'
+                log('daemon request failed', e)
+            finally:
+                connection.close()
 
-        if (backend in ['stdout', 'notify-send'] and args.backend == None) or args.backend == 'notify-send':
+    def run_daemon():
+        import socket
+        import signal
+
+        if not hasattr(socket, 'AF_UNIX'):
+            print_stdout('nf: ERROR: --daemon is not supported on {}'.format(sys.platform), file=sys.stderr)
+            return 1
+
+        socket_path = daemon_socket_path()
+        try:
+            os.makedirs(os.path.dirname(socket_path))
+        except OSError:
+            pass
+
+        try:
+            daemon_send({'request': 'ping'}, timeout=1)
+            print_stdout('nf: ERROR: nf daemon is already running: {}'.format(socket_path), file=sys.stderr)
+            return 1
+        except Exception as e:
+            log('daemon not running yet', e)
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+        def sigterm_handler(signum, frame):
+            raise KeyboardInterrupt()
+
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGTERM, sigterm_handler)
+
+        daemon_backend = select_backend()
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            server.bind(socket_path)
+        finally:
+            os.umask(old_umask)
+        server.listen(16)
+        log('daemon listen on {} with backend={}', socket_path, daemon_backend)
+
+        try:
+            daemon_serve(server, daemon_backend, early_ack=True)
+        except KeyboardInterrupt:
+            log('daemon stopped')
+        finally:
+            server.close()
             try:
-                notify_send_app = which('notify-send')
-                log('backend={}'.format('notify-send'), notify_send_app)
-                if notify_send_app is not None:
-                    backend = 'notify-send'
-                else:
-                    backend = 'stdout'
+                os.remove(socket_path)
             except Exception as e:
-                log('backend={}'.format('notify-send'), e)
-                backend = 'stdout'
+                log('cannot remove daemon socket', e)
+        return 0
+
+    ############################################################################
+    # --wsl-helper
+    ############################################################################
+    WSL_HELPER_IDLE_TIMEOUT = 3600
+    WSL_HELPER_START_TIMEOUT = 15
+
+    # helper writes it in its (Windows) nf_dir, WSL side reads it through nf_dir_win_for_wsl
+    def wsl_helper_info_path(directory):
+        return os.path.join(directory, 'wsl', 'helper.json')
 
-        if (backend in ['stdout', 'termux-notification'] and args.backend == None) or args.backend == 'termux-notification':
+    def wsl_helper_info_read():
+        import json
+        try:
+            with open(wsl_helper_info_path(nf_dir_win_for_wsl)) as f:
+                return json.load(f)
+        except Exception as e:
+            log('no wsl helper info', e)
+        return None
+
+    def wsl_helper_info_write(directory, info):
+        write_json_file(wsl_helper_info_path(directory), info)
+
+    def run_wsl_helper():
+        import binascii
+        import socket
+
+        if remote_source() is None:
+            print_stdout('nf: ERROR: --wsl-helper needs nf source', file=sys.stderr)
+            return 1
+        info = None
+        try:
+            with open(wsl_helper_info_path(nf_dir)) as f:
+                import json
+                info = json.load(f)
+            if info.get('sha') != remote_source()['sha']:
+                raise Exception('wsl helper runs other nf version')
+            daemon_send({'request': 'ping', 'token': info['token']}, timeout=1, address=('127.0.0.1', info['port']))
+            log('wsl helper is already running', info)
+            return 0
+        except Exception as e:
+            log('wsl helper not running yet', e)
+
+        daemon_backend = select_backend()
+
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(16)
+        info = {'port': server.getsockname()[1], 'token': binascii.hexlify(os.urandom(16)).decode(), 'pid': os.getpid(), 'sha': remote_source()['sha']}
+        wsl_helper_info_write(nf_dir, info)
+        log('wsl helper listen on {} with backend={}', info['port'], daemon_backend)
+
+        try:
+            daemon_serve(server, daemon_backend, token=info['token'], idle_timeout=WSL_HELPER_IDLE_TIMEOUT)
+        except KeyboardInterrupt:
+            log('wsl helper stopped')
+        finally:
+            server.close()
             try:
-                termux_notification_app = which('termux-notification')
-                if termux_notification_app is not None:
-                    backend = 'termux-notification'
-                else:
-                    backend = 'stdout'
+                with open(wsl_helper_info_path(nf_dir)) as f:
+                    import json
+                    if json.load(f)['token'] == info['token']:
+                        os.remove(wsl_helper_info_path(nf_dir))
             except Exception as e:
-                log('backend={}'.format('termux-notification'), e)
-                backend = 'stdout'
+                log('cannot remove wsl helper info', e)
+        return 0
 
-        if (backend in ['stdout', 'plyer', 'plyer_toast'] and args.backend == None) or args.backend == 'plyer' or args.backend == 'plyer_toast':
+    def wsl_helper_spawn(old_info):
+        import subprocess
+        cmdline_args = remote_bootstrap_argv(backend_internal['python_exe'], None, ['--wsl-helper'] + remote_wsl_argv())
+        log('start wsl helper', cmdline_args)
+        options = {}
+        if hasattr(os, 'setsid'):
+            options['preexec_fn'] = os.setsid  # survive terminal close
+        with open(os.devnull, 'r+b') as devnull:
+            subprocess.Popen(cmdline_args, stdin=devnull, stdout=devnull, stderr=devnull, env=backend_internal['environ'], close_fds=True, **options)
+
+        deadline = time.time() + WSL_HELPER_START_TIMEOUT
+        while time.time() < deadline:
+            info = wsl_helper_info_read()
+            if info is not None and (old_info is None or info.get('token') != old_info.get('token')):
+                return info
+            time.sleep(0.05)
+        return None
+
+    # True - helper delivered notification, False - use one-shot Windows python
+    def wsl_helper_notify(notification):
+        info = wsl_helper_info_read()
+        if info is not None and info.get('unreachable'):
+            log('wsl helper is not reachable from WSL, skip it')
+            return False
+        if info is not None and info.get('sha') != remote_source()['sha']:
+            log('wsl helper runs other nf version')
+            info = {'token': info.get('token')}
+        spawned = False
+        while True:
+            if info is None or 'port' not in info:
+                info = wsl_helper_spawn(info)
+                spawned = True
+                if info is None:
+                    log('wsl helper did not start')
+                    return False
             try:
-                import plyer
-                if args.backend == 'plyer' or args.backend == 'plyer_toast':
-                    backend = args.backend
+                response = daemon_send({'request': 'notify', 'notification': notification, 'token': info['token']}, address=('127.0.0.1', info['port']))
+                log('wsl helper response', response)
+                return response.get('backend') != 'stdout'
             except Exception as e:
-                log('backend={}'.format('plyer'), e)
-                backend = 'stdout'
+                log('wsl helper failed', e)
+            if spawned:
+                break
+            info = {'token': info['token']}  # respawn
+        # e.g. WSL2 without localhost forwarding
+        info['unreachable'] = True
+        try:
+            wsl_helper_info_write(nf_dir_win_for_wsl, info)
+        except Exception as e:
+            log('cannot mark wsl helper unreachable', e)
+        return False
 
-        if backend == 'stdout' and args.backend != 'stdout':
-            print_stdout("nf: WARNING: Could not get backend, notification will not work", file=sys.stderr)
-    log('choosen backend is {}'.format(backend))
+    ############################################################################
+    # --coalesce
+    ############################################################################
+    # each finishing nf drops one record, one nf (holding the lock) waits the window and sends a digest for all of them
+    SPOOL_DIR = os.path.join(nf_dir, 'spool', session_fingerprint())
+    SPOOL_DIGEST_MAX_FAILURES = 10
+
+    def spool_put(record):
+        import binascii
+        import json
+        try:
+            os.makedirs(SPOOL_DIR)
+        except OSError:
+            pass
+        name = '{:.6f}-{}-{}'.format(time.time(), os.getpid(), binascii.hexlify(os.urandom(4)).decode())
+        tmp_path = os.path.join(SPOOL_DIR, name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(record, f)
+        os.rename(tmp_path, os.path.join(SPOOL_DIR, name + '.json'))
+
+    def spool_pending():
+        import glob
+        return sorted(glob.glob(os.path.join(SPOOL_DIR, '*.json')))
+
+    def spool_take():
+        import json
+        records = []
+        for path in spool_pending():
+            try:
+                with open(path) as f:
+                    records.append(json.load(f))
+            except Exception as e:
+                log('broken spool record', path, e)
+            try:
+                os.remove(path)
+            except OSError as e:
+                log('cannot remove spool record', path, e)
+        return records
+
+    def spool_digest(records):
+        if len(records) == 1:
+            return records[0]['notification']
+        failed = [record for record in records if record['notification']['exit_code'] != 0]
+        lines = ['{}: exit code {}'.format(record['job'], record['notification']['exit_code']) for record in failed[:SPOOL_DIGEST_MAX_FAILURES]]
+        if len(failed) > SPOOL_DIGEST_MAX_FAILURES:
+            lines.append('... and {} more'.format(len(failed) - SPOOL_DIGEST_MAX_FAILURES))
+        if not failed:
+            lines.append('All jobs finished work.')
+        lines.append('Timestamp: ' + str(time.time()))
+        return {
+            'app_name': 'nf',
+            'app_icon': 'process-stop' if failed else 'services',
+            'title': '{} jobs finished, {} failed'.format(len(records), len(failed)),
+            'body': '\n'.join(lines),
+            'timeout': 0,
+            'exit_code': failed[0]['notification']['exit_code'] if failed else 0,
+        }
+
+    # returns backend used for digest, 'spool' if other nf sends it
+    def spool_flush(backend, deliver, window):
+        import fcntl
+        used_backend = 'spool'
+        with open(os.path.join(SPOOL_DIR, 'lock'), 'a') as lock_file:
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    log('other nf sends spooled notifications')
+                    return used_backend
+                try:
+                    time.sleep(window)
+                    records = spool_take()
+                    log('spooled notifications', len(records))
+                    if records:
+                        digest = spool_digest(records)
+                        used_backend = deliver(backend, digest)
+                        if used_backend == 'stdout' and len(records) > 1:
+                            print_notification(digest, bell=True)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+                # record dropped while this nf was holding the lock
+                if not spool_pending():
+                    return used_backend
+
+    if args.provision:
+        paths = wsl_paths()
+        if os.path.exists(paths['manifest']):
+            print_stdout('nf: WSL backend dependencies are already provisioned: {}'.format(paths['manifest']))
+            exit_code = 0
+        elif wsl_provision(paths):
+            print_stdout('nf: WSL backend dependencies provisioned: {}'.format(paths['manifest']))
+            exit_code = 0
+        else:
+            print_stdout('nf: ERROR: WSL backend dependencies provisioning failed', file=sys.stderr)
+            exit_code = 1
+        nf_cleanup()
+        return exit_code
+
+    if args.wsl_helper:
+        exit_code = run_wsl_helper()
+        nf_cleanup()
+        return exit_code
+
+    if args.daemon:
+        exit_code = run_daemon()
+        nf_cleanup()
+        return exit_code
+
+    backend = 'stdout'
+    backend_context = {'probed': None, 'thread': None}
+    if not args.no_notify:
+        if args.backend is None and os.path.exists(daemon_socket_path()):
+            backend = 'daemon'
+        elif args.defer_backend and not fanout_requested():
+            backend = 'deferred'
+        else:
+            backend = select_backend()
+    log('choosen backend is {}', backend)
+    profile_mark('backend')
 
     cmd = None
     if args.cmd is None:
@@ -879,6 +2684,7 @@ Examples:
         notify__title += ' (' + args.label + ')'
 
     time_start = datetime.datetime.now()
+    time_start_epoch = time.time()
 
     import shlex
     import subprocess
@@ -890,31 +2696,55 @@ Examples:
     shell_cmdline = None
     exit_code = 0
 
-    parent_names = []
-    try:
-        import psutil
-
-        process_info = psutil.Process(os.getpid())
-        ppid = process_info.ppid()
-        parents = process_info.parents()
-        parent_names = [parent.name() for parent in parents]
-
-        if 'tmux: server' in parent_names:
-            tmux_cmdline = ['tmux', 'display-message', '-p', '"#{client_pid}"']
-            multiplexer_client_pid = int(process_exec(tmux_cmdline).decode().strip('"\n'))
-            log('tmux multiplexer_client_pid {}'.format(multiplexer_client_pid))
-            tmux_process_info = psutil.Process(multiplexer_client_pid)
-            tmux_parents = tmux_process_info.parents()
-            parent_names.extend([parent.name() for parent in tmux_parents])
-        parent_process_info = psutil.Process(ppid)
-        parent_process_info_exe = parent_process_info.exe()
-        parent_process_info_cmdline = parent_process_info.cmdline()
-    except Exception as e:
-        log('psutil failed'.format(backend), e)
-        parents = []
-        parent_process_info_exe = ''
-        parent_process_info_cmdline = ['']
+    # ancestors of nf: terminal application and multiplexer are detected by their names
+    PARENTS_STOP_NAMES = ['konsole', 'yakuake', 'sshd', 'tmux: server']
+    PARENTS_CACHE_FILE = os.path.join(nf_dir, 'parents.json')
+    PARENTS_CACHE_SIZE = 64
+
+    # one /proc/<pid>/stat read per ancestor, stops where nothing above matters
+    def proc_ancestry(pid):
+        names = []
+        while pid > 1:
+            stat = read_proc_stat(pid)
+            names.append(stat['comm'])
+            if stat['comm'] in PARENTS_STOP_NAMES:
+                break
+            pid = stat['ppid']
+        return names
+
+    # ancestry of shell does not change during its life, so it is cached by shell pid and start time
+    def proc_parent_names(ppid):
+        key = '{}:{}'.format(ppid, read_proc_stat(ppid)['starttime'])
+        try:
+            cache = read_json_file(PARENTS_CACHE_FILE)
+        except Exception:
+            cache = {}
+        names = cache.get(key)
+        if names is not None:
+            log('cached parents', names)
+        else:
+            names = proc_ancestry(ppid)
+            cache[key] = names
+            for old_key in list(cache)[:-PARENTS_CACHE_SIZE]:
+                del cache[old_key]
+            try:
+                write_json_file(PARENTS_CACHE_FILE, cache)
+            except Exception as e:
+                log('cannot write parents cache', e)
+
+        # tmux client can change (detach, attach from other terminal), so it is not in parents cache, only in short tmux context cache
+        if names and names[-1] == 'tmux: server':
+            multiplexer_client_pid = (tmux_context() or {}).get('client_pid')
+            log('tmux multiplexer_client_pid {}', multiplexer_client_pid)
+            if multiplexer_client_pid is not None:
+                names = names + proc_ancestry(read_proc_stat(multiplexer_client_pid)['ppid'])
+        return names
 
+    parent_names = []
+    parent_process_info_exe = ''
+    parent_process_info_cmdline = ['']
+    # psutil import is slow, use it only if already imported or there is no /proc
+    if sys.modules.get('psutil') is None and os.path.isdir('/proc'):
         try:
             ppid = os.getppid()
             parent_process_info_exe = os.readlink('/proc/{}/exe'.format(ppid))
@@ -924,173 +2754,168 @@ Examples:
                 parent_process_info_cmdline = f.read()[0:-1].split('\0')
                 log('cmdline', parent_process_info_cmdline)
 
-            pid = ppid
-            while pid != 1:
-                pid_exe = os.readlink('/proc/{}/exe'.format(pid))
-                parent_name = os.path.basename(pid_exe)
-                if 'tmux: server' == parent_name:
-                    multiplexer_client_pid = int(process_exec(['tmux', 'display-message', '-p', '"#{client_pid}"']).decode().strip('"\n'))
-                    log('tmux multiplexer_client_pid {}'.format(multiplexer_client_pid))
-                    pid = multiplexer_client_pid
-                parent_names.append(parent_name)
-                with open('/proc/{}/stat'.format(pid)) as f:
-                    other_process_info_stat = f.read().split(' ')
-                    pid = int(other_process_info_stat[3])
+            parent_names = proc_parent_names(ppid)
         except Exception as e:
-            log('usinng /proc failed'.format(backend), e)
+            log('usinng /proc failed', e)
+    else:
+        try:
+            import psutil
 
-    # GUI: yakuake, konsole
-    try:
-        log('shell parents', parent_names)
-        konsole_app_index = parent_names.index('konsole') if 'konsole' in parent_names else None
-        yakuake_app_index = parent_names.index('yakuake') if 'yakuake' in parent_names else None
-        log('detect konsole {} yakuake {}'.format(konsole_app_index, yakuake_app_index))
-        if yakuake_app_index is not None and konsole_app_index is not None:
-            if konsole_app_index < yakuake_app_index:
-                gui_app = 'konsole'
-            elif konsole_app_index > yakuake_app_index:
-                gui_app = 'yakuake'
-        elif konsole_app_index is not None:
-            gui_app = 'konsole'
-        elif yakuake_app_index is not None:
-            gui_app ='yakuake'
-        elif 'KONSOLE_VERSION' in os.environ:
-            gui_app = 'konsole'
-        else:
-             gui_app = 'unknown'
-        log('gui_app {}'.format(gui_app))
+            process_info = psutil.Process(os.getpid())
+            ppid = process_info.ppid()
+            parents = process_info.parents()
+            parent_names = [parent.name() for parent in parents]
+
+            if 'tmux: server' in parent_names:
+                multiplexer_client_pid = (tmux_context() or {}).get('client_pid')
+                log('tmux multiplexer_client_pid {}', multiplexer_client_pid)
+                if multiplexer_client_pid is not None:
+                    tmux_process_info = psutil.Process(multiplexer_client_pid)
+                    tmux_parents = tmux_process_info.parents()
+                    parent_names.extend([parent.name() for parent in tmux_parents])
+            parent_process_info = psutil.Process(ppid)
+            parent_process_info_exe = parent_process_info.exe()
+            parent_process_info_cmdline = parent_process_info.cmdline()
+        except Exception as e:
+            log('psutil failed', e)
 
-        gui_app_tab_name = None
-        if gui_app == 'yakuake':
-            # SESSION_ID=$(qdbus org.kde.yakuake /yakuake/sessions activeSessionId)
-            # qdbus org.kde.yakuake /yakuake/tabs tabTitle ${SESSION_ID}
-            try:
-                import dbus
-                gui_app_dbus_session = dbus.SessionBus()
-                if gui_app_dbus_session is not None:
-                    dbus_object = gui_app_dbus_session.get_object('org.kde.yakuake', '/yakuake/sessions')
-                    if dbus_object is not None:
-                        session_id = dbus_object.activeSessionId()
-                        dbus_object = gui_app_dbus_session.get_object('org.kde.yakuake', '/yakuake/tabs')
-                        gui_app_tab_name = dbus_object.tabTitle(session_id)
-            except Exception as e:
-                log('yakuake get tab name exception1'.format(backend), e)
+    def detect_console_names():
+        detection_start = monotonic()
+        # GUI: yakuake, konsole
+        try:
+            log('shell parents', parent_names)
+            konsole_app_index = parent_names.index('konsole') if 'konsole' in parent_names else None
+            yakuake_app_index = parent_names.index('yakuake') if 'yakuake' in parent_names else None
+            log('detect konsole {} yakuake {}', konsole_app_index, yakuake_app_index)
+            if yakuake_app_index is not None and konsole_app_index is not None:
+                if konsole_app_index < yakuake_app_index:
+                    gui_app = 'konsole'
+                elif konsole_app_index > yakuake_app_index:
+                    gui_app = 'yakuake'
+            elif konsole_app_index is not None:
+                gui_app = 'konsole'
+            elif yakuake_app_index is not None:
+                gui_app ='yakuake'
+            elif 'KONSOLE_VERSION' in os.environ:
+                gui_app = 'konsole'
+            else:
+                 gui_app = 'unknown'
+            log('gui_app {}', gui_app)
 
+            gui_app_tab_name = None
+            if gui_app == 'yakuake':
+                # SESSION_ID=$(qdbus org.kde.yakuake /yakuake/sessions activeSessionId)
+                # qdbus org.kde.yakuake /yakuake/tabs tabTitle ${SESSION_ID}
                 try:
-                    active_session_id = call_dbus('org.kde.yakuake', '/yakuake/sessions', 'activeSessionId')
-                    gui_app_tab_name = call_dbus('org.kde.yakuake', '/yakuake/tabs', 'tabTitle', 'int32:' + active_session_id)
-
+                    import dbus
+                    gui_app_dbus_session = dbus.SessionBus()
+                    if gui_app_dbus_session is not None:
+                        dbus_object = gui_app_dbus_session.get_object('org.kde.yakuake', '/yakuake/sessions')
+                        if dbus_object is not None:
+                            session_id = dbus_object.activeSessionId()
+                            dbus_object = gui_app_dbus_session.get_object('org.kde.yakuake', '/yakuake/tabs')
+                            gui_app_tab_name = dbus_object.tabTitle(session_id)
                 except Exception as e:
-                    log('yakuake get tab name exception2'.format(backend), e)
-        elif gui_app == 'konsole':
-            # $KONSOLE_DBUS_SERVICE $KONSOLE_DBUS_SESSION title 1
-            try:
-                import dbus
-                gui_app_dbus_session = dbus.SessionBus()
-                if gui_app_dbus_session is not None:
-                    dbus_object = gui_app_dbus_session.get_object(os.environ['KONSOLE_DBUS_SERVICE'], os.environ['KONSOLE_DBUS_SESSION'])
-                    gui_app_tab_name = dbus_object.title(1)
-            except Exception as e:
-                log('yakuake get tab name exception1'.format(backend), e)
+                    log('yakuake get tab name exception1', e)
 
-                try:
-                    gui_app_tab_name = call_dbus(os.environ['KONSOLE_DBUS_SERVICE'], os.environ['KONSOLE_DBUS_SESSION'], 'title', 'int32:1')
+                    try:
+                        active_session_id = call_dbus('org.kde.yakuake', '/yakuake/sessions', 'activeSessionId')
+                        gui_app_tab_name = call_dbus('org.kde.yakuake', '/yakuake/tabs', 'tabTitle', 'int32:' + active_session_id)
 
+                    except Exception as e:
+                        log('yakuake get tab name exception2', e)
+            elif gui_app == 'konsole':
+                # $KONSOLE_DBUS_SERVICE $KONSOLE_DBUS_SESSION title 1
+                try:
+                    import dbus
+                    gui_app_dbus_session = dbus.SessionBus()
+                    if gui_app_dbus_session is not None:
+                        dbus_object = gui_app_dbus_session.get_object(os.environ['KONSOLE_DBUS_SERVICE'], os.environ['KONSOLE_DBUS_SESSION'])
+                        gui_app_tab_name = dbus_object.title(1)
                 except Exception as e:
+                    log('yakuake get tab name exception1', e)
+
                     try:
-                        gui_app_tab_name = call_dbus('org.kde.konsole', os.environ['KONSOLE_DBUS_SESSION'], 'title', 'int32:1')
+                        gui_app_tab_name = call_dbus(os.environ['KONSOLE_DBUS_SERVICE'], os.environ['KONSOLE_DBUS_SESSION'], 'title', 'int32:1')
+
                     except Exception as e:
-                        log('yakuake get tab name exception3'.format(backend), e)
-                    log('yakuake get tab name exception2'.format(backend), e)
+                        try:
+                            gui_app_tab_name = call_dbus('org.kde.konsole', os.environ['KONSOLE_DBUS_SESSION'], 'title', 'int32:1')
+                        except Exception as e:
+                            log('yakuake get tab name exception3', e)
+                        log('yakuake get tab name exception2', e)
 
-        log('gui_app_tab_name', gui_app_tab_name)
+            log('gui_app_tab_name', gui_app_tab_name)
 
-        # text multiplexers: tmux, screen
-        tmux_app_index = parent_names.index('tmux: server') if 'tmux: server' in parent_names else None
-        screen_app_index = parent_names.index('screen') if 'screen' in parent_names else None
-        if tmux_app_index is None:
+            # text multiplexers: tmux, screen
             tmux_app_index = parent_names.index('tmux: server') if 'tmux: server' in parent_names else None
-        log('detect tmux {} screen {}'.format(tmux_app_index, screen_app_index))
-
-        if tmux_app_index is not None and screen_app_index is not None:
-            if screen_app_index < tmux_app_index:
+            screen_app_index = parent_names.index('screen') if 'screen' in parent_names else None
+            if tmux_app_index is None:
+                tmux_app_index = parent_names.index('tmux: server') if 'tmux: server' in parent_names else None
+            log('detect tmux {} screen {}', tmux_app_index, screen_app_index)
+
+            if tmux_app_index is not None and screen_app_index is not None:
+                if screen_app_index < tmux_app_index:
+                    multiplexer_app = 'screen'
+                elif screen_app_index > tmux_app_index:
+                    multiplexer_app = 'tmux'
+            elif screen_app_index is not None:
                 multiplexer_app = 'screen'
-            elif screen_app_index > tmux_app_index:
+            elif tmux_app_index is not None:
+                multiplexer_app ='tmux'
+            elif 'TMUX' in os.environ:
                 multiplexer_app = 'tmux'
-        elif screen_app_index is not None:
-            multiplexer_app = 'screen'
-        elif tmux_app_index is not None:
-            multiplexer_app ='tmux'
-        elif 'TMUX' in os.environ:
-            multiplexer_app = 'tmux'
-        elif 'STY' in os.environ:
-            multiplexer_app = 'screen'
-        else:
-             multiplexer_app = 'unknown'
-
-        log('multiplexer_app {}'.format(multiplexer_app))
-
-        multiplexer_window_name = None
-        multiplexer_pane_name = None
-        multiplexer_way = None
-        if multiplexer_app == 'screen':
-            try:
-                sty = os.environ.get('STY')
-                log('multiplexer_app: {}, STY: {}'.format(multiplexer_app, sty))
+            elif 'STY' in os.environ:
+                multiplexer_app = 'screen'
+            else:
+                 multiplexer_app = 'unknown'
 
-                screen_output = process_exec(['screen', '-q', '-Q', 'title'])
+            log('multiplexer_app {}', multiplexer_app)
 
-                multiplexer_window_name = screen_output.decode().rstrip('\n\r')
-                if multiplexer_window_name == '':
-                    multiplexer_window_name = None
-                log('multiplexer_app: {}, title: {}'.format(multiplexer_app, multiplexer_window_name))
-            except Exception as e:
-                log('screen multiplexer_window_name - exception:', e)
-        if multiplexer_app  == 'tmux':
-            try:
-                tmux_output = process_exec(['tmux', 'display-message', '-p', '"#{session_name} -> #{window_index} #{window_name} -> #{pane_index} #{pane_title}"'])
-                multiplexer_way = tmux_output.decode()[0:-1].strip('"').strip()
-                log('multiplexer_app: {}, way: {}'.format(multiplexer_app, multiplexer_way))
-            except Exception as e:
-                log('tmux multiplexer_way - exception:', e)
-
-            try:
-                tmux_output = process_exec(['tmux', 'list-window', '-F', '"#{window_name} #{window_active}"'])
-                tmux_windows = tmux_output.decode()[0:-1].splitlines()
-                [multiplexer_window_name] = [tmux_window.strip('"')[0:-2] for tmux_window in tmux_windows if tmux_window.strip('"')[-1] == '1']
-                if multiplexer_window_name == '':
-                    multiplexer_window_name = None
-                log('multiplexer_app: {}, window: {}'.format(multiplexer_app, multiplexer_window_name))
-            except Exception as e:
-                log('tmux multiplexer_window_name - exception:', e)
+            multiplexer_window_name = None
+            multiplexer_pane_name = None
+            multiplexer_way = None
+            if multiplexer_app == 'screen':
+                try:
+                    sty = os.environ.get('STY')
+                    log('multiplexer_app: {}, STY: {}', multiplexer_app, sty)
 
-            try:
-                tmux_output = process_exec(['tmux', 'list-pane', '-F', '"#{pane_title} #{pane_active}"'])
-                tmux_panes = tmux_output.decode()[0:-1].splitlines()
-                [multiplexer_pane_name] = [tmux_pane.strip('"')[0:-2] for tmux_pane in tmux_panes if tmux_pane.strip('"')[-1] == '1']
-                log('multiplexer_app: {}, pane: {}'.format(multiplexer_app, multiplexer_pane_name))
-            except Exception as e:
-                log('tmux multiplexer_pane_name - exception:', e)
+                    screen_output = process_exec(['screen', '-q', '-Q', 'title'])
 
-        console_names = []
-        if gui_app_tab_name is not None:
-            console_names.append(gui_app_tab_name)
-        if multiplexer_way is not None:
-            console_names.append(multiplexer_way)
-        else:
-            if multiplexer_window_name is not None:
-                console_names.append(multiplexer_window_name)
-            if multiplexer_pane_name is not None:
-                console_names.append(multiplexer_pane_name)
+                    multiplexer_window_name = screen_output.decode().rstrip('\n\r')
+                    if multiplexer_window_name == '':
+                        multiplexer_window_name = None
+                    log('multiplexer_app: {}, title: {}', multiplexer_app, multiplexer_window_name)
+                except Exception as e:
+                    log('screen multiplexer_window_name - exception:', e)
+            if multiplexer_app  == 'tmux':
+                context = tmux_context()
+                if context is not None:
+                    multiplexer_way = '{} -> {} {} -> {} {}'.format(context['session'], context['window_index'], context['window_name'], context['pane_index'], context['pane_title']).strip()
+                    multiplexer_window_name = context['window_name'] or None
+                    multiplexer_pane_name = context['pane_title'] or None
+                    log('multiplexer_app: {}, way: {}', multiplexer_app, multiplexer_way)
+
+            console_names = []
+            if gui_app_tab_name is not None:
+                console_names.append(gui_app_tab_name)
+            if multiplexer_way is not None:
+                console_names.append(multiplexer_way)
+            else:
+                if multiplexer_window_name is not None:
+                    console_names.append(multiplexer_window_name)
+                if multiplexer_pane_name is not None:
+                    console_names.append(multiplexer_pane_name)
 
-        if len(console_names) > 1:
-            names = ' -> '.join(console_names)
-        elif len(console_names) == 1:
-            names = console_names[0]
+            console_context['names'] = console_names
+        except Exception as e:
+            log('console names detection failed', e)
+        console_context['time'] = monotonic() - detection_start
 
-        if len(console_names) > 0:
-            notify__title += ' [{}]'.format(names)
+    console_context = {'names': [], 'time': None}
+    profile_mark('parents')
 
+    try:
         shell = parent_process_info_exe
         shell_cmdline = parent_process_info_cmdline
 
@@ -1121,9 +2946,97 @@ Examples:
                     cmdline_args = shlex.split(run_cmd)
                 system_shell = False
     except Exception as e:
-        log('backend={} cmd run'.format(backend), e)
+        log('backend={} cmd run', backend, e)
+
+    if log_enabled:
+        log('detected_shell={} detected_shell_cmdline={} use_system_shell={} cmdline={}', shell, shell_cmdline, system_shell, run_cmd)
+
+    # simple command does not need shell, its startup (rc files) can take longer than command itself
+    SHELL_BUILTINS = ['.', ':', '[', 'alias', 'bg', 'bind', 'break', 'builtin', 'cd', 'command', 'continue', 'declare', 'dirs', 'disown', 'echo', 'enable', 'eval', 'exec', 'exit', 'export', 'fc', 'fg', 'getopts', 'hash', 'history', 'jobs', 'kill', 'let', 'local', 'logout', 'popd', 'printf', 'pushd', 'pwd', 'read', 'readonly', 'return', 'set', 'shift', 'shopt', 'source', 'test', 'time', 'times', 'trap', 'type', 'typeset', 'ulimit', 'umask', 'unalias', 'unset', 'wait']
+
+    # read by non-interactive "shell -c" (with BASH_ENV, ENV, ZDOTDIR), aliases and functions defined there shadow binaries
+    SHELL_STARTUP_FILES = ['~/.zshenv', '/etc/zshenv', '/etc/zsh/zshenv', '~/.config/fish/config.fish', '~/.config/fish/functions', '/etc/fish/config.fish']
+    SHELL_COMMANDS_CACHE_FILE = os.path.join(nf_dir, 'shell_commands.json')
+    SHELL_COMMANDS_CACHE_SIZE = 64
+
+    # True if shell runs binary (or builtin doing the same) for name, False for alias, function or unknown shell;
+    # shell is asked once, answer is cached until PATH, exported functions or startup files change
+    def shell_runs_binary(shell, name):
+        import hashlib
+        import subprocess
+        if shell.endswith('fish'):
+            query = 'type -t {}'.format(name)
+        elif [known_shell for known_shell in ['bash', 'zsh', 'sh'] if shell.endswith(known_shell)]:
+            query = 'type {}'.format(name)
+        else:
+            return False
+        startup_files = SHELL_STARTUP_FILES + [os.environ.get('BASH_ENV'), os.environ.get('ENV')]
+        if os.environ.get('ZDOTDIR'):
+            startup_files.append(os.path.join(os.environ['ZDOTDIR'], '.zshenv'))
+        key = [shell, name, os.environ.get('PATH')] + sorted([env for env in os.environ if env.startswith('BASH_FUNC_')])
+        for path in startup_files:
+            if path:
+                try:
+                    key.append('{}={}'.format(path, os.path.getmtime(os.path.expanduser(path))))
+                except OSError:
+                    pass
+        key = hashlib.sha1('\n'.join(key).encode()).hexdigest()
+        try:
+            cache = read_json_file(SHELL_COMMANDS_CACHE_FILE)
+        except Exception:
+            cache = {}
+        if key in cache:
+            log('cached shell command', name, cache[key])
+            return cache[key]
+
+        try:
+            environ = dict(os.environ, LC_ALL='C')
+            with open(os.devnull, 'r+b') as devnull:
+                output = subprocess.Popen([shell, '-c', query], stdin=devnull, stdout=subprocess.PIPE, stderr=devnull, env=environ).communicate()[0]
+            output = output.decode('utf-8', 'replace').strip()
+        except Exception as e:
+            log('cannot ask shell for command', shell, name, e)
+            return False
+        # "ls is /bin/ls", "ls is hashed (/bin/ls)", "true is a shell builtin", "ls is an alias for ...", "f is a function"
+        if shell.endswith('fish'):
+            binary = output in ['file', 'builtin']
+        else:
+            binary = 'alias' not in output and 'function' not in output and ('builtin' in output or ' is /' in output or '(/' in output)
+        log('shell command', shell, name, output, binary)
+        cache[key] = binary
+        for old_key in list(cache)[:-SHELL_COMMANDS_CACHE_SIZE]:
+            del cache[old_key]
+        try:
+            write_json_file(SHELL_COMMANDS_CACHE_FILE, cache)
+        except Exception as e:
+            log('cannot write shell commands cache', e)
+        return binary
 
-    log('detected_shell={} detected_shell_cmdline={} use_system_shell={} cmdline={}'.format(shell, shell_cmdline, system_shell, run_cmd))
+    def direct_argv(cmdline, shell):
+        import re
+        words = cmdline.split()
+        if not words or words[0] in SHELL_BUILTINS or '=' in words[0]:
+            return None
+        # no quotes, variables, globs, redirections, pipes, ~, comments, brace expansion
+        if not all([re.match(r'^[A-Za-z0-9_@+,./:=-]+$', word) for word in words]):
+            return None
+        executable = which(words[0])
+        if executable is None:
+            return None  # maybe alias or function
+        if '/' not in words[0] and not shell_runs_binary(shell, words[0]):
+            return None  # alias or function shadows binary, or shell cannot tell
+        return [executable] + words[1:]
+
+    direct_exec = False
+    if args.cmd is not None and not args.use_shell and sys.platform != 'win32':
+        # without detected shell command would run by /bin/sh
+        argv_direct = direct_argv(cmdline, '/bin/sh' if system_shell else shell)
+        if argv_direct is not None:
+            cmdline_args = argv_direct
+            system_shell = False
+            direct_exec = True
+            log('run without shell', cmdline_args)
+    profile_mark('shell')
 
     ############################################################################
     # --detach
@@ -1148,70 +3061,438 @@ Examples:
             else:
                 pid = os.fork()
                 if pid > 0:
-                    log('parent pid={} exit'.format(os.getpid()))
+                    log('parent pid={} exit', os.getpid())
 
                     nf_cleanup()
                     return 'detached'
                 if pid == 0:
-                    log('child pid={} start'.format(os.getpid()))
+                    log('child pid={} start', os.getpid())
+        except Exception as e:
+            log('detach not supported for {} {}', sys.platform, sys.version_info, e)
+
+    # backend is probed while waiting for pids/running command, only steps which need terminal (password) are done at the end
+    if backend == 'deferred':
+        def probe_backends_deferred():
+            try:
+                backend_context['probed'] = probe_backends(interactive=False)
+            except Exception as e:
+                log('deferred backend probe failed', e)
+        try:
+            import threading
+            backend_context['thread'] = threading.Thread(target=probe_backends_deferred)
+            backend_context['thread'].daemon = True
+            backend_context['thread'].start()
         except Exception as e:
-            log('detach not supported for {} {}'.format(sys.platform, sys.version_info), e)
+            log('cannot probe backend in background', e)
+            backend = select_backend()
 
     ############################################################################
     # --wait-for-pids
     ############################################################################
-    if args.wait_for_pid is not None:
-        pids = list(set(args.wait_for_pid)) # unique items only
-        log('wait for pid: {}'.format(pids))
-        psutil_fail = False
+    def wait_for_pids_poll(pids):
+        # tick based fallback, tick grows so short waits are precise and long waits are cheap
+        start_times = {}
+        for pid in pids:
+            try:
+                start_times[pid] = read_proc_stat(pid)['starttime']
+            except Exception:
+                start_times[pid] = None
+        tick = 0.01
+        while pids:
+            for pid in pids[:]:
+                try:
+                    if start_times[pid] is None:
+                        os.kill(pid, 0)  # no /proc, e.g. macOS
+                        continue
+                    stat = read_proc_stat(pid)
+                    if stat['starttime'] != start_times[pid]:
+                        log('pid {} finished work', pid)
+                        pids.remove(pid)
+                    elif stat['state'] == 'Z':
+                        log('pid {} is zombie, treat as finished', pid)
+                        pids.remove(pid)
+                except Exception as e:
+                    log('pid {} finished work:', pid, e)
+                    pids.remove(pid)
+            if pids:
+                time.sleep(tick)
+                tick = min(tick * 2, 1)
+
+    def wait_for_pids(pids):
+        if hasattr(os, 'pidfd_open'):
+            import errno
+            import select
+            epoll = select.epoll()
+            pidfds = {}
+            not_pidfd_pids = []
+            try:
+                for pid in pids:
+                    try:
+                        pidfd = os.pidfd_open(pid)
+                    except Exception as e:
+                        if isinstance(e, OSError) and e.errno == errno.ESRCH:
+                            log('pid {} finished work', pid)
+                        else:
+                            log('pidfd_open failed for pid {}, poll it', pid, e)  # e.g. too many open files
+                            not_pidfd_pids.append(pid)
+                        continue
+                    pidfds[pidfd] = pid
+                    epoll.register(pidfd, select.EPOLLIN)
+
+                # pidfd is readable when process exits, so nothing is done until then
+                while pidfds:
+                    for pidfd, _ in epoll.poll(-1):
+                        log('pid {} finished work', pidfds.pop(pidfd))
+                        epoll.unregister(pidfd)
+                        os.close(pidfd)
+            finally:
+                for pidfd in pidfds:
+                    os.close(pidfd)
+                epoll.close()
+            wait_for_pids_poll(not_pidfd_pids)
+            return
+
         try:
             import psutil
             processes = [psutil.Process(pid) for pid in pids if  psutil.pid_exists(pid)]
             psutil.wait_procs(processes)
+            return
         except Exception as e:
             log('wait for pid psutil exception', e)
-            psutil_fail = True
-        if psutil_fail == True:
+        wait_for_pids_poll(pids)
+
+    if args.wait_for_pid is not None:
+        pids = list(set(args.wait_for_pid)) # unique items only
+        log('wait for pid: {}', pids)
+        try:
+            wait_for_pids(pids)
+        except Exception as e:
+            log('exception while waiting for pids', e)
+    profile_mark('wait_for_pid')
+
+    # terminal context is needed only for notification title so detect it while command is running
+    try:
+        import threading
+        console_context['thread'] = threading.Thread(target=detect_console_names)
+        console_context['thread'].daemon = True
+        console_context['thread'].start()
+    except Exception as e:
+        log('cannot run console names detection in background', e)
+        console_context['thread'] = None
+        detect_console_names()
+
+    RUSAGE_FIELDS = ['ru_utime', 'ru_stime', 'ru_maxrss', 'ru_inblock', 'ru_oublock', 'ru_nvcsw', 'ru_nivcsw']
+
+    def rusage_to_dict(rusage):
+        usage = dict([(field, getattr(rusage, field)) for field in RUSAGE_FIELDS])
+        if sys.platform == 'darwin':
+            usage['ru_maxrss'] //= 1024  # bytes on macOS, KiB elsewhere
+        return usage
+
+    def children_rusage():
+        try:
+            import resource
+            return rusage_to_dict(resource.getrusage(resource.RUSAGE_CHILDREN))
+        except Exception as e:
+            log('cannot get children rusage', e)
+        return None
+
+    # returns (exit code, resource usage of waited child or None)
+    def wait_process(p):
+        if hasattr(os, 'wait4'):
             try:
-                start_time = None
                 while True:
-                    for pid in pids[:]:
-                        try:
-                            with open('/proc/{pid}/stat'.format(pid=pid)) as f:
-                                stat = f.read().split()
-                                if start_time is None:
-                                    start_time = stat[21]
-                                elif start_time != stat[21]:
-                                    log('pid {} finished work'.format(pid))
-                                    pids.remove(pid)
-                                elif stat[2] == 'Z':
-                                    log('pid {} is zombie, treat as finished'.format(pid))
-                                    pids.remove(pid)
-                        except Exception as e:
-                            log('exception while waiting for pid {}:'.format(pid), e)
-                            pids.remove(pid)
-                    if len(pids) == 0:
+                    try:
+                        _, status, rusage = os.wait4(p.pid, 0)
                         break
-                    time.sleep(1)
+                    except OSError as e:
+                        import errno
+                        if e.errno != errno.EINTR:  # python < 3.5 does not retry
+                            raise
+                if os.WIFSIGNALED(status):
+                    p.returncode = -os.WTERMSIG(status)
+                else:
+                    p.returncode = os.WEXITSTATUS(status)
+                return p.returncode, rusage_to_dict(rusage)
+            except Exception as e:
+                log('wait4 failed', e)
+
+        usage_before = children_rusage()
+        p.communicate()
+        usage_after = children_rusage()
+        usage = None
+        if usage_before is not None and usage_after is not None:
+            usage = dict([(field, usage_after[field] - usage_before[field]) for field in RUSAGE_FIELDS])
+            usage['ru_maxrss'] = usage_after['ru_maxrss']  # maximum of all children, not a counter
+        return p.returncode, usage
+
+    perf_counter = time.perf_counter if hasattr(time, 'perf_counter') else time.time
+    rusage = None
+
+    # --tail: output goes through nf unchanged, only last chunks are kept so memory does not depend on output size
+    TAIL_CHUNK_SIZE = 64 * 1024
+    TAIL_MAX_BYTES = 1024 * 1024  # for --tail N when lines are very long
+
+    output_tail = None
+    if args.tail is not None or args.tail_bytes is not None:
+        import collections
+        output_tail = {
+            'chunks': collections.deque(),
+            'bytes': 0,
+            'newlines': 0,
+            'max_lines': args.tail,
+            'max_bytes': args.tail_bytes if args.tail_bytes is not None else TAIL_MAX_BYTES,
+        }
+
+    def output_tail_append(data):
+        output_tail['chunks'].append(data)
+        output_tail['bytes'] += len(data)
+        output_tail['newlines'] += data.count(b'\n')
+        # drop oldest chunk only if the rest is still enough
+        while len(output_tail['chunks']) > 1:
+            first = output_tail['chunks'][0]
+            first_newlines = first.count(b'\n')
+            enough_lines = output_tail['max_lines'] is not None and output_tail['newlines'] - first_newlines > output_tail['max_lines']
+            enough_bytes = output_tail['bytes'] - len(first) >= output_tail['max_bytes']
+            if not (enough_lines or enough_bytes):
+                break
+            output_tail['chunks'].popleft()
+            output_tail['bytes'] -= len(first)
+            output_tail['newlines'] -= first_newlines
+
+    def output_tail_text():
+        data = b''.join(output_tail['chunks'])[-output_tail['max_bytes']:]
+        text = data.decode('utf-8', 'replace')
+        lines = text.rstrip('\n').split('\n')
+        if output_tail['max_lines'] is not None:
+            lines = lines[-output_tail['max_lines']:] if output_tail['max_lines'] > 0 else []
+        return '\n'.join(lines)
+
+    # --notify-on: all patterns are joined into one regex with named groups so each chunk is scanned once,
+    # patterns which cannot be joined (global flags like (?i), the same group names) are compiled one by one
+    output_triggers = None
+    if args.notify_on:
+        output_triggers = {
+            'patterns': dict(enumerate(args.notify_on)),
+            'regex': None,
+            'separate': {},
+            'carry': {},
+            'threads': [],
+        }
+
+    def output_triggers_compile():
+        import re
+        patterns = output_triggers['patterns']
+        output_triggers['regex'] = None
+        output_triggers['separate'] = {}
+        if not patterns:
+            return
+        regex = '|'.join(['(?P<nf_trigger_{}>{})'.format(index, patterns[index]) for index in sorted(patterns)])
+        if not isinstance(regex, bytes):
+            regex = regex.encode('utf-8')
+        try:
+            output_triggers['regex'] = re.compile(regex, re.MULTILINE)
+        except re.error as e:
+            log('cannot join --notify-on patterns, use them one by one', e)
+            output_triggers['separate'] = dict([(index, re.compile(pattern if isinstance(pattern, bytes) else pattern.encode('utf-8'), re.MULTILINE)) for index, pattern in patterns.items()])
+
+    # returns (pattern index, match) of the first match or None
+    def output_triggers_search(data, pos):
+        if output_triggers['regex'] is not None:
+            match = output_triggers['regex'].search(data, pos)
+            return None if match is None else (int(match.lastgroup[len('nf_trigger_'):]), match)
+        found = None
+        for index, regex in output_triggers['separate'].items():
+            match = regex.search(data, pos)
+            if match is not None and (found is None or match.start() < found[1].start()):
+                found = (index, match)
+        return found
+
+    def output_triggers_scan(data, key, final=False):
+        # only complete lines are scanned, the rest waits for next chunk
+        data = output_triggers['carry'].get(key, b'') + data
+        end = len(data) if final else data.rfind(b'\n') + 1
+        if len(data) - end > TAIL_MAX_BYTES:
+            end = len(data)  # very long line, do not keep it forever
+        output_triggers['carry'][key] = data[end:]
+        data = data[:end]
+        pos = 0
+        while True:
+            found = output_triggers_search(data, pos)
+            if found is None:
+                break
+            index, match = found
+            line_start = data.rfind(b'\n', 0, match.start()) + 1
+            line_end = data.find(b'\n', match.end())
+            if line_end == -1:
+                line_end = len(data)
+            output_trigger_fire(output_triggers['patterns'].pop(index), data[line_start:line_end].decode('utf-8', 'replace'))
+            output_triggers_compile()
+            pos = line_start  # other patterns can match the same line
+
+    def output_trigger_fire(pattern, line):
+        log('output matched', pattern, line)
+        notification = {
+            'app_name': cmd,
+            'app_icon': 'dialog-information',
+            'title': notify__title,
+            'body': '"{}$ {}" output matched "{}":\n{}'.format(os.getcwd(), cmd, pattern, line),
+            'timeout': 0,
+            'exit_code': 0,
+        }
+        import threading
+        thread = threading.Thread(target=deliver_running_notification, args=(notification,))
+        thread.daemon = True
+        thread.start()
+        output_triggers['threads'].append(thread)
+
+    # backend for notifications while command is running, final backend selection must not be disturbed
+    def running_backend():
+        if args.no_notify:
+            return 'stdout'
+        if backend != 'deferred':
+            return backend
+        backend_context['thread'].join()
+        if backend_context['probed'] is not None:
+            for candidate, result in backend_context['probed'][0]:
+                if result:  # no user interaction while command is running
+                    return candidate
+        return 'stdout'
+
+    def deliver_running_notification(notification):
+        used_backend = 'stdout'
+        try:
+            used_backend = running_backend()
+            if used_backend == 'daemon':
+                try:
+                    used_backend = daemon_send({'request': 'notify', 'notification': notification})['backend']
+                except Exception as e:
+                    log('daemon failed', e)
+                    used_backend = 'stdout'
+            elif used_backend != 'stdout':
+                used_backend = deliver_notification(used_backend, notification)
+            if 'stdout' in used_backend.split(',') or args.print:
+                print_notification(notification, bell=not args.no_notify)
+        except Exception as e:
+            log('cannot deliver notification while command is running', e)
+        return used_backend
+
+    # --heartbeat: one notification updated in place, so only backends returning notification id are used
+    HEARTBEAT_BACKENDS = ['dbus', 'gdbus']
+
+    heartbeat_context = None
+    if args.heartbeat is not None and args.heartbeat > 0 and args.cmd is not None:
+        heartbeat_context = {
+            'replaces': 'heartbeat-{}-{}'.format(os.getpid(), time_start_epoch),
+            'used': False,
+            'thread': None,
+        }
+
+    def format_elapsed(seconds):
+        return (datetime.datetime(1970, 1, 1, 0, 0, 0) + datetime.timedelta(seconds=seconds)).strftime("%H:%M.%S")
+
+    def heartbeat():
+        expected_elapsed = history_expected_elapsed(cmdline, os.getcwd())
+        # Event.wait sleeps whole interval, nf wakes up only to send update
+        while not heartbeat_context['stop'].wait(args.heartbeat):
+            backend_name = running_backend()
+            if backend_name == 'daemon':
+                # daemon keeps notification ids, so it can replace them if its own backend can
+                try:
+                    backend_name = daemon_send({'request': 'ping'}, timeout=1)['backend']
+                except Exception as e:
+                    log('daemon failed', e)
+                    backend_name = 'stdout'
+            if backend_name not in HEARTBEAT_BACKENDS:
+                log('backend {} cannot replace notification, no heartbeat', backend_name)
+                return
+            elapsed = perf_counter() - command_start
+            body = '"{}$ {}" is running.\n\nElapsed time: {}'.format(os.getcwd(), cmd, format_elapsed(elapsed))
+            if expected_elapsed is not None:
+                body += '\nETA:          {}'.format(format_elapsed(max(expected_elapsed - elapsed, 0)))
+            notification = {
+                'app_name': cmd,
+                'app_icon': 'appointment-soon',
+                'title': notify__title,
+                'body': body,
+                'timeout': 0,
+                'exit_code': 0,
+                'replaces': heartbeat_context['replaces'],
+            }
+            used_backend = deliver_running_notification(notification)
+            if used_backend not in HEARTBEAT_BACKENDS:
+                log('backend {} cannot replace notification, no heartbeat', used_backend)
+                return
+            heartbeat_context['used'] = True
+
+    def output_pump(pipe, stream, key, lock):
+        out = getattr(stream, 'buffer', stream)
+        fd = pipe.fileno()
+        while True:
+            data = os.read(fd, TAIL_CHUNK_SIZE)
+            if not data:
+                break
+            try:
+                out.write(data)
+                out.flush()
             except Exception as e:
-                log('exception while waiting for pids', e)
+                log('cannot pass command output through', e)
+            with lock:
+                if output_tail is not None:
+                    output_tail_append(data)
+                if output_triggers is not None and output_triggers['patterns']:
+                    output_triggers_scan(data, key)
+        with lock:
+            if output_triggers is not None and output_triggers['patterns']:
+                output_triggers_scan(b'', key, final=True)
+        pipe.close()
+
+    def wait_process_piped(p):
+        import threading
+        lock = threading.Lock()
+        pumps = [threading.Thread(target=output_pump, args=(p.stdout, sys.stdout, 'stdout', lock)), threading.Thread(target=output_pump, args=(p.stderr, sys.stderr, 'stderr', lock))]
+        for pump in pumps:
+            pump.daemon = True
+            pump.start()
+        for pump in pumps:
+            pump.join()
+        p.stdout = p.stderr = None  # already read and closed, communicate() must not touch them
+        return wait_process(p)
+
     ############################################################################
     # core
     ############################################################################
+    command_start = perf_counter()
+    if heartbeat_context is not None:
+        try:
+            import threading
+            heartbeat_context['stop'] = threading.Event()
+            heartbeat_context['thread'] = threading.Thread(target=heartbeat)
+            heartbeat_context['thread'].daemon = True
+            heartbeat_context['thread'].start()
+        except Exception as e:
+            log('cannot start heartbeat', e)
     if args.cmd is not None:
         log('before run cmd', cmdline_args)
         try:
             import subprocess
-            p = subprocess.Popen(cmdline_args, shell=system_shell)
-            p.communicate()
-            exit_code = p.returncode
+            # close_fds=False lets subprocess use posix_spawn (nf descriptors are not inheritable since python 3.4)
+            popen_options = {'close_fds': False} if direct_exec and sys.version_info >= (3, 4) else {}
+            if output_tail is not None or output_triggers is not None:
+                if output_triggers is not None:
+                    output_triggers_compile()
+                p = subprocess.Popen(cmdline_args, shell=system_shell, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **popen_options)
+                exit_code, rusage = wait_process_piped(p)
+            else:
+                p = subprocess.Popen(cmdline_args, shell=system_shell, **popen_options)
+                exit_code, rusage = wait_process(p)
             #if sys.version_info >= (3, 5):
             #    exit_code = subprocess.run(cmdline_args, shell=system_shell).returncode
             #else:
             #    import subprocess
             #    exit_code = subprocess.call(cmdline_args, shell=system_shell)
         except Exception as e:
-            log('core run cmdline failed for: <{}>'.format(cmdline_args), e)
+            log('core run cmdline failed for:', cmdline_args, e, level='ERROR')
         log('after run cmd', cmdline_args)
             #exit_code = os.system(run_cmd)
         # exit_code = os.system(cmdline) # works fine
@@ -1219,11 +3500,33 @@ Examples:
     # end of core
     ############################################################################
 
-    log('cmdline={} system_shell={} exit code={}'.format(cmdline_args, system_shell, exit_code))
+    command_elapsed = perf_counter() - command_start
+    if heartbeat_context is not None and heartbeat_context['thread'] is not None:
+        heartbeat_context['stop'].set()
+        heartbeat_context['thread'].join()
+    if log_enabled:
+        log('cmdline={} system_shell={} exit code={} rusage={}', cmdline_args, system_shell, exit_code, rusage)
+    profile_mark('command')
 
     time_end = datetime.datetime.now()
+    time_end_epoch = time.time()
+
+    time_elapsed = datetime.datetime(1970, 1, 1, 0, 0, 0) + datetime.timedelta(seconds=command_elapsed)
+
+    if console_context['thread'] is not None:
+        console_context['thread'].join()
+    console_names = console_context['names']
+    log('console names', console_names)
+    if len(console_names) > 1:
+        names = ' -> '.join(console_names)
+    elif len(console_names) == 1:
+        names = console_names[0]
 
-    time_elapsed = datetime.datetime(1970, 1, 1, 0, 0, 0) +  (time_end - time_start)
+    if len(console_names) > 0:
+        notify__title += ' [{}]'.format(names)
+    profile_mark('console_names_wait')
+    if console_context['time'] is not None:
+        profile['phases'].append(('console_names (background)', console_context['time']))
 
     notify__body = '"' + os.getcwd() + "$ " + cmd + '"'
 
@@ -1241,7 +3544,14 @@ Examples:
         notify__body += ' finished work.'
 
     notify__body += "\n\nStart time:   " + time_start.strftime("%H:%M.%S") + "\n" + "End time:     " + time_end.strftime("%H:%M.%S") + "\n" + "Elapsed time: " + time_elapsed.strftime("%H:%M.%S")
+    if rusage is not None:
+        notify__body += "\nCPU user/sys: {:.2f}s / {:.2f}s".format(rusage['ru_utime'], rusage['ru_stime'])
+        notify__body += "\nMax RSS:      {:.1f} MiB".format(rusage['ru_maxrss'] / 1024.0)
+        notify__body += "\nBlock I/O:    {} in / {} out".format(rusage['ru_inblock'], rusage['ru_oublock'])
+        notify__body += "\nCtx switches: {} voluntary / {} involuntary".format(rusage['ru_nvcsw'], rusage['ru_nivcsw'])
     notify__body += "\nTimestamp: " + str(time.time())  # Observation: in KDE the same notification body results in replace notification(s) so you can run 5 nf and see only 2 notifications
+    if output_tail is not None and output_tail['bytes'] > 0:
+        notify__body += "\n\nOutput tail:\n" + output_tail_text()
 
     if args.custom_notification_title is not None:
         notify__title = args.custom_notification_title
@@ -1249,159 +3559,142 @@ Examples:
     if args.custom_notification_text is not None:
         notify__body = args.custom_notification_text
 
-    log('no_notifty is {}, backend is {}'.format(args.no_notify, backend))
-    if not args.no_notify:
-        try:
-            if backend == 'wsl':
-
-                nf_exit_code = 0
-                cmdline_args = None
-                try:
-                    s = None
-                    try:
-                        import inspect
-                        s = inspect.getsource(inspect.getmodule(nf))
-
-                        if sys.version_info.major == 2:
-                            s = s[s.find('##'):]
-
-                        s = s.replace('nf_stored_code = None', 'nf_stored_code = {}'.format(repr(s)), 1)
-                    except Exception as e:
-                        s = nf_stored_code
-                        s = s.replace('nf_stored_code = None', 'nf_stored_code = {}'.format(repr(s)), 1) # recover stored code variable
-                        log('inspect exception:', e)
-
-                    cmdline_args = [python_exe, '-', '--custom_notification_title={}'.format(notify__title), '--custom_notification_text={}'.format(notify__body),  '--custom_notification_exit_code={}'.format(exit_code)]
-
-                    log('run external python:', cmdline_args)
-                    import subprocess
-                    p = subprocess.Popen(cmdline_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=environ)
-                    nf_script = s.encode()
-                    output, stderr_output  = p.communicate(nf_script)
-                    o = output.decode()
-                    log('stdout external python', output)
-                    log('stderr external python', stderr_output)
-                    if o != '':
-                        print_stdout(o)
-                    # output is redirected on stdout
-                    if nf_exit_code != 0:
-                        log('run external python exit with error: <{}> exit code {}'.format(cmdline_args, nf_exit_code))
-                except Exception as e:
-                    log('run external python failed for: <{}> exit code {}'.format(cmdline_args, nf_exit_code), e)
-                    print_stdout('ERROR: Cannot run external python, last3 win step')
-                    backend = 'stdout'
+    log('no_notifty is {}, backend is {}', args.no_notify, backend)
+    notification = {
+        'app_name': notify__app_name,
+        'app_icon': notify__app_icon,
+        'title': notify__title,
+        'body': notify__body,
+        'timeout': notify__timeout,
+        'exit_code': exit_code,
+    }
+    if heartbeat_context is not None and heartbeat_context['used']:
+        notification['replaces'] = heartbeat_context['replaces']  # final notification replaces heartbeat one
+    if args.notification_json is not None:
+        import json
+        notification = json.loads(args.notification_json)
+    if output_triggers is not None:
+        for thread in output_triggers['threads']:
+            thread.join()
+    if backend == 'deferred':
+        backend_context['thread'].join()
+        if backend_context['probed'] is not None:
+            backend = choose_backend(backend_context['probed'])
+        else:
+            backend = select_backend()
+        log('deferred backend is {}', backend)
 
-                log('wsl external python exit code ', nf_exit_code)
-            elif backend == 'dbus':
-                notify__replaces_id = dbus.UInt32(time.time() * 1000000 % 2 ** 32)
-                notify__actions = dbus.Array(signature='s')
-                notify__hints = dbus.Dictionary(signature='sv')
+    def deliver_final_notification(backend, notification):
+        if backend == 'daemon':
+            try:
+                job = {'cmdline': cmdline, 'exit_code': exit_code, 'time_start': time_start.strftime("%Y-%m-%d %H:%M.%S.%f"), 'time_end': time_end.strftime("%Y-%m-%d %H:%M.%S.%f")}
+                response = daemon_send({'request': 'notify', 'notification': notification, 'job': job})
+                log('daemon response', response)
+                return response['backend']
+            except Exception as e:
+                log('daemon failed, fallback to local backend', e, level='WARNING')
+                backend = select_backend()
+        return deliver_notification(backend, notification)
 
+    def notify_final(backend):
+        if args.coalesce:
+            try:
+                import fcntl  # not on Windows, notification is sent directly
+            except ImportError as e:
+                fcntl = None
+                log('no fcntl, notifications are not coalesced', e)
+            if fcntl is not None:
+                spooled = False
                 try:
-                    backend_internal['dbus_notification'].Notify(notify__app_name, notify__replaces_id, notify__app_icon, notify__title, notify__body, notify__actions, notify__hints, notify__timeout)
+                    spool_put({'notification': notification, 'job': args.label if args.label else cmd})
+                    spooled = True
+                    return spool_flush(backend, deliver_final_notification, args.coalesce)
                 except Exception as e:
-                    log('dbus notify #1 fails', e)
-                    notify_interface = dbus.Interface(dbus_notification, dbus_interface='org.freedesktop.Notifications')
-                    notify_interface.Notify(notify__app_name, notify__replaces_id, notify__app_icon, notify__title, notify__body, notify__actions, notify__hints, notify__timeout)
-            elif backend == 'gdbus':
-                process_exec([gdbus_app, 'call', '--session', '--dest', 'org.freedesktop.Notifications', '--object-path', '/org/freedesktop/Notifications', '--method', 'org.freedesktop.Notifications.Notify',
-                                  notify__app_name,
-                                  str(int(time.time() * 1000000 % 2 ** 32)),
-                                  notify__app_icon,
-                                  notify__title,
-                                  notify__body,
-                                  "[]",
-                                  "{}",
-                                  str(notify__timeout)])
-            elif backend == 'notify-send':
-                process_exec([notify_send_app, notify__title, notify__body, '--expire-time', str(notify__timeout), '--icon', notify__app_icon, '--app-name', notify__app_name])
-            elif backend == 'termux-notification':
-                process_exec([termux_notification_app, '--title', notify__title, '--content', notify__body, '--sound', '--vibrate', '500,100,200', '--action', '"am start com.termux/.app.TermuxActivity"'])
-            elif backend == 'win10toast-persist':
-                import win10toast
-                toaster = win10toast.ToastNotifier()
-                toaster.show_toast(notify__title, notify__body, duration=None)
-            elif backend == 'win10toast':
-                import win10toast
-                toaster = win10toast.ToastNotifier()
-                toaster.show_toast(notify__title, notify__body)
-            elif backend == 'plyer':
-                plyer.notification.notify(title=notify__title, message=notify__body, app_name=notify__app_name, app_icon=notify__app_icon,timeout=notify__timeout)
-            elif backend == 'plyer_toast':
-                plyer.notification.notify(title=notify__title, message=notify__body, app_name=notify__app_name, app_icon=notify__app_icon,timeout=notify__timeout, toast=True)
-            elif backend == 'ssh':
-                if ssh_process:
-                    with open(__file__, 'r') as f:
-                        line = f.readline()
-                        while line != '##\n':
-                            line = f.readline()
-                        myself = f.read()
-# TODO: unbash ssh cmd: remove unset SSH_CLIENT)
-# TODO: detect DISPLAY=:0 
-# ps -fC X
-# UID        PID  PPID  C STIME TTY          TIME CMD
-# xxxx yyy   zzz  eee fff ttyaaa         aa:aa:aa X :0
-# so CMD is X :0 <-= ":0"
-# TODO: detect DBUS_SESSION_BUS_ADDRESS if possible
-                    cmd = "python - --custom_notification_title=\"{}\" --custom_notification_text=\"{}\" --custom_notification_exit_code={} --env-unset=SSH_CLIENT --env-set-default=DISPLAY=:0 {rest}".format(notify__title.replace("\"", "\\\""), notify__body.replace("\"", "\\\""), exit_code, rest=args.sub_nf_args).encode() + b"\n" + myself.encode() + b"\n"
-                    if sys.version_info >= (3, 3):
-                        output, stderr_output = ssh_process.communicate(cmd, timeout=5)
-                    else:
-                        output, stderr_output = ssh_process.communicate(cmd)
-                    log('stdout', output.decode())
-                    log('stderr', stderr_output.decode())
-            elif backend == 'paramiko':
-                if ssh_client:
-                    with open(__file__, 'r') as f:
-                        line = f.readline()
-                        while line != '##\n':
-                            line = f.readline()
-                        myself = f.read()
-                    cmd = "python - --custom_notification_title=\"{}\" --custom_notification_text=\"{}\" --custom_notification_exit_code={} --env-unset=SSH_CLIENT --env-set-default=DISPLAY=:0 {rest}".format(notify__title.replace("\"", "\\\""), notify__body.replace("\"", "\\\""), exit_code, rest=args.sub_nf_args).encode() + b"\n" + myself.encode() + b"\n"
-                    stdin, output, stderr_output = ssh_client.exec_command(cmd)
-                    log('stdout', output.read().decode())
-                    log('stderr', stderr_output.read().decode())
-                    ssh_client.close()
-        except Exception as e:
-            log('engine error, backend={}:'.format(backend), e)
-            exc_info = sys.exc_info()
-            log('traceback line: {line} ; '.format(line=exc_info[-1].tb_lineno), e)
-            import traceback
-            traceback.print_exception(*exc_info)
+                    log('spool failed', e, level='WARNING')
+                    if spooled:
+                        return backend
+        return deliver_final_notification(backend, notification)
+
+    # nf returns at once, notification is delivered by new nf process in own session: not killed with terminal,
+    # no fork of this process (threads of backends and probes could hold locks in forked copy)
+    def notify_final_detached(backend):
+        import json
+        import subprocess
+        argv = [sys.executable, os.path.abspath(__file__), '--notification-json', json.dumps(notification), '-l', args.label if args.label else cmd]
+        if backend != 'daemon':  # new nf finds daemon itself
+            argv += ['-b', backend]
+        argv += ['--coalesce={}'.format(args.coalesce or 0)]
+        if args.sub_nf_args is not None:
+            argv += ['--sub-nf-args={}'.format(args.sub_nf_args)]
+        if args.debugfile is not None:
+            logfile_flush()
+            argv += ['--debugfile', args.debugfile, '--debugfile-format', args.debugfile_format, '--debug-level', args.debug_level]
+        environ = dict(os.environ)
+        environ.pop('NF_ASYNC_NOTIFY', None)
+        options = {'start_new_session': True} if sys.version_info >= (3, 2) else {'preexec_fn': os.setsid}
+        with open(os.devnull, 'r+b') as devnull:
+            process = subprocess.Popen(argv, stdin=devnull, stdout=devnull, stderr=devnull, env=environ, close_fds=True, **options)
+        log('notification is delivered by detached process pid={}', process.pid)
+        return backend
 
-            backend = 'stdout'
+    if not args.no_notify:
+        # stdout backend prints to terminal, it cannot be done later
+        # paramiko connected with password cannot connect again without terminal
+        if args.async_notify and 'stdout' not in backend.split(',') and sys.platform != 'win32' and not backend_internal.get('paramiko_password'):
+            try:
+                backend = notify_final_detached(backend)
+            except Exception as e:
+                log('cannot deliver notification in detached process', e)
+                backend = notify_final(backend)
+        else:
+            backend = notify_final(backend)
     else:
         if backend != 'stdout':
             backend = 'stdout'
 
-    if backend == 'stdout' or args.print:
-        columns = 10
-        try:
-            import shutil
-            sizes = shutil.get_terminal_size()
-            columns = sizes.columns
-        except Exception as e:
-            log('Cannot get terminal size', e)
+    if 'stdout' in backend.split(',') or args.print:
+        print_notification(notification, bell=not args.no_notify)
 
-        print_stdout('-' * columns)
-        print_stdout(notify__title)
-        print_stdout(notify__body)
-        print_stdout('-' * columns)
-        if not args.no_notify:
-            print_stdout('\a')
+    profile_mark('notification')
 
     if args.save:
         try:
+            import socket
+            history_save({
+                'cmdline': cmdline,
+                'cwd': os.getcwd(),
+                'label': args.label,
+                'exit_code': exit_code,
+                'start': time_start_epoch,
+                'end': time_end_epoch,
+                'elapsed': command_elapsed,
+                'host': socket.gethostname(),
+                'backend': backend,
+                'utime': rusage['ru_utime'] if rusage is not None else None,
+                'stime': rusage['ru_stime'] if rusage is not None else None,
+                'maxrss': rusage['ru_maxrss'] if rusage is not None else None,
+                'inblock': rusage['ru_inblock'] if rusage is not None else None,
+                'oublock': rusage['ru_oublock'] if rusage is not None else None,
+                'nvcsw': rusage['ru_nvcsw'] if rusage is not None else None,
+                'nivcsw': rusage['ru_nivcsw'] if rusage is not None else None,
+            })
+        except Exception as e:
+            log('Cannot save history', e)
+
+        try:
+            # one write, so parallel nf runs do not interleave lines
             with open(".nf", 'a') as f:
-                print_stdout(cmdline, file=f)
-                print_stdout('Exit code: {}'.format(exit_code), file=f)
-                print_stdout('Start {}'.format(time_start.strftime("%Y-%m-%d %H:%M.%S.%f")), file=f)
-                print_stdout('Stop  {}'.format(time_end.strftime("%Y-%m-%d %H:%M.%S.%f")), file=f)
-                print_stdout('Diff             {}'.format(time_elapsed.strftime('%H:%M.%S')), file=f)
-                print_stdout('----------', file=f)
+                print_stdout('\n'.join([
+                    cmdline,
+                    'Exit code: {}'.format(exit_code),
+                    'Start {}'.format(time_start.strftime("%Y-%m-%d %H:%M.%S.%f")),
+                    'Stop  {}'.format(time_end.strftime("%Y-%m-%d %H:%M.%S.%f")),
+                    'Diff             {}'.format(time_elapsed.strftime('%H:%M.%S')),
+                    '----------']), file=f)
         except Exception as e:
             print_stdout('Cannot save .nf file')
             log('Cannot save .nf file', e)
+    profile_mark('save')
 
     nf_cleanup()
     return exit_code
@@ -12,10 +12,11 @@ import os
 tmp_fake_apps = os.path.abspath(os.path.join('tests', 'tmp_fake_apps'))
 
 @pytest.fixture(scope='function')
-def fixture_environment():
+def fixture_environment(tmp_path):
     import os
 
     environ_backup = os.environ.copy()
+    os.environ['HOME'] = str(tmp_path)  # ~/.nfdir: backend cache, history, spool
 
     if 'KONSOLE_VERSION' in os.environ:
         del os.environ['KONSOLE_VERSION']
@@ -111,6 +112,28 @@ def fixture_remove_fake_apps():
     remove_fake_apps(tmp_fake_apps)
 
 
+@pytest.fixture(scope='function')
+def fixture_fake_app(fixture_remove_fake_apps, fixture_environment):
+    # fake_app('notify-send', 'echo "$@" >> log\n') writes shell script to tmp_fake_apps, which is first in PATH
+    os.environ['PATH'] = tmp_fake_apps + os.pathsep + os.environ['PATH']
+
+    def fake_app(name, script):
+        app = os.path.join(tmp_fake_apps, name)
+        with open(app, 'w') as f:
+            f.write('#!/bin/sh\n' + script)
+        os.chmod(app, 0o777)
+        return app
+
+    yield fake_app
+
+
+@pytest.fixture(scope='function')
+def fixture_fake_python(fixture_fake_app):
+    # "remote" nf of ssh and wsl tests is run by python from PATH
+    os.symlink(sys.executable, os.path.join(tmp_fake_apps, 'python'))
+    yield fixture_fake_app
+
+
 def get_method_mocks():
     dbus_session_bus = mock.MagicMock()
     dbus_session_bus.SessionBus.return_value = None
@@ -860,18 +883,13 @@ def test_tmux_support(fixture_remove_fake_apps, fixture_environment, capsys, is_
 
         my_app = '''#!{shebang}
 import sys
-if sys.argv[1] == 'list-window':
-    print('window 1')
-elif sys.argv[1] == 'list-pane':
-    print('pane 1')
-elif sys.argv[1:] == ['display-message', '-p', '"#{client_pid}"']:
-    print('0')
-elif sys.argv[1] == 'display-message':
-    print('session -> 1 window -> 1 pane')
+if sys.argv[1] == 'display-message' and 'show-environment' in sys.argv:
+    print('session\\t1\\twindow\\t1\\tpane\\t0')
+    print('-SSH_CLIENT')
 else:
     sys.exit(2)
 
-'''.format(shebang=sys.executable, client_pid='{client_pid}')
+'''.format(shebang=sys.executable)
 
         test_app_name = 'tmux'
         if sys.platform == "win32":
@@ -1194,21 +1212,35 @@ def test_wait_for_pid_no_psutil(fixture_environment, capsys):
     assert end - start > 0.5
 
 
-def test_debugfile(fixture_environment):
-    test_file = 'tmp_debugfile1'
-
-    import nf
-    exit_code = nf.nf(['-dp', '--debugfile', test_file, '--backend', 'stdout', ''])
+@pytest.mark.skipif(sys.platform == "win32" or sys.platform == "darwin", reason="Linux specific test")
+@pytest.mark.parametrize('pidfd', [True, False])
+def test_wait_for_pid_latency(fixture_environment, capsys, monkeypatch, pidfd):
     import os
+    import time
+    import subprocess
+    import sys
 
-    try:
-        os.remove(test_file)
-    except:
-        import time
-        time.sleep(1)
-        os.remove(test_file)
+    if pidfd and not hasattr(os, 'pidfd_open'):
+        pytest.skip('os.pidfd_open not available')
+    if not pidfd:
+        monkeypatch.delattr(os, 'pidfd_open', raising=False)
+    monkeypatch.setitem(sys.modules, 'psutil', None)
+
+    process = subprocess.Popen([sys.executable, '-c', 'import time;time.sleep(0.3)'])
+
+    sleeps = []
+    sleep = time.sleep
+    def recorded_sleep(seconds):
+        sleeps.append(seconds)
+        sleep(seconds)
+    monkeypatch.setattr(time, 'sleep', recorded_sleep)
+
+    import nf
+    exit_code = nf.nf(['--wait-for-pid', str(process.pid), '--wait-for-pid', '999999999', '--backend', 'stdout', ''])
+    process.wait()
 
     assert exit_code == 0
+    assert sum(sleeps) < 1  # exit is noticed without waiting a whole second
 
 
 def test_closed_stdout(fixture_environment):
@@ -1233,6 +1265,836 @@ def test_closed_stdout(fixture_environment):
     assert exit_code == 0
 
 
+def test_debugfile(fixture_environment):
+    test_file = 'tmp_debugfile1'
+
+    import nf
+    exit_code = nf.nf(['-dp', '--debugfile', test_file, '--backend', 'stdout', ''])
+    import os
+
+    try:
+        os.remove(test_file)
+    except:
+        import time
+        time.sleep(1)
+        os.remove(test_file)
+
+    assert exit_code == 0
+
+
+def test_debugfile_json_rotation(fixture_environment, tmpdir):
+    import json
+    import os
+
+    test_file = os.path.join(str(tmpdir), 'debug.log')
+
+    import nf
+    exit_code = nf.nf(['--debugfile', test_file, '--debugfile-format', 'json', '--debugfile-max-size', '2000', '-b', 'stdout', '-n', 'true'])
+    assert exit_code == 0
+
+    assert os.path.getsize(test_file) <= 2000 + 1  # and new line from cleanup
+    assert os.path.exists(test_file + '.1')
+    with open(test_file) as f:
+        records = [json.loads(line) for line in f.read().splitlines() if line]
+    assert records
+    assert set(records[0]) == set(['time', 'level', 'pid', 'message'])
+    assert records[0]['level'] == 'DEBUG'
+
+
+def test_debug_lazy_format(fixture_environment, capsys):
+    import re
+
+    import nf
+    exit_code = nf.nf(['-d', '-b', 'stdout', '-n', 'true'])
+    captured = capsys.readouterr()
+
+    assert exit_code == 0
+    assert re.search(r': nf version=\d+\.\d+', captured.out)  # fields filled when record is written
+    assert 'choosen backend is stdout\n' in captured.out
+    assert 'version={}' not in captured.out
+
+
+def test_backend_fanout(fixture_fake_app, capsys, tmpdir):
+    import os
+
+    calls = os.path.join(str(tmpdir), 'calls')
+    started = os.path.join(str(tmpdir), 'started')
+    # each backend waits until other one is started, so it meets it only if they are run at once
+    for app_name, condition in [('notify-send', 'true'), ('gdbus', '[ "$8" = "org.freedesktop.Notifications.Notify" ]')]:
+        fixture_fake_app(app_name, 'if ' + condition + '; then\n'
+                         '  echo ' + app_name + ' >> ' + started + '\n'
+                         '  for i in $(seq 100); do [ "$(wc -l < ' + started + ')" -ge 2 ] && break; sleep 0.1; done\n'
+                         '  [ "$(wc -l < ' + started + ')" -ge 2 ] && echo ' + app_name + ' >> ' + calls + '\n'
+                         '  echo "(uint32 7,)"\n'
+                         'fi\n')
+
+    import nf
+    exit_code = nf.nf(['-d', '--backend', 'notify-send,gdbus,stdout', 'true'])
+    captured = capsys.readouterr()
+
+    assert exit_code == 0
+    with open(calls) as f:
+        assert sorted(f.read().split()) == ['gdbus', 'notify-send']  # backends are not waited one after another
+    assert 'backend=notify-send delivery=True' in captured.out
+    assert 'backend=gdbus delivery=True' in captured.out
+    assert '$ true" finished work.' in captured.out  # stdout is one of backends
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Linux specific test")
+def test_backend_cache(fixture_fake_app, capsys, tmpdir):
+    import os
+
+    cache_file = os.path.join(str(tmpdir), '.nfdir', 'backend_cache.json')
+    fixture_fake_app('gdbus', '')
+
+    import nf
+    exit_code = nf.nf(['-d', 'true'])
+    assert exit_code == 0
+    assert os.path.exists(cache_file)
+    assert 'from cache' not in capsys.readouterr().out
+
+    exit_code = nf.nf(['-d', 'true'])
+    assert exit_code == 0
+    assert 'from cache' in capsys.readouterr().out
+
+    exit_code = nf.nf(['-d', '--rescan-backends', 'true'])
+    assert exit_code == 0
+    assert 'from cache' not in capsys.readouterr().out
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Linux specific test")
+def test_backend_cache_not_stdout(fixture_fake_app, capsys, tmpdir):
+    import os
+
+    cache_file = os.path.join(str(tmpdir), '.nfdir', 'backend_cache.json')
+    os.environ['PATH'] = tmp_fake_apps + ':/bin:/usr/bin'
+    os.environ['DBUS_SESSION_BUS_ADDRESS'] = 'unix:path=' + os.path.join(str(tmpdir), 'no_bus')
+
+    import nf
+    exit_code = nf.nf(['-d', 'true'])
+    captured = capsys.readouterr()
+    assert exit_code == 0
+    if 'probe success' not in captured.out:  # no real backend on this machine
+        assert not os.path.exists(cache_file)
+
+    fixture_fake_app('gdbus', '')
+    exit_code = nf.nf(['-d', 'true'])
+    captured = capsys.readouterr()
+    assert exit_code == 0
+    assert 'backend=stdout from cache' not in captured.out
+    assert os.path.exists(cache_file)
+
+    fixture_fake_app('gdbus', 'exit 1\n')  # e.g. notification daemon is gone
+    exit_code = nf.nf(['-d', 'true'])
+    captured = capsys.readouterr()
+    assert exit_code == 0
+    assert 'backend=gdbus from cache' in captured.out
+    assert 'backend cache dropped' in captured.out
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Linux specific test")
+def test_backend_concurrent_probe(fixture_fake_app, capsys):
+    for app_name in ['gdbus', 'notify-send']:
+        fixture_fake_app(app_name, '')
+
+    import nf
+    exit_code = nf.nf(['-d', '--rescan-backends', 'true'])
+
+    captured = capsys.readouterr()
+    print(captured.out)
+
+    assert exit_code == 0
+    assert 'backend=gdbus probe result=True' in captured.out
+    assert 'backends probe time=' in captured.out
+    assert 'choosen backend is gdbus' in captured.out
+
+
+def test_defer_backend(fixture_environment, capsys):
+    import nf
+    exit_code = nf.nf(['-dp', '--defer-backend', '--backend', 'stdout', 'true'])
+
+    captured = capsys.readouterr()
+    print(captured.out)
+
+    assert exit_code == 0
+    assert 'deferred backend is stdout' in captured.out
+    assert captured.out.index('after run cmd') < captured.out.index('deferred backend is stdout')
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Linux specific test")
+def test_console_names_detection_in_background(fixture_fake_app, capsys, tmpdir):
+    import os
+
+    os.environ['STY'] = '/dev/null'
+    # screen and command wait for each other, so title is found only if screen is asked while command runs
+    meet = 'touch {0}/$1; for i in $(seq 100); do [ -e {0}/$2 ] && exit 0; sleep 0.1; done; exit 1\n'.format(tmpdir)
+    fixture_fake_app('meet', meet)
+    fixture_fake_app('screen', 'meet screen command && echo slow_screen_title\n')
+
+    import nf
+    exit_code = nf.nf(['-np', '--backend', 'stdout', 'meet command screen'])
+
+    captured = capsys.readouterr()
+    print(captured.out)
+
+    assert exit_code == 0
+    assert 'meet command screen [slow_screen_title]' in captured.out.splitlines()
+
+
+def wait_for_daemon_socket(home):
+    import os
+    import time
+
+    daemon_dir = os.path.join(home, '.nfdir', 'daemon')
+    for _ in range(100):
+        if os.path.isdir(daemon_dir) and os.listdir(daemon_dir):
+            return os.path.join(daemon_dir, os.listdir(daemon_dir)[0])
+        time.sleep(0.05)
+    return None
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Linux specific test")
+def test_daemon(fixture_environment, capsys, tmpdir):
+    import os
+    import socket
+    import subprocess
+    import time
+
+    daemon = subprocess.Popen([sys.executable, os.path.abspath('nf.py'), '--daemon', '--backend', 'stdout'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    socket_path = wait_for_daemon_socket(str(tmpdir))
+    assert os.path.basename(socket_path).startswith(socket.gethostname() + '-')
+
+    import nf
+    exit_code = nf.nf(['-d', '-l', 'daemon_label', 'true'])
+
+    daemon.terminate()
+    daemon.communicate()
+
+    captured = capsys.readouterr()
+    print(captured.out)
+
+    assert exit_code == 0
+    assert 'daemon response' in captured.out
+    assert 'true (daemon_label)' in captured.out.splitlines()
+    assert not os.path.exists(socket_path)
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Linux specific test")
+def test_daemon_other_environment(fixture_environment, capsys, tmpdir):
+    import os
+    import subprocess
+
+    environ = dict(os.environ)
+    environ['DISPLAY'] = os.environ.get('DISPLAY', '') + ':other'
+    daemon = subprocess.Popen([sys.executable, os.path.abspath('nf.py'), '--daemon', '--backend', 'stdout'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=environ)
+    assert wait_for_daemon_socket(str(tmpdir)) is not None
+
+    import nf
+    exit_code = nf.nf(['-d', '-l', 'daemon_label', 'true'])
+
+    daemon.terminate()
+    daemon.communicate()
+
+    captured = capsys.readouterr()
+    assert exit_code == 0
+    assert 'choosen backend is daemon' not in captured.out  # it would notify on other display
+    assert 'daemon response' not in captured.out
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Linux specific test")
+def test_daemon_accept_before_delivery(fixture_fake_app, capsys, tmpdir):
+    import os
+    import subprocess
+    import time
+
+    delivered = os.path.join(str(tmpdir), 'delivered')
+    release = os.path.join(str(tmpdir), 'release')
+    fixture_fake_app('notify-send', 'for i in $(seq 300); do [ -e ' + release + ' ] && break; sleep 0.1; done\n: > ' + delivered + '\n')
+
+    daemon = subprocess.Popen([sys.executable, os.path.abspath('nf.py'), '--daemon', '--backend', 'notify-send'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert wait_for_daemon_socket(str(tmpdir)) is not None
+
+    import nf
+    exit_code = nf.nf(['-d', 'true'])
+    delivered_before_reply = os.path.exists(delivered)
+    open(release, 'w').close()
+    for _ in range(100):
+        if os.path.exists(delivered):
+            break
+        time.sleep(0.1)
+
+    daemon.terminate()
+    daemon.communicate()
+
+    captured = capsys.readouterr()
+    assert exit_code == 0
+    assert "'status': 'accepted'" in captured.out
+    assert not delivered_before_reply  # client does not wait for delivery
+    assert os.path.exists(delivered)
+
+
+def test_async_notify(fixture_fake_app, tmpdir, monkeypatch):
+    import os
+    import time
+
+    def no_fork():
+        raise AssertionError('nf process with threads must not fork')
+    monkeypatch.setattr(os, 'fork', no_fork)
+
+    notify_log = os.path.join(str(tmpdir), 'notify-send.log')
+    release = os.path.join(str(tmpdir), 'release')
+    fixture_fake_app('notify-send', 'for i in $(seq 300); do [ -e ' + release + ' ] && break; sleep 0.1; done\necho "$@" >> ' + notify_log + '\n')
+
+    import nf
+    exit_code = nf.nf(['--async-notify', '-b', 'notify-send', '-l', 'async', 'false'])
+
+    assert exit_code == 1
+    assert not os.path.exists(notify_log)  # slow backend does not hold the prompt
+    open(release, 'w').close()
+    for _ in range(50):
+        if os.path.exists(notify_log):
+            break
+        time.sleep(0.1)
+    with open(notify_log) as f:
+        notifications = f.read()
+    assert 'exit code = 1' in notifications
+    assert '--app-name false' in notifications  # the same notification as without --async-notify
+
+
+def test_async_notify_ssh(fixture_fake_python, tmpdir):
+    import os
+    import time
+
+    os.environ['SSH_CLIENT'] = '127.0.0.1 5555 6666'
+    notify_log = os.path.join(str(tmpdir), 'notify-send.log')
+    fixture_fake_python('ssh', 'exec sh\n')
+    fixture_fake_python('notify-send', 'echo "$@" >> ' + notify_log + '\n')
+
+    import nf
+    for run in range(3):
+        exit_code = nf.nf(['--async-notify', '-b', 'ssh', '--sub-nf-args=-b notify-send', '--custom_notification_title', 'async {}'.format(run), 'true'])
+        assert exit_code == 0
+
+    notifications = ''
+    for _ in range(100):
+        if os.path.exists(notify_log):
+            with open(notify_log) as f:
+                notifications = f.read()
+            if all('async {}'.format(run) in notifications for run in range(3)):
+                break
+        time.sleep(0.1)
+    assert all('async {}'.format(run) in notifications for run in range(3))  # remote nf run for each of them
+
+
+def test_coalesce(fixture_fake_app, tmpdir):
+    import os
+    import subprocess
+
+    notify_log = os.path.join(str(tmpdir), 'notify-send.log')
+    fixture_fake_app('notify-send', 'echo "$@" >> ' + notify_log + '\n')
+    os.environ['NF_COALESCE'] = '2'  # by environment, like in shell rc file
+
+    nf_py = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'nf.py')
+    processes = [subprocess.Popen([sys.executable, nf_py, '-b', 'notify-send', '-l', 'shard{}'.format(shard), ['true', 'false'][shard % 2]], stdout=subprocess.PIPE)
+                 for shard in range(5)]
+    exit_codes = [p.wait() for p in processes]
+    for p in processes:
+        p.stdout.close()
+    del os.environ['NF_COALESCE']
+
+    assert exit_codes == [0, 1, 0, 1, 0]
+    with open(notify_log) as f:
+        notifications = f.read()
+    print(notifications)
+    assert notifications.count('jobs finished') == 1  # one delivery for all of them
+    assert '5 jobs finished, 2 failed' in notifications
+    assert 'shard1: exit code 1' in notifications and 'shard3: exit code 1' in notifications
+    assert 'shard0' not in notifications
+    spool_dirs = os.listdir(os.path.join(str(tmpdir), '.nfdir', 'spool'))
+    assert len(spool_dirs) == 1
+    assert [name for name in os.listdir(os.path.join(str(tmpdir), '.nfdir', 'spool', spool_dirs[0])) if name != 'lock'] == []
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Linux specific test")
+def test_coalesce_other_session(fixture_fake_app, tmpdir):
+    import os
+    import subprocess
+
+    notify_log = os.path.join(str(tmpdir), 'notify-send.log')
+    fixture_fake_app('notify-send', 'echo "$DISPLAY $@" >> ' + notify_log + '\n')
+
+    nf_py = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'nf.py')
+    processes = []
+    for display in [':1', ':1', ':2']:
+        environ = dict(os.environ, DISPLAY=display)
+        processes.append(subprocess.Popen([sys.executable, nf_py, '--coalesce', '2', '-b', 'notify-send', '-l', 'display' + display, 'true'], stdout=subprocess.PIPE, env=environ))
+    for p in processes:
+        p.communicate()
+
+    with open(notify_log) as f:
+        notifications = f.read().splitlines()
+    print(notifications)
+    assert len([line for line in notifications if line.startswith(':1 ') and '2 jobs finished' in line]) == 1
+    assert len([line for line in notifications if line.startswith(':2 ')]) == 1  # own session, not in digest of :1
+    assert not [line for line in notifications if '3 jobs finished' in line]
+
+
+def test_coalesce_wrong_environment(fixture_environment, capsys):
+    import os
+
+    os.environ['NF_COALESCE'] = 'abc'
+    try:
+        import nf
+        exit_code = nf.nf(['-n', 'true'])
+    finally:
+        del os.environ['NF_COALESCE']
+    captured = capsys.readouterr()
+
+    assert exit_code == 0
+    assert 'NF_COALESCE is not number of seconds' in captured.err
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Linux specific test")
+def test_rusage(fixture_environment, capsys):
+    import nf
+    exit_code = nf.nf(['-np', '--backend', 'stdout', 'python -c "sum(range(10**6))"'])
+
+    captured = capsys.readouterr()
+    print(captured.out)
+
+    assert exit_code == 0
+    assert [line for line in captured.out.splitlines() if line.startswith('CPU user/sys: ')]
+    assert [line for line in captured.out.splitlines() if line.startswith('Max RSS: ')]
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Linux specific test")
+def test_tail(fixture_environment, capsys):
+    import nf
+    exit_code = nf.nf(['-np', '--tail', '2', '--backend', 'stdout', 'python -c "import sys;[print(i) for i in range(100000)];sys.exit(3)"'])
+
+    captured = capsys.readouterr()
+    print(captured.out)
+
+    lines = captured.out.splitlines()
+    assert exit_code == 3
+    assert '0' in lines and '99997' in lines  # output passed through
+    index = lines.index('Output tail:')
+    assert lines[index + 1:index + 3] == ['99998', '99999']
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Linux specific test")
+def test_tail_bytes_small_chunks(fixture_environment, capsys):
+    import nf
+    exit_code = nf.nf(['-np', '--tail-bytes', '200', '--backend', 'stdout', 'python -u -c "import time;[(print(\'line\', i), time.sleep(0.005)) for i in range(50)]"'])
+
+    captured = capsys.readouterr()
+    print(captured.out)
+
+    lines = captured.out.splitlines()
+    assert exit_code == 0
+    tail = lines[lines.index('Output tail:') + 1:]
+    assert 'line 30' in tail and 'line 49' in tail  # about 200 bytes, not only the last chunk
+    assert 'line 10' not in tail
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Linux specific test")
+def test_notify_on(fixture_environment, capsys):
+    import nf
+    exit_code = nf.nf(['--notify-on', 'line 5$', '--notify-on', '[Ff]ail', '--notify-on', 'never', '--backend', 'stdout', 'python -c "[print(\'line\', i) for i in range(100000)];print(\'FAIL\')"'])
+
+    captured = capsys.readouterr()
+    print(captured.out)
+
+    lines = captured.out.splitlines()
+    assert exit_code == 0
+    assert len([line for line in lines if line.endswith('" output matched "line 5$":')]) == 1
+    assert lines.count('line 5') == 2  # command output and notification
+    assert not [line for line in lines if 'output matched "[Ff]ail"' in line]
+    assert not [line for line in lines if 'output matched "never"' in line]
+
+
+def test_notify_on_inline_flags(fixture_environment, capsys):
+    import nf
+    exit_code = nf.nf(['--notify-on', 'line 7$', '--notify-on', '(?i)fail', '--backend', 'stdout', 'python -c "[print(\'line\', i) for i in range(10)];print(\'FAIL\')"'])
+
+    captured = capsys.readouterr()
+    print(captured.out)
+
+    lines = captured.out.splitlines()
+    assert exit_code == 0
+    # (?i) cannot be joined with other patterns, so patterns are used one by one
+    assert len([line for line in lines if line.endswith('" output matched "line 7$":')]) == 1
+    assert len([line for line in lines if line.endswith('" output matched "(?i)fail":')]) == 1
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Linux specific test")
+def test_heartbeat(fixture_fake_app, capsys, tmpdir):
+    import os
+
+    calls = os.path.join(str(tmpdir), 'gdbus_calls')
+    fixture_fake_app('gdbus', 'if [ "$8" = "org.freedesktop.Notifications.Notify" ]; then echo "${10}" >> ' + calls + '; echo "(uint32 7,)"; fi\n')
+
+    import nf
+    exit_code = nf.nf(['--backend', 'gdbus', '--heartbeat', '0.3', 'sleep 1'])
+    assert exit_code == 0
+
+    with open(calls) as f:
+        replaces_ids = f.read().split()
+    assert len(replaces_ids) >= 3  # heartbeats and final notification
+    assert replaces_ids[0] == '0'
+    assert set(replaces_ids[1:]) == set(['7'])
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Linux specific test")
+def test_heartbeat_daemon_cannot_replace(fixture_environment, capsys, tmpdir):
+    import os
+    import subprocess
+
+    daemon = subprocess.Popen([sys.executable, os.path.abspath('nf.py'), '-d', '--daemon', '--backend', 'stdout'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert wait_for_daemon_socket(str(tmpdir)) is not None
+
+    import nf
+    exit_code = nf.nf(['-d', '--heartbeat', '0.2', 'sleep 1'])
+
+    daemon.terminate()
+    daemon_output = daemon.communicate()[0].decode()
+
+    captured = capsys.readouterr()
+    assert exit_code == 0
+    assert 'backend stdout cannot replace notification, no heartbeat' in captured.out
+    assert 'is running' not in daemon_output  # no stray heartbeat notification
+    assert 'finished work' in daemon_output
+
+
+def dbus_stand_in_bus(socket_path, messages, connections):
+    import socket
+    import struct
+    import threading
+
+    def reply(serial, signature, body):
+        fields = struct.pack('<BBcBI', 5, 1, b'u', 0, serial) + struct.pack('<BBcBB', 8, 1, b'g', 0, len(signature)) + signature + b'\0'
+        header = b'l\x02\x00\x01' + struct.pack('<III', len(body), serial + 1000, len(fields)) + fields
+        return header + b'\0' * (-len(header) % 8) + body
+
+    def serve(connection):
+        data = b''
+        while b'BEGIN\r\n' not in data:
+            data += connection.recv(4096)
+            if b'AUTH EXTERNAL' in data and b'\r\n' in data and b'OK' not in data:
+                connection.sendall(b'OK 0123456789abcdef\r\n')
+                data += b'OK'
+        data = data[data.index(b'BEGIN\r\n') + 7:]
+        while True:
+            while len(data) < 16 or len(data) < 16 + struct.unpack_from('<I', data, 12)[0]:
+                chunk = connection.recv(4096)
+                if not chunk:
+                    return
+                data += chunk
+            body_length, serial, fields_length = struct.unpack_from('<III', data, 4)
+            length = 16 + fields_length + (-fields_length % 8) + body_length
+            while len(data) < length:
+                data += connection.recv(4096)
+            message, data = data[:length], data[length:]
+            messages.append(message)
+            if b'Hello' in message:
+                connection.sendall(reply(serial, b's', struct.pack('<I', 4) + b':1.1\0'))
+            elif b'NameHasOwner' in message:
+                connection.sendall(reply(serial, b'b', struct.pack('<I', 1)))
+            elif b'Notify' in message:
+                connection.sendall(reply(serial, b'u', struct.pack('<I', 42)))
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(5)
+
+    def accept():
+        while True:
+            try:
+                connection, _ = server.accept()
+            except Exception:
+                return
+            connections.append(connection)
+            thread = threading.Thread(target=serve, args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+    thread = threading.Thread(target=accept)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Linux specific test")
+def test_dbus_wire(fixture_environment, capsys, tmpdir, monkeypatch):
+    import os
+
+    socket_path = os.path.join(str(tmpdir), 'bus')
+    os.environ['DBUS_SESSION_BUS_ADDRESS'] = 'unix:path={},guid=0123456789abcdef'.format(socket_path)
+    monkeypatch.setitem(sys.modules, 'dbus', None)
+    messages = []
+    connections = []
+    server = dbus_stand_in_bus(socket_path, messages, connections)
+
+    import nf
+    try:
+        exit_code = nf.nf(['-d', '--backend', 'dbus', '--custom_notification_title', 'wire title', 'true'])
+    finally:
+        server.close()
+
+    captured = capsys.readouterr()
+    print(captured.out)
+
+    assert exit_code == 0
+    assert len(connections) == 1  # probe and notification share connection
+    assert [b'Hello' in message for message in messages].count(True) == 1
+    notify = [message for message in messages if b'Notify' in message]
+    assert len(notify) == 1
+    assert b'wire title' in notify[0]
+    assert b'susssasa{sv}i' in notify[0]
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Linux specific test")
+def test_tmux_context_cache(fixture_fake_app, capsys, tmpdir):
+    import os
+
+    os.environ['TMUX'] = '/dev/null'
+    os.environ['TMUX_PANE'] = '%1'
+    calls = os.path.join(str(tmpdir), 'tmux_calls')
+    fixture_fake_app('tmux', 'echo "$@" >> ' + calls + '\nprintf "session\\t1\\twindow\\t2\\tpane\\t\\n"\necho "SSH_CLIENT=10.0.0.1 1234 22"\n')
+
+    import nf
+    for _ in range(2):
+        exit_code = nf.nf(['-d', '-b', 'stdout', 'true'])
+        assert exit_code == 0
+
+    captured = capsys.readouterr()
+    print(captured.out)
+
+    with open(calls) as f:
+        tmux_calls = f.read().splitlines()
+    assert len(tmux_calls) == 1
+    assert '-t %1' in tmux_calls[0]
+    assert 'cached tmux context' in captured.out
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Linux specific test")
+def test_tmux_context_concurrent(fixture_fake_app, capsys, tmpdir):
+    import os
+
+    os.environ['TMUX'] = '/dev/null'
+    os.environ['TMUX_PANE'] = '%1'
+    calls = os.path.join(str(tmpdir), 'tmux_calls')
+    fixture_fake_app('tmux', 'echo "$@" >> ' + calls + '\nsleep 0.5\nprintf "session\\t1\\twindow\\t2\\tpane\\t\\n"\necho "SSH_CLIENT=10.0.0.1 1234 22"\n')
+    fixture_fake_app('ssh', 'exit 255\n')
+
+    import nf
+    exit_code = nf.nf(['-d', '--rescan-backends', 'true'])  # ssh and paramiko probes and console names detection ask tmux at once
+    assert exit_code == 0
+
+    with open(calls) as f:
+        tmux_calls = f.read().splitlines()
+    assert len(tmux_calls) == 1
+
+
+@pytest.mark.skipif(sys.platform != "linux" and sys.platform != "linux2", reason="Linux specific test")
+def test_proc_parents(fixture_environment, tmpdir):
+    import os
+    import subprocess
+
+    script = os.path.join(str(tmpdir), 'nf (t) x')  # shell name with spaces and parentheses
+    with open(script, 'w') as f:
+        f.write('#!/bin/sh\nfor i in 1 2; do "{}" -c "import sys; sys.modules[\'psutil\'] = None; import nf; nf.nf([\'-d\', \'-b\', \'stdout\', \'true\'])"; done\n'.format(sys.executable))
+    os.chmod(script, 0o777)
+
+    output = subprocess.check_output([script], env=dict(os.environ, PYTHONPATH=os.getcwd())).decode()
+
+    assert "shell parents ['nf (t) x'," in output
+    assert output.count('cached parents') == 1  # second nf from the same shell
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Linux specific test")
+@pytest.mark.parametrize("argv, direct", [
+    (['true'], True),
+    (['ls', '-l', '/'], True),
+    (['--use-shell', 'true'], False),
+    (['true | cat'], False),
+    (['ls', '$HOME'], False),
+    (['cd', '/'], False),
+    (['A=1', 'true'], False),
+])
+def test_run_without_shell(fixture_environment, capsys, argv, direct):
+    import nf
+    exit_code = nf.nf(['-d', '-b', 'stdout'] + argv)
+
+    captured = capsys.readouterr()
+
+    assert exit_code == 0
+    assert ('run without shell' in captured.out) == direct
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Linux specific test")
+def test_run_alias_shadows_binary(fixture_environment, tmpdir):
+    import os
+    import subprocess
+
+    bash_env = os.path.join(str(tmpdir), 'bash_env')
+    with open(bash_env, 'w') as f:
+        f.write("shopt -s expand_aliases\nalias uname='echo aliased uname'\n")
+    environ = dict(os.environ, BASH_ENV=bash_env)
+    nf_py = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'nf.py')
+    for _ in range(2):  # second time from cache
+        # bash stays parent of nf, so it is the detected shell
+        output = subprocess.check_output(['bash', '-c', '"{}" "{}" -d -b stdout uname; true'.format(sys.executable, nf_py)], env=environ).decode()
+        print(output)
+        assert 'aliased uname' in output
+        assert 'run without shell' not in output
+    assert 'cached shell command' in output
+
+    os.remove(bash_env)
+    output = subprocess.check_output(['bash', '-c', '"{}" "{}" -d -b stdout uname; true'.format(sys.executable, nf_py)], env=environ).decode()
+    assert 'run without shell' in output
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Linux specific test")
+def test_remote_nf_cache(fixture_fake_python, capsys, tmpdir):
+    import glob
+    import os
+
+    os.environ['SSH_CLIENT'] = '127.0.0.1 5555 6666'
+    fixture_fake_python('ssh', 'exec sh\n')  # "remote" shell on this machine
+
+    import nf
+    outputs = []
+    for _ in range(2):
+        exit_code = nf.nf(['-d', '--backend', 'ssh', '--sub-nf-args=-b stdout', '--custom_notification_title', 'remote title', 'true'])
+        assert exit_code == 0
+        outputs.append(capsys.readouterr().out)
+    print(outputs)
+
+    assert 'remote nf cache MISS' in outputs[0]
+    assert 'remote nf cache HIT' in outputs[1]
+    assert 'remote title' in outputs[1].split('remote nf cache HIT')[1]  # printed by remote nf
+    assert len(glob.glob(os.path.join(str(tmpdir), '.nfdir', 'cache', 'nf_*.py'))) == 1
+
+
+def test_paramiko_text_mode(fixture_environment, capsys, monkeypatch):
+    import io
+    import os
+
+    os.environ['SSH_CLIENT'] = '127.0.0.1 5555 6666'
+    commands = []
+
+    class FakeChannel(object):
+        def shutdown_write(self):
+            pass
+
+    class FakeSSHClient(object):
+        def set_missing_host_key_policy(self, policy):
+            pass
+        def load_system_host_keys(self):
+            pass
+        def connect(self, **kwargs):
+            pass
+        def exec_command(self, command, timeout=None):
+            commands.append(command)
+            stdin = mock.MagicMock()
+            stdin.channel = FakeChannel()
+            # like paramiko makefile('r'): readline() returns str
+            return stdin, io.StringIO(u'NF-BOOTSTRAP HIT\nremote nf done\n'), io.StringIO(u'')
+        def close(self):
+            pass
+
+    fake_paramiko = mock.MagicMock()
+    fake_paramiko.SSHClient = FakeSSHClient
+    monkeypatch.setitem(sys.modules, 'paramiko', fake_paramiko)
+
+    import nf
+    exit_code = nf.nf(['-d', '--backend', 'paramiko', 'true'])
+    captured = capsys.readouterr()
+
+    assert exit_code == 0
+    assert len(commands) == 1
+    assert 'remote nf cache HIT' in captured.out
+    assert 'remote nf done' in captured.out
+    assert 'engine error' not in captured.out
+
+
+def test_remote_without_source(fixture_environment, capsys, monkeypatch):
+    import os
+
+    os.environ['SSH_CLIENT'] = '127.0.0.1 5555 6666'
+
+    import nf
+    monkeypatch.setattr(nf, '__file__', os.path.join(os.sep, 'nonexistent', 'nf.py'))  # e.g. run from zip
+    exit_code = nf.nf(['-d', '--backend', 'ssh', 'true'])
+    captured = capsys.readouterr()
+
+    assert exit_code == 0
+    assert 'remote nf is not available' in captured.out
+    assert 'engine error' not in captured.out
+
+
+def test_ssh_control_master(fixture_fake_python, capsys, tmpdir):
+    import os
+
+    os.environ['SSH_CLIENT'] = '127.0.0.1 5555 6666'
+    ssh_log = os.path.join(str(tmpdir), 'ssh.log')
+    fixture_fake_python('ssh',
+                        'echo "$@" >> ' + ssh_log + '\n'
+                        'for a in "$@"; do case "$a" in ControlPath=*) cp="${a#ControlPath=}";; esac; done\n'
+                        'case " $* " in\n'
+                        '  *" -O check "*) test -e "$cp"; exit $?;;\n'
+                        '  *" -f -N "*) : > "$cp"; exit 0;;\n'
+                        'esac\n'
+                        'exec sh\n')
+
+    import nf
+    for _ in range(2):
+        exit_code = nf.nf(['-d', '--backend', 'ssh', '--sub-nf-args=-b stdout', '--custom_notification_title', 'remote title', 'true'])
+        assert exit_code == 0
+        assert 'remote title' in capsys.readouterr().out  # printed by remote nf
+
+    with open(ssh_log) as f:
+        calls = f.read().splitlines()
+    print(calls)
+    masters = [call for call in calls if ' -f -N ' in call]
+    assert len(masters) == 1  # second run multiplexed over the first master
+    assert 'ControlPersist=600' in masters[0] and 'BatchMode=yes' in masters[0]
+    assert len([call for call in calls if '-O check' in call]) == 1  # no socket yet on first run
+    assert all('ControlPath=' + os.path.join(str(tmpdir), '.nfdir', 'ssh', '') in call for call in calls)
+
+
+def test_ssh_control_master_stale(fixture_fake_python, capsys, tmpdir):
+    import os
+
+    os.environ['SSH_CLIENT'] = '127.0.0.1 5555 6666'
+    ssh_log = os.path.join(str(tmpdir), 'ssh.log')
+    fixture_fake_python('ssh',
+                        'echo "$@" >> ' + ssh_log + '\n'
+                        'for a in "$@"; do case "$a" in ControlPath=*) cp="${a#ControlPath=}";; esac; done\n'
+                        'case " $* " in\n'
+                        '  *" -O check "*) exit 255;;\n'  # master is dead
+                        '  *" -f -N "*) test -e "$cp" && exit 1; : > "$cp"; exit 0;;\n'  # real ssh would not multiplex
+                        'esac\n'
+                        'exec sh\n')
+
+    ssh_dir = os.path.join(str(tmpdir), '.nfdir', 'ssh')
+    os.makedirs(ssh_dir)
+    import hashlib
+    stale = os.path.join(ssh_dir, hashlib.sha1('127.0.0.1:6666'.encode()).hexdigest()[:16])
+    open(stale, 'w').close()
+
+    import nf
+    exit_code = nf.nf(['-d', '--backend', 'ssh', '--sub-nf-args=-b stdout', '--custom_notification_title', 'remote title', 'true'])
+    assert exit_code == 0
+    assert 'remote title' in capsys.readouterr().out
+
+    with open(ssh_log) as f:
+        calls = f.read().splitlines()
+    assert len([call for call in calls if '-O check' in call]) == 1
+    assert len([call for call in calls if ' -f -N ' in call]) == 1
+
+
 def test_wsl(fixture_environment):
     test_file = 'tmp_debugfile3'
 
@@ -1240,6 +2102,14 @@ def test_wsl(fixture_environment):
     exit_code = nf.nf(['-dp', '--debugfile', test_file, '--backend', 'wsl', ''])
     import os
 
+    try:
+        import json
+        import signal
+        with open(os.path.join(os.path.expanduser('~'), '.nfdir', 'wsl', 'helper.json')) as f:
+            os.kill(json.load(f)['pid'], signal.SIGTERM)  # resident helper started by wsl backend
+    except Exception:
+        pass
+
     try:
         os.remove(test_file)
     except:
@@ -1250,6 +2120,154 @@ def test_wsl(fixture_environment):
     assert exit_code == 0
 
 
+def test_provision(fixture_environment, capsys, tmpdir):
+    import os
+
+    manifest = os.path.join(str(tmpdir), '.nfdir', 'wsl', 'manifest-1-3.8.2.json')
+    os.makedirs(os.path.dirname(manifest))
+    with open(manifest, 'w') as f:
+        f.write('{}')
+
+    import nf
+    exit_code = nf.nf(['-d', '--provision'])
+    captured = capsys.readouterr()
+    print(captured.out)
+
+    assert exit_code == 0
+    assert 'already provisioned: {}'.format(manifest) in captured.out
+    assert 'install pip' not in captured.out
+    assert not os.path.exists(os.path.join(str(tmpdir), '.nfdir', 'downloaded'))
+
+
+def test_wsl_helper(fixture_fake_python, capsys, tmpdir):
+    import json
+    import os
+    import signal
+    import time
+
+    nf_dir = os.path.join(str(tmpdir), '.nfdir')
+    # nothing to download, "Windows" python is python from PATH outside of WSL
+    os.makedirs(os.path.join(nf_dir, 'wsl'))
+    open(os.path.join(nf_dir, 'wsl', 'manifest-1-3.8.2.json'), 'w').close()
+
+    notify_log = os.path.join(str(tmpdir), 'notify-send.log')
+    fixture_fake_python('notify-send', 'echo "$@" >> ' + notify_log + '\n')
+
+    import nf
+    outputs = []
+    infos = []
+    try:
+        for title in ['first', 'second']:
+            exit_code = nf.nf(['-d', '--backend', 'wsl', '--sub-nf-args=-b notify-send', '--custom_notification_title', title, 'true'])
+            assert exit_code == 0
+            outputs.append(capsys.readouterr().out)
+            with open(os.path.join(nf_dir, 'wsl', 'helper.json')) as f:
+                infos.append(json.load(f))
+    finally:
+        if infos:
+            os.kill(infos[0]['pid'], signal.SIGTERM)
+
+    assert 'start wsl helper' in outputs[0]
+    assert 'start wsl helper' not in outputs[1]
+    assert 'run external python' not in ''.join(outputs)
+    assert all('notification delivered by wsl helper' in output for output in outputs)
+    assert infos[0]['pid'] == infos[1]['pid']
+    for _ in range(100):  # helper replies after delivery, notify-send may still be writing
+        with open(notify_log) as f:
+            notifications = f.read()
+        if 'first' in notifications and 'second' in notifications:
+            break
+        time.sleep(0.05)
+    assert 'first' in notifications and 'second' in notifications
+
+
+def test_try_version_offline(fixture_environment, capsys, tmpdir):
+    import hashlib
+    import json
+    import os
+
+    versions_dir = os.path.join(str(tmpdir), '.nfdir', 'versions')
+    source = b'import sys\ndef nf(argv=None):\n    print("tried nf", argv, sys.argv[1:])\n    return 3\n'
+    sha = hashlib.sha256(source).hexdigest()
+    os.makedirs(os.path.join(versions_dir, 'objects'))
+    with open(os.path.join(versions_dir, 'objects', 'nf_{}.py'.format(sha)), 'wb') as f:
+        f.write(source)
+    with open(os.path.join(versions_dir, 'refs.json'), 'w') as f:
+        json.dump({'v9.9.9': {'sha256': sha, 'etag': '"x"', 'time': 0}}, f)
+    with open(os.path.join(versions_dir, 'tags.json'), 'w') as f:
+        json.dump({'tags': ['v9.9.9', 'v1.4.0'], 'etag': '"y"', 'time': 0}, f)
+
+    import nf
+    exit_code = nf.nf(['--offline', '--try-version', 'v9.9.9', 'echo', 'hi'])
+    captured = capsys.readouterr()
+    assert exit_code == 3  # exit code of tried version, run in this process
+    assert "tried nf ['echo', 'hi'] ['echo', 'hi']" in captured.out
+
+    exit_code = nf.nf(['--offline', '--try-version=list'])
+    captured = capsys.readouterr()
+    assert exit_code == 0
+    assert captured.out == 'v9.9.9 v1.4.0\n'
+
+    exit_code = nf.nf(['--offline', '--try-version', 'v0.0.1', 'echo', 'hi'])
+    captured = capsys.readouterr()
+    assert exit_code == 1
+    assert 'nf version v0.0.1 is not cached' in captured.err
+
+
+def test_profile(fixture_environment, tmpdir):
+    import json
+    import os
+
+    profile_file = os.path.join(str(tmpdir), 'profile.json')
+    cprofile_file = os.path.join(str(tmpdir), 'nf.pstats')
+
+    import nf
+    exit_code = nf.nf(['-n', '--profile-file', profile_file, '--cprofile', cprofile_file, 'true'])
+
+    assert exit_code == 0
+    with open(profile_file) as f:
+        report = json.loads(f.readline())
+    phases = [phase['phase'] for phase in report['phases']]
+    for phase in ['arguments', 'environment', 'backend', 'parents', 'shell', 'command', 'notification', 'save']:
+        assert phase in phases
+    assert report['total'] >= sum([phase['seconds'] for phase in report['phases'] if phase['phase'] != 'console_names (background)'])
+    assert os.path.exists(cprofile_file)
+
+
+def test_history(fixture_environment, capsys, tmpdir):
+    import json
+    import os
+
+    cwd = os.getcwd()
+    os.chdir(str(tmpdir))
+
+    import nf
+    try:
+        assert nf.nf(['-n', '-s', '-l', 'history_label', 'true']) == 0
+        assert nf.nf(['-n', '-s', 'false']) != 0
+        capsys.readouterr()
+
+        assert nf.nf(['history', '--json', '--cwd', '.']) == 0
+        jobs = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+        assert [job['cmdline'] for job in jobs] == ['true', 'false']
+        assert jobs[0]['label'] == 'history_label'
+        assert jobs[0]['cwd'] == os.path.abspath(str(tmpdir))
+
+        assert nf.nf(['history', '--json', '--failed']) == 0
+        jobs = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+        assert [job['cmdline'] for job in jobs] == ['false']
+
+        assert nf.nf(['history', '--label', 'history_label', '--command', 'tr']) == 0
+        lines = capsys.readouterr().out.splitlines()
+        assert len(lines) == 1
+        assert '$ true" (history_label)' in lines[0]
+
+        with open('.nf') as f:
+            assert len(f.read().splitlines()) == 12
+    finally:
+        os.chdir(cwd)
+
+
 @pytest.mark.slow
 def test_readme_rst():
     import rstcheck